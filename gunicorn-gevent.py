@@ -0,0 +1,23 @@
+import multiprocessing
+import os
+from opcon.modules import config
+
+# cooperative (gevent) workers: log and blobstore downloads wait on the
+# network instead of pinning a process, so hundreds of them can share a
+# few workers.
+#   gunicorn -c gunicorn-gevent.py 'opcon.app:app'
+worker_class = 'gevent'
+worker_connections = 1000
+# streams don't hold threads here, so [bosh] event_streams defaults higher
+raw_env = ['OPCON_GEVENT=1']
+
+# more than one worker needs a shared state store (see [state] in opcon.ini)
+_config = config.config(config_file=os.getenv('CONFIG_FILE', 'opcon.ini'))
+if _config.get('o_state_store'):
+    workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+else:
+    workers = 1
+
+backlog = 2048
+errorlog = '-'
+accesslog = '-'
@@ -1,5 +1,20 @@
+import multiprocessing
+import os
+from opcon.modules import config
+
+# more than one worker needs a shared state store (see [state] in opcon.ini)
+_config = config.config(config_file=os.getenv('CONFIG_FILE', 'opcon.ini'))
+if _config.get('o_state_store'):
+    workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+else:
+    workers = 1
+
+# threads, shared by every request; a page holding a task events stream
+# open (see opcon/modules/taskevents.py) holds one of them, so only
+# [bosh] event_streams (default 2) of them are held at once
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
 backlog = 64
-workers = 1
 worker_connections = 10
 errorlog = '-'
 accesslog = '-'
@@ -2,9 +2,18 @@ import sys
 import json
 import requests
 from opcon.modules import accesslog
+from opcon.modules import taskhistory
+from opcon.modules import blobcache
+from opcon.modules import logsearch
+from opcon.modules import logcollect
+from opcon.modules import vitalsummary
+from opcon.modules import vitalsquery
+from opcon.modules import federation
+from opcon.modules import tasktail
+from opcon.modules import taskevents
 import flask_login
 from flask import current_app, request
-from flask import Response, stream_with_context, redirect
+from flask import Response, stream_with_context, redirect, send_file
 from flask import Blueprint
 
 api_bp = Blueprint('api_bp', __name__,
@@ -12,6 +21,14 @@ api_bp = Blueprint('api_bp', __name__,
                    static_folder='static', static_url_path='assets')
 
 
+@api_bp.errorhandler(requests.RequestException)
+def v1_director_error(e):
+    # the director (or its UAA) failed mid-request, e.g. it refused a re-login
+    print('director request failed: {}'.format(e), file=sys.stderr)
+    return Response(json.dumps({"status": "error", "message": "director request failed: {}".format(e)}),
+                    status=502, content_type='application/json; charset=UTF-8')
+
+
 # v1/ -- return usage
 @api_bp.route('/v1', methods=['GET', 'POST'])
 # @flask_login.login_required
@@ -63,29 +80,95 @@ def v1_callback():
 # v1/tasks - return list of previous tasks
 @api_bp.route('/v1/tasks')
 def v1_tasks():
-    director = current_app.config['DIRECTOR']
+    # all directors' tasks, when there are several
+    director = current_app.config.get('DIRECTORS') or current_app.config['DIRECTOR']
     limit = request.args.get('limit', default=100, type=int)
+    filters = taskhistory.filters_from_args(request.args)
+    try:
+        results = director.get_job_history(limit, **filters)
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        status=400, content_type='application/json; charset=UTF-8')
     return Response(
-        json.dumps({"status": "ok", "limit": limit, "results": director.get_job_history(limit)}),
+        json.dumps({"status": "ok", "limit": limit, "filters": filters, "results": results}),
         status=200, content_type='application/json; charset=UTF-8')
 
 
+# v1/tasks/events - task state changes as Server-Sent Events ("task" events
+# of {"director", "id", "state", ...}); resumes from Last-Event-ID
+@api_bp.route('/v1/tasks/events')
+def v1_task_events():
+    events = current_app.config.get('TASK_EVENTS')
+    if events is None:
+        return Response(json.dumps({"status": "error", "message": "no task events"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    streams = current_app.config['STREAMS']
+    if streams.full():
+        return Response(json.dumps({"status": "error", "message": "too many streams"}),
+                        content_type='application/json; charset=UTF-8',
+                        headers={'Retry-After': str(taskevents.BUSY_RETRY // 1000)},
+                        status=503)
+    director = current_app.config['DIRECTOR']
+    if director.task_watcher is not None:
+        director.task_watcher.watch_pending()
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    return Response(stream_with_context(streams.hold(events.stream(last_id))),
+                    content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 # v1/tasks/<taskid>/<action>
 # Perform result/debug/event/cancel on the task
 @api_bp.route('/v1/task/<taskid>/<out_type>')
 def v1_tasks_id_action(taskid, out_type):
-    director = current_app.config['DIRECTOR']
+    director = federation.select(current_app.config, request.args.get('director'))
+    if director is None:
+        return Response(json.dumps({"status": "error", "message": "no such director"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
     if out_type not in ["result", "debug", "event", "cancel"]:
         return Response(
             json.dumps({"status": "error", "message": "result, debug, event, cancel"}),
             content_type='application/json; charset=UTF-8',
             status=404)
+    if request.args.get('follow') and out_type != 'cancel':
+        # ?follow=1&offset=N - only what the task adds from offset on, until it finishes
+        try:
+            tail = tasktail.TaskTail(director, taskid, out_type,
+                                     offset=request.headers.get('Last-Event-ID') or request.args.get('offset'))
+        except ValueError as e:
+            return Response(json.dumps({"status": "error", "message": str(e)}),
+                            content_type='application/json; charset=UTF-8',
+                            status=400)
+        streams = current_app.config['STREAMS']
+        if streams.full():
+            return Response(json.dumps({"status": "error", "message": "too many streams"}),
+                            content_type='application/json; charset=UTF-8',
+                            headers={'Retry-After': str(taskevents.BUSY_RETRY // 1000)},
+                            status=503)
+        if request.accept_mimetypes.best == 'text/event-stream':
+            return Response(stream_with_context(streams.hold(tail.sse())),
+                            content_type='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        return Response(stream_with_context(streams.hold(tail.text(), busy=b'')),
+                        content_type='text/plain; charset=UTF-8',
+                        headers={'X-Accel-Buffering': 'no', 'X-Task-Offset': str(tail.offset)})
+    # task ids are per director; the cache holds the primary director's
+    cache = None
+    if director is current_app.config['DIRECTOR']:
+        cache = current_app.config.get('OUTPUT_CACHE')
+    if cache is not None:
+        cached = cache.lookup(taskid, out_type)
+        if cached is not None:
+            return send_file(cached, mimetype='text/plain; charset=UTF-8', conditional=True)
     task_url = '/tasks/{}/output'.format(taskid)
-    r = director.session.get(director.bosh_url + task_url,
-                             params={'type': out_type},
-                             verify=director.verify_tls)
+    r = director.stream(task_url, params={'type': out_type})
     if r.ok:
-        return Response(stream_with_context(r.iter_content(chunk_size=512*1024)),
+        body = director.iter_stream(r)
+        if cache is not None and cache.path(taskid, out_type) and director.task_finished(taskid):
+            body = cache.tee(taskid, out_type, body)
+        return Response(stream_with_context(body),
                         content_type='text/plain; charset=UTF-8', status=r.status_code)
     return Response(
         json.dumps({"status": "error", "message": r.content}),
@@ -106,10 +189,21 @@ def v1_tasks_id_action(taskid, out_type):
 @api_bp.route('v1/blobstore/<bs_guid>')
 def v1_blobstore_guid(bs_guid):
     director = current_app.config['DIRECTOR']
-    r = director.session.get(director.bosh_url + "/resources/{}".format(bs_guid))
-    return Response(stream_with_context(r.iter_content(chunk_size=512 * 1024)),
+    filename = "{}.tgz".format(bs_guid)
+    blobs = current_app.config.get('BLOB_CACHE')
+    if blobs is not None:
+        cached, body = blobs.fetch(director, bs_guid)
+        if cached is not None:
+            return send_file(cached, mimetype='application/gzip', as_attachment=True,
+                             download_name=filename, conditional=True)
+        if body is not None:
+            return Response(stream_with_context(body),
+                            content_type='application/gzip',
+                            headers={'Content-Disposition': "attachment; filename={}".format(filename)})
+    r = director.stream("/resources/{}".format(bs_guid))
+    return Response(stream_with_context(director.iter_stream(r)),
                     content_type='application/gzip',
-                    headers={'Content-Disposition': "attachment; filename={}.tgz".format(bs_guid)})
+                    headers={'Content-Disposition': "attachment; filename={}".format(filename)})
 
 
 # v1/deployments - return list of deployments
@@ -142,6 +236,7 @@ def v1_deployment_job_actions(deployment, job, instance, action):
     r = director.session.post(action_url,
                               params={'skip_drain': skip_drain},
                               verify=director.verify_tls)
+    director.invalidate(deployment)
     if r.ok:
         return Response(status=r.status_code,
                         content_type='application/json; charset=UTF-8',
@@ -153,6 +248,211 @@ def v1_deployment_job_actions(deployment, job, instance, action):
                         content_type='application/json; charset=UTF-8')
 
 
+# v1/deployment/<deployment>/bulk/<action>
+# POST {"instances": ["diego_cell/*", "api/<guid>"], "canaries": 1, "max_in_flight": 4,
+#       "skip_drain": false} - act on many instances; returns the bulk action to poll
+@api_bp.route('/v1/deployment/<deployment>/bulk/<action>', methods=['POST'])
+def v1_deployment_bulk_actions(deployment, action):
+    bulk = current_app.config['BULK']
+    args = request.get_json(silent=True) or {}
+    try:
+        started = bulk.start(deployment, action, args.get('instances') or [],
+                             canaries=args.get('canaries'),
+                             max_in_flight=args.get('max_in_flight'),
+                             skip_drain=args.get('skip_drain', False))
+    except PermissionError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=403)
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    return Response(json.dumps({"status": "ok", "data": started}),
+                    content_type='application/json; charset=UTF-8',
+                    status=202)
+
+
+# v1/deployment/<deployment>/vitals?fields=id,job_name,mem&sort=-mem&filter=mem>80&limit=100&cursor=...
+# - a page of the deployment's instance vitals; see vitalsquery.query()
+@api_bp.route('/v1/deployment/<deployment>/vitals')
+def v1_deployment_vitals(deployment):
+    director = current_app.config['DIRECTOR']
+    if deployment not in director.deployments:
+        return Response(json.dumps({"status": "error", "message": "no deployment"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    state, vitals, vitals_task = director.get_deployment_vitals_nowait(deployment,
+                                                                       retry=bool(request.args.get('retry')))
+    if state != 'done':
+        return vitals_pending(state, vitals_task)
+    return vitals_page(vitals)
+
+
+# v1/vitals?deployment=cf&fields=director,id,mem&sort=-mem&filter=mem>80 - the
+# same query over the deployment on every director that has one, each
+# instance with a director field
+@api_bp.route('/v1/vitals')
+def v1_vitals():
+    directors = current_app.config['DIRECTORS']
+    deployment = request.args.get('deployment')
+    if not deployment:
+        return Response(json.dumps({"status": "error", "message": "deployment required"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    if not any([deployment in d.deployments for d in directors]):
+        return Response(json.dumps({"status": "error", "message": "no deployment"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    records, pending = directors.get_deployment_vitals(deployment, retry=bool(request.args.get('retry')))
+    if pending:
+        # the task of each director still collecting
+        return vitals_pending('processing', pending)
+    return vitals_page(records,
+                       default_fields=['director'] + vitalsquery.DEFAULT_FIELDS)
+
+
+def vitals_pending(state, task):
+    '''the vitals are not in yet: 202 while their task runs (ask again), else
+    500 (failed; asked again with retry=1, or after a minute, it is run again)'''
+    if state == 'processing':
+        return Response(json.dumps({"status": "pending", "task": task}),
+                        content_type='application/json; charset=UTF-8',
+                        headers={'Retry-After': '2'},
+                        status=202)
+    return Response(json.dumps({"status": "error", "message": "vitals could not be collected", "task": task}),
+                    content_type='application/json; charset=UTF-8',
+                    status=500)
+
+
+def vitals_page(records, default_fields=None):
+    '''the page of records asked for by fields=, sort=, filter=, limit= and cursor='''
+    fields = request.args.get('fields')
+    sort = request.args.get('sort')
+    try:
+        page = vitalsquery.query(records,
+                                 fields=fields.split(',') if fields else default_fields,
+                                 sort=sort.split(',') if sort else None,
+                                 filters=request.args.getlist('filter'),
+                                 limit=request.args.get('limit', default=vitalsquery.PAGE, type=int),
+                                 cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    page['status'] = 'ok'
+    return Response(json.dumps(page, separators=(',', ':')),
+                    content_type='application/json; charset=UTF-8')
+
+
+# v1/deployment/<deployment>/summary?z=3 - per job mean/p50/p95/max of every
+# vitals metric, and the instances at least z standard deviations from their job's mean
+@api_bp.route('/v1/deployment/<deployment>/summary')
+def v1_deployment_summary(deployment):
+    director = current_app.config['DIRECTOR']
+    if deployment not in director.deployments:
+        return Response(json.dumps({"status": "error", "message": "no deployment"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    z = request.args.get('z', default=vitalsummary.Z_THRESHOLD, type=float)
+    state, vitals, vitals_task = director.get_deployment_vitals_nowait(deployment,
+                                                                       retry=bool(request.args.get('retry')))
+    if state != 'done':
+        return vitals_pending(state, vitals_task)
+    summary = vitalsummary.summarize(vitals, z=z)
+    return Response(json.dumps({"status": "ok", "data": summary}),
+                    content_type='application/json; charset=UTF-8')
+
+
+# v1/deployment/<deployment>/history/<job>/<id>?resolution=0|1&metrics=mem,swap
+# - an instance's sampled vitals (1 minute buckets for 6 hours, or 15 minutes for 7 days)
+@api_bp.route('/v1/deployment/<deployment>/history/<job>/<instance_id>')
+def v1_instance_history(deployment, job, instance_id):
+    history = current_app.config.get('VITALS_HISTORY')
+    if history is None:
+        return Response(json.dumps({"status": "error", "message": "no vitals history"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    metrics = request.args.get('metrics')
+    try:
+        series = history.history(deployment, job, instance_id,
+                                 resolution=request.args.get('resolution', default=0, type=int),
+                                 metrics=metrics.split(',') if metrics else None)
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    if series is None:
+        return Response(json.dumps({"status": "error", "message": "no history for instance"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    return Response(json.dumps({"status": "ok", "data": series}, separators=(',', ':')),
+                    content_type='application/json; charset=UTF-8')
+
+
+# v1/bulk/<bulk_id> - progress of a bulk action
+@api_bp.route('/v1/bulk/<bulk_id>')
+def v1_bulk_action(bulk_id):
+    bulk = current_app.config['BULK']
+    progress = bulk.get(bulk_id)
+    if progress is None:
+        return Response(json.dumps({"status": "error", "message": "unknown bulk action"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    return Response(json.dumps({"status": "ok", "data": progress}),
+                    content_type='application/json; charset=UTF-8')
+
+
+# v1/collections
+# POST {"targets": ["cf:router", "cf:api", "cf-diego:diego_cell"]} - submit
+# "bosh logs" for every target at once; returns the collection to poll
+@api_bp.route('/v1/collections', methods=['POST'])
+def v1_collect_logs():
+    collect = current_app.config['LOG_COLLECT']
+    args = request.get_json(silent=True) or {}
+    try:
+        started = collect.start(logcollect.parse_targets(','.join(args.get('targets') or [])))
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    return Response(json.dumps({"status": "ok", "data": started}),
+                    content_type='application/json; charset=UTF-8',
+                    status=202)
+
+
+# v1/collections/<collection_id> - state of a log collection's tasks
+@api_bp.route('/v1/collections/<collection_id>')
+def v1_collection(collection_id):
+    collection = current_app.config['LOG_COLLECT'].get(collection_id)
+    if collection is None:
+        return Response(json.dumps({"status": "error", "message": "unknown collection"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    return Response(json.dumps({"status": "ok", "data": collection}),
+                    content_type='application/json; charset=UTF-8')
+
+
+# v1/collections/<collection_id>/archive - every target's logs in one tar.gz,
+# under <deployment>/<jobs>/
+@api_bp.route('/v1/collections/<collection_id>/archive')
+def v1_collection_archive(collection_id):
+    collect = current_app.config['LOG_COLLECT']
+    if collect.get(collection_id) is None:
+        return Response(json.dumps({"status": "error", "message": "unknown collection"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    try:
+        archive = collect.archive(collection_id)
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=409)
+    return Response(stream_with_context(archive),
+                    content_type='application/gzip',
+                    headers={'Content-Disposition': "attachment; filename=logs-{}.tgz".format(collection_id)})
+
+
 # v1/logs - return list of logs from previous "bosh logs" statements
 @api_bp.route('/v1/logs', methods=['GET'])
 def v1_list_task_logs():
@@ -173,13 +473,53 @@ def v1_list_task_logs():
 def v1_stream_task_log(taskid):
     director = current_app.config['DIRECTOR']
     download_url = director.get_logs_job("/tasks/{}".format(taskid))
-    r = director.session.get(director.bosh_url + download_url,
-                             verify=director.verify_tls,
-                             stream=True)
-    return Response(stream_with_context(r.iter_content(chunk_size=512 * 1024)),
+    blobs = current_app.config.get('BLOB_CACHE')
+    if blobs is not None and download_url is not None:
+        cached, body = blobs.fetch(director, download_url.rsplit('/', 1)[-1])
+        if cached is not None:
+            return send_file(cached, mimetype='application/gzip', conditional=True)
+        if body is not None:
+            return Response(stream_with_context(body),
+                            content_type='application/gzip')
+    r = director.stream(download_url)
+    return Response(stream_with_context(director.iter_stream(r)),
                     content_type='application/gzip')
 
 
+# v1/logs/<taskid>/search?q=... - matching lines from the task's log bundle,
+# one JSON object per line ({file, line, text}), then a {summary}
+@api_bp.route('/v1/logs/<taskid>/search', methods=['GET'])
+def v1_search_task_log(taskid):
+    director = current_app.config['DIRECTOR']
+    pattern, options = logsearch.options_from_args(request.args,
+                                                   **current_app.config['LOG_SEARCH_LIMITS'])
+    try:
+        search = logsearch.LogSearch(pattern, **options)
+    except ValueError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=400)
+    download_url = director.get_logs_job("/tasks/{}".format(taskid))
+    if download_url is None:
+        return Response(json.dumps({"status": "error", "message": "logs not available"}),
+                        content_type='application/json; charset=UTF-8',
+                        status=404)
+    try:
+        chunks = blobcache.resource_chunks(director, download_url.rsplit('/', 1)[-1],
+                                           current_app.config.get('BLOB_CACHE'))
+    except IOError as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}),
+                        content_type='application/json; charset=UTF-8',
+                        status=502)
+
+    def generate():
+        for name, lineno, text in search.run(chunks):
+            yield json.dumps({'file': name, 'line': lineno, 'text': text}) + '\n'
+        yield json.dumps({'summary': search.summary()}) + '\n'
+    return Response(stream_with_context(generate()),
+                    content_type='application/x-ndjson; charset=UTF-8')
+
+
 # v1/logs/<deployment>/<job>/<instance> - run "bosh -d depl logs jobs/instance"
 # note that this form gets logfiles from a specific job instance.
 # This submits a task to fetch those jobs
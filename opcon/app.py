@@ -1,9 +1,22 @@
 
 from opcon.modules import director
+from opcon.modules import federation
 from opcon.modules import auth
 from opcon.modules import config
 from opcon.modules import accesslog
 from opcon.modules import auditlog
+from opcon.modules import taskwatch
+from opcon.modules import taskevents
+from opcon.modules import inventory
+from opcon.modules import bulkaction
+from opcon.modules import taskhistory
+from opcon.modules import outputcache
+from opcon.modules import blobcache
+from opcon.modules import logcollect
+from opcon.modules import vitalshistory
+from opcon.modules import statestore
+from opcon.modules import metrics
+from opcon.modules import tracing
 from opcon.bosh.bosh_bp import bosh_bp
 from opcon.api.api_bp import api_bp
 from flask import (
@@ -16,6 +29,7 @@ from flask import (
 )
 from flask_apscheduler import APScheduler
 from flask_bootstrap import Bootstrap
+from markupsafe import Markup
 import requests
 import uuid
 import os
@@ -28,13 +42,16 @@ import re
 app = Flask(__name__)
 Bootstrap(app)
 app.config['JSON_AS_ASCII'] = True
-app.config['SECRET_KEY'] = uuid.uuid4().hex
 scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
 
 # main configuration dictionary
 config = config.config(config_file=os.getenv('CONFIG_FILE', 'opcon.ini'))
+# state shared by all workers - logins, tokens, pending tasks
+store = statestore.state_store(config.get('o_state_store'))
+app.config['STATE_STORE'] = store
+app.config['SECRET_KEY'] = store.setdefault('app', 'secret_key', uuid.uuid4().hex)
 if config.get('o_debug'):
     app.config['DEBUG'] = config.get('o_debug')
 if config.get('o_auth_type'):
@@ -52,16 +69,73 @@ user_auth = auth.user_authentication(app)
 user_auth.ua_login_manager.init_app(app)
 user_auth.ua_login_manager.login_view = 'login'
 
-director = director.Director(config.get('o_director_url'),
-                             config.get('o_bosh_user'),
-                             config.get('o_bosh_pass'),
-                             timeo=config.get('o_director_timeo'),
-                             debug=config.get('o_debug'),
-                             testing=config.get('o_testing'),
-                             verify_tls=config.get('o_verify_tls'),
-                             errands=errands_acls,
-                             readonly=config.get('o_readonly'))
+# the [bosh] director comes first; [bosh:<name>] sections add more, all
+# sharing one worker pool
+executor, background = federation.new_pools(config.get('o_director_workers'))
+director_settings = [{'name': config.get('o_director_name'),
+                      'url': config.get('o_director_url'),
+                      'user': config.get('o_bosh_user'),
+                      'pass': config.get('o_bosh_pass'),
+                      'timeo': config.get('o_director_timeo'),
+                      'verify_tls': config.get('o_verify_tls'),
+                      'readonly': config.get('o_readonly')}] + (config.get('o_directors') or [])
+# task state changes of all directors, for the live pages
+task_events = taskevents.TaskEvents()
+app.config['TASK_EVENTS'] = task_events
+app.config['STREAMS'] = taskevents.Streams(config.get('o_event_streams') or 2)
+bosh_directors = list()
+for settings in director_settings:
+    d = director.Director(settings['url'],
+                          settings['user'],
+                          settings['pass'],
+                          name=settings['name'],
+                          timeo=settings['timeo'],
+                          workers=config.get('o_director_workers'),
+                          pool_size=config.get('o_pool_size'),
+                          retries=config.get('o_http_retries'),
+                          backoff=config.get('o_http_backoff'),
+                          store=store,
+                          cache_size=config.get('o_cache_size'),
+                          cache_ttls=config.get('o_cache_ttls'),
+                          debug=config.get('o_debug'),
+                          testing=config.get('o_testing'),
+                          verify_tls=settings['verify_tls'],
+                          errands=errands_acls,
+                          readonly=settings['readonly'],
+                          executor=executor,
+                          background=background)
+    d.task_watcher = taskwatch.TaskWatcher(d, events=task_events)
+    d.task_history = taskhistory.TaskHistory(d,
+                                             min_interval=config.get('o_cache_ttls')['tasks'],
+                                             max_tasks=config.get('o_history_size'))
+    if config.get('o_inventory_interval'):
+        d.inventory = inventory.Inventory(d, interval=config.get('o_inventory_interval'))
+    bosh_directors.append(d)
+directors = federation.Federation(bosh_directors)
+director = directors.primary
+app.config['DIRECTORS'] = directors
 app.config.update({'AUTH': user_auth, 'DIRECTOR': director})
+app.config['BULK'] = bulkaction.BulkActions(director, store,
+                                            max_in_flight=config.get('o_bulk_max_in_flight'),
+                                            canaries=config.get('o_bulk_canaries'))
+app.config['VITALS_ASYNC'] = config.get('o_vitals_async')
+app.config['LOG_SEARCH_LIMITS'] = {'max_matches': config.get('o_search_max_matches'),
+                                   'max_bytes': config.get('o_search_max_bytes')}
+if config.get('o_output_cache_dir'):
+    app.config['OUTPUT_CACHE'] = outputcache.OutputCache(config.get('o_output_cache_dir'),
+                                                         max_bytes=config.get('o_output_cache_size'),
+                                                         debug=config.get('o_debug'))
+if config.get('o_blob_cache_dir'):
+    app.config['BLOB_CACHE'] = blobcache.BlobCache(config.get('o_blob_cache_dir'),
+                                                   max_bytes=config.get('o_blob_cache_size'),
+                                                   ttl=config.get('o_blob_cache_ttl'),
+                                                   debug=config.get('o_debug'))
+app.config['LOG_COLLECT'] = logcollect.LogCollections(director, store,
+                                                      blobs=app.config.get('BLOB_CACHE'))
+if config.get('o_vitals_history') and config.get('o_vitals_interval'):
+    app.config['VITALS_HISTORY'] = vitalshistory.VitalsHistory(director,
+                                                               config.get('o_vitals_history'),
+                                                               max_instances=config.get('o_vitals_instances'))
 app.config.update({
     'DEPLOYMENT_GITHASH': os.getenv('DEPLOYMENT_GITHASH', 'no_hash'),
     'DEPLOYMENT_DATE': os.getenv('DEPLOYMENT_DATE', time.asctime()),
@@ -71,6 +145,10 @@ app.config.update({
 if config.get('o_audit_enable'):
     auditlog = auditlog.AuditLog(config.get('o_audit_data'),
                                  extra_fields=config.get('o_audit_extra_fields'),
+                                 batch_size=config.get('o_audit_batch_size'),
+                                 flush_interval=config.get('o_audit_flush_interval'),
+                                 queue_size=config.get('o_audit_queue_size'),
+                                 spool_file=config.get('o_audit_spool'),
                                  debug=config.get('o_audit_debug'))
     app.config.update({'AUDIT': auditlog})
 
@@ -81,6 +159,11 @@ def format_datetime(value):
     return time.ctime(value)
 
 
+@app.template_filter('sparkline')
+def sparkline(values):
+    return Markup(vitalshistory.sparkline_svg(values))
+
+
 @app.template_filter('regex_replace')
 def regex_replace(s, find, replace):
     return re.sub(find, replace, s)
@@ -92,7 +175,8 @@ def regex_replace(s, find, replace):
 @accesslog.log_access
 def index():
     return render_template("index.html", director=director,
-                           stats=director.get_director_stats())
+                           rows=directors.stats(),
+                           inventory_age=directors.inventory_age())
 
 
 @app.route('/version', methods=['GET'])
@@ -204,26 +288,90 @@ def logout():
 
 
 app.register_blueprint(bosh_bp, url_prefix='/bosh')
+if config.get('o_metrics_enable'):
+    try:
+        metrics.init_app(app, allow=config.get('o_metrics_allow'))
+    except ValueError as e:
+        print("Trouble parsing metrics allow: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    director_cache = metrics.REGISTRY.gauge('opcon_director_cache',
+                                            'director read cache hits, misses and entries')
+
+    def collect_director_metrics():
+        for d in directors:
+            for k, v in d.cache.stats().items():
+                director_cache.set(v, {'director': d.name, 'stat': k})
+    metrics.REGISTRY.add_collector(collect_director_metrics)
+if config.get('o_trace_enable'):
+    tracer = tracing.Tracer(config.get('o_trace_file'),
+                            sample_rate=config.get('o_trace_sample'),
+                            max_bytes=config.get('o_trace_max_bytes'),
+                            backups=config.get('o_trace_backups'),
+                            debug=config.get('o_trace_debug'))
+    tracer.init_app(app)
+    app.config['TRACER'] = tracer
 print("api enabled:", config.get('o_api_enable'))
 if config.get('o_api_enable'):
     app.register_blueprint(api_bp, url_prefix='/api')
 
 
-if not director.connect() and not config.get('o_testing'):
-    print("Cannot connect to director {}; exiting".format(config.get('o_director_url')))
-    sys.exit(1)
+for d in list(directors):
+    if not d.connect() and not config.get('o_testing'):
+        if d is director:
+            print("Cannot connect to director {}; exiting".format(config.get('o_director_url')))
+            sys.exit(1)
+        print("Cannot connect to director {} ({}); leaving it out".format(d.name, d.bosh_url),
+              file=sys.stderr)
+        directors.remove(d.name)
+if not config.get('o_testing'):
+    try:
+        directors.login()
+    except requests.RequestException as e:
+        print("Cannot log in to director {}: {}; exiting".format(config.get('o_director_url'), e))
+        sys.exit(1)
+for d in directors:
+    if not config.get('o_testing'):
+        if d.inventory is not None:
+            d.inventory.refresh()
+        else:
+            d.get_deployments()
+    # the primary director keeps the plain job names
+    suffix = '' if d is director else '-' + d.name
+    print("scheduled oauth update for {} in {} seconds".format(d.name, d.oauth_token_expires() - 30))
+    scheduler.add_job(id='oauth-refresh' + suffix,
+                      func=metrics.timed_job('oauth-refresh' + suffix, d.refresh_token),
+                      trigger='interval',
+                      seconds=d.oauth_token_expires() - 30)
+    if d.inventory is None:
+        scheduler.add_job(id='deployments-refresh' + suffix,
+                          func=metrics.timed_job('deployments-refresh' + suffix, d.get_deployments),
+                          trigger='interval',
+                          seconds=120)
+    if not config.get('o_testing'):
+        if d.inventory is not None:
+            # the inventory spreads its deployments over its interval, so tick often
+            scheduler.add_job(id='inventory-refresh' + suffix,
+                              func=metrics.timed_job('inventory-refresh' + suffix, d.inventory.refresh),
+                              trigger='interval',
+                              seconds=5)
+        scheduler.add_job(id='task-watch' + suffix,
+                          func=metrics.timed_job('task-watch' + suffix, d.task_watcher.sweep),
+                          trigger='interval',
+                          seconds=d.task_watcher.min_interval)
 if not config.get('o_testing'):
-    director.login()
-    director.get_deployments()
-print("scheduled oauth update in %d seconds" % (
-    director.oauth_token_expires() - 30))
-scheduler.add_job(id='oauth-refresh',
-                  func=director.refresh_token,
-                  trigger='interval',
-                  seconds=director.oauth_token_expires() - 30)
-scheduler.add_job(id='deployments-refresh',
-                  func=director.get_deployments,
-                  trigger='interval',
-                  seconds=120)
+    if app.config.get('BLOB_CACHE') is not None:
+        scheduler.add_job(id='blob-cache-cleanup',
+                          func=metrics.timed_job('blob-cache-cleanup', app.config['BLOB_CACHE'].cleanup),
+                          trigger='interval',
+                          seconds=600)
+    scheduler.add_job(id='log-collect-refresh',
+                      func=metrics.timed_job('log-collect-refresh', app.config['LOG_COLLECT'].refresh),
+                      trigger='interval',
+                      seconds=10)
+    if app.config.get('VITALS_HISTORY') is not None:
+        scheduler.add_job(id='vitals-sample',
+                          func=metrics.timed_job('vitals-sample', app.config['VITALS_HISTORY'].sample),
+                          trigger='interval',
+                          seconds=config.get('o_vitals_interval'))
 if __name__ == '__main__':
     app.run(debug=config['o_debug'])
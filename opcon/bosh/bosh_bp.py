@@ -1,11 +1,20 @@
 import sys
 import json
+import requests
 from opcon.modules import boshforms
 from opcon.modules import accesslog
+from opcon.modules import taskhistory
+from opcon.modules import blobcache
+from opcon.modules import logsearch
+from opcon.modules import logcollect
+from opcon.modules import vitalsummary
+from opcon.modules import federation
+from opcon.modules import tasktail
+from opcon.modules import taskevents
 import flask_login
 from flask import current_app, request, jsonify
-from flask import Response, stream_with_context
-from flask import Blueprint, render_template
+from flask import Response, stream_with_context, send_file
+from flask import Blueprint, render_template, redirect, url_for
 
 
 bosh_bp = Blueprint('bosh_bp',  __name__,
@@ -13,6 +22,13 @@ bosh_bp = Blueprint('bosh_bp',  __name__,
                     static_folder='static', static_url_path='assets')
 
 
+@bosh_bp.errorhandler(requests.RequestException)
+def bosh_director_error(e):
+    # the director (or its UAA) failed mid-request, e.g. it refused a re-login
+    print('director request failed: {}'.format(e), file=sys.stderr)
+    return Response('director request failed: {}\n'.format(e), status=502, content_type='text/plain')
+
+
 @bosh_bp.route('/', methods=['GET', 'POST'])
 @flask_login.login_required
 @accesslog.log_access
@@ -40,7 +56,11 @@ def bosh_logs():
                                deployment_name=deployment,
                                deployments=director.deployments,
                                jobs=jobs,
-                               tasks=director.pending_tasks)
+                               jobs_age=director.inventory_age(deployment),
+                               tasks=director.pending_tasks,
+                               collections=current_app.config['LOG_COLLECT'].recent(),
+                               events_id=events_id(),
+                               director_name=director.name)
     return jsonify(director.pending_tasks)
 
 
@@ -48,12 +68,47 @@ def bosh_logs():
 @flask_login.login_required
 @accesslog.log_access
 def get_tasks():
-    director = current_app.config['DIRECTOR']
+    # all directors' tasks, when there are several
+    director = current_app.config.get('DIRECTORS') or current_app.config['DIRECTOR']
     limit = request.args.get('limit', default=100, type=int)
-    # return Response(director.get_job_history(limit),
-    #                 content_type='application/json')
+    filters = taskhistory.filters_from_args(request.args)
+    # snapshot tasks are noise here, unless asked for
+    filters.setdefault('exclude', '^snapshot')
+    try:
+        tasks = director.get_job_history(limit, **filters)
+    except ValueError as e:
+        return Response(str(e), status=400, content_type='text/plain')
     return render_template('bosh_history.html',
-                           tasks=director.get_job_history(limit))
+                           limit=limit,
+                           filters=filters,
+                           tasks=tasks,
+                           events_id=events_id())
+
+
+def events_id():
+    '''the id a page starts its task events from, or None without events'''
+    events = current_app.config.get('TASK_EVENTS')
+    return events.last_id() if events is not None else None
+
+
+# task state changes as Server-Sent Events, for the logs and history pages
+@bosh_bp.route('/tasks/events', methods=['GET'])
+@flask_login.login_required
+def task_events():
+    events = current_app.config.get('TASK_EVENTS')
+    if events is None:
+        return Response('no task events', status=404, content_type='text/plain')
+    streams = current_app.config['STREAMS']
+    if streams.full():
+        # the browser stops asking; the page just doesn't update in place
+        return Response(status=204)
+    director = current_app.config['DIRECTOR']
+    if director.task_watcher is not None:
+        director.task_watcher.watch_pending()
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    return Response(stream_with_context(streams.hold(events.stream(last_id))),
+                    content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @bosh_bp.route('/tasks/<taskid>', methods=['GET'])
@@ -69,33 +124,114 @@ def download_logs(taskid):
     if t is None:
         return Response('Could not find task', 404)
     filename = t.t_query.replace('/', '_').replace(' ', '_') + ".tgz"
+    if director.task_watcher is not None and not director.task_watcher.watch(t.t_url).done():
+        # the task watcher keeps this current; don't hold the worker waiting on it
+        return render_template('bosh_logerr.html', taskid=taskid)
     # director.pending_tasks.remove(t)
     download_url = director.get_logs_job("/tasks/{}".format(taskid))
     if download_url is None:
         print(f"Found task {taskid} not ready, wait")
         return render_template('bosh_logerr.html', taskid=taskid)
-    r = director.session.get(director.bosh_url + download_url,
-                             verify=director.verify_tls,
-                             stream=True)
-    return Response(stream_with_context(r.iter_content(chunk_size=512 * 1024)),
+    blobs = current_app.config.get('BLOB_CACHE')
+    if blobs is not None:
+        cached, body = blobs.fetch(director, download_url.rsplit('/', 1)[-1])
+        if cached is not None:
+            return send_file(cached, mimetype='application/gzip', as_attachment=True,
+                             download_name=filename, conditional=True)
+        if body is not None:
+            return Response(stream_with_context(body),
+                            content_type='application/gzip',
+                            headers={'Content-Disposition': "attachment; filename={}".format(filename)})
+    r = director.stream(download_url)
+    return Response(stream_with_context(director.iter_stream(r)),
                     content_type='application/gzip',
                     headers={'Content-Disposition': "attachment; filename={}".format(filename)})
 
 
+@bosh_bp.route('/tasks/<taskid>/search', methods=['GET'])
+@flask_login.login_required
+@accesslog.log_access
+def search_logs(taskid):
+    director = current_app.config['DIRECTOR']
+    pattern, options = logsearch.options_from_args(request.args,
+                                                   **current_app.config['LOG_SEARCH_LIMITS'])
+    try:
+        search = logsearch.LogSearch(pattern, **options)
+    except ValueError as e:
+        return Response(str(e), status=400, content_type='text/plain')
+    download_url = director.get_logs_job("/tasks/{}".format(taskid))
+    if download_url is None:
+        return Response('logs for task {} are not available'.format(taskid), status=404,
+                        content_type='text/plain')
+    try:
+        chunks = blobcache.resource_chunks(director, download_url.rsplit('/', 1)[-1],
+                                           current_app.config.get('BLOB_CACHE'))
+    except IOError as e:
+        return Response(str(e), status=502, content_type='text/plain')
+
+    def generate():
+        for name, lineno, text in search.run(chunks):
+            yield "{}:{}: {}\n".format(name, lineno, text)
+        summary = search.summary()
+        yield "# {} matches in {} files, {} bytes scanned{}\n".format(
+            summary['matches'], summary['files'], summary['bytes_scanned'],
+            ", stopped at {}".format(summary['truncated']) if summary['truncated'] else '')
+    return Response(stream_with_context(generate()), content_type='text/plain')
+
+
 @bosh_bp.route('/tasks/<taskid>/output', methods=['GET'])
 @flask_login.login_required
 @accesslog.log_access
 def get_task_output(taskid):
-    director = current_app.config['DIRECTOR']
+    director = federation.select(current_app.config, request.args.get('director'))
+    if director is None:
+        return Response("no such director", status=404, content_type='text/plain')
     output_type = request.args.get('type')
     if output_type == '':
         output_type = 'result'
+    if request.args.get('follow'):
+        # only what the task adds from offset on, until it finishes
+        try:
+            tail = tasktail.TaskTail(director, taskid, output_type or 'debug',
+                                     offset=request.headers.get('Last-Event-ID') or request.args.get('offset'))
+        except ValueError as e:
+            return Response(str(e), status=400, content_type='text/plain')
+        best = request.accept_mimetypes.best
+        if best == 'text/html':
+            # a page following the output through the event stream below
+            return render_template('bosh_task_tail.html',
+                                   taskid=taskid,
+                                   output_type=tail.output_type,
+                                   stream_url=request.full_path)
+        streams = current_app.config['STREAMS']
+        if best == 'text/event-stream':
+            if streams.full():
+                return Response(status=204)
+            return Response(stream_with_context(streams.hold(tail.sse())),
+                            content_type='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        if streams.full():
+            return Response('too many streams, try again later\n', status=503, content_type='text/plain',
+                            headers={'Retry-After': str(taskevents.BUSY_RETRY // 1000)})
+        return Response(stream_with_context(streams.hold(tail.text(), busy=b'')),
+                        content_type='text/plain',
+                        headers={'X-Content-Type-Options': 'nosniff', 'X-Accel-Buffering': 'no',
+                                 'X-Task-Offset': str(tail.offset)})
+    # task ids are per director; the cache holds the primary director's
+    cache = None
+    if director is current_app.config['DIRECTOR']:
+        cache = current_app.config.get('OUTPUT_CACHE')
+    if cache is not None:
+        cached = cache.lookup(taskid, output_type)
+        if cached is not None:
+            return send_file(cached, mimetype='text/plain', conditional=True)
     task_url = '/tasks/{}/output'.format(taskid)
-    r = director.session.get(director.bosh_url + task_url,
-                             params={'type': output_type},
-                             verify=director.verify_tls)
+    r = director.stream(task_url, params={'type': output_type})
     if r.ok:
-        return Response(stream_with_context(r.iter_content(chunk_size=512 * 1024)),
+        body = director.iter_stream(r)
+        if cache is not None and cache.path(taskid, output_type) and director.task_finished(taskid):
+            body = cache.tee(taskid, output_type, body)
+        return Response(stream_with_context(body),
                         content_type='text/plain')
     else:
         return Response("error fetching task {} output".format(
@@ -106,12 +242,15 @@ def get_task_output(taskid):
 @flask_login.login_required
 @accesslog.log_access
 def cancel_task(taskid):
-    director = current_app.config['DIRECTOR']
+    director = federation.select(current_app.config, request.args.get('director'))
+    if director is None:
+        return Response("no such director", status=404, content_type='text/plain')
     task_url = '/task/{}'.format(taskid)
     if director.readonly:
         return Response(status=403, content_type='application/json',
                         response=json.dumps({'error': 'administratively denied'}))
     r = director.session.delete(director.bosh_url + task_url)
+    director.invalidate()
     if r.ok:
         return Response(status=r.status_code,
                         response=r.text,
@@ -152,6 +291,19 @@ def run_deployment_errand(deployment, errand):
     return Response("{'running': '%s'}" % (running), status=rcode)
 
 
+def sort_vitals(vitals):
+    '''sort by job_name/id'''
+    return sorted(vitals, key=lambda d: d['job_name'] + "/" + d['id'])
+
+
+def vitals_sparklines(deployment):
+    '''memory use over the last hour of each instance, if there's a vitals history'''
+    history = current_app.config.get('VITALS_HISTORY')
+    if history is None:
+        return dict()
+    return history.sparklines(deployment, 'mem')
+
+
 @bosh_bp.route('/deployment/vitals', methods=['GET'])
 @flask_login.login_required
 @accesslog.log_access
@@ -162,14 +314,82 @@ def get_deployment_vitals_default():
         return render_template('index.html', director=director)
     if deployment is None:
         deployment = director.deployments[0]
-    vitals = director.get_deployment_vitals(deployment)
-    # sort by job_name/id
-    sorted_vitals = sorted(vitals, key=lambda d: d['job_name'] + "/" + d['id'])
+    if current_app.config.get('VITALS_ASYNC'):
+        # return the page skeleton now; the browser polls for the results
+        return render_template('bosh_vitals.html',
+                               deployment_name=deployment,
+                               deployments=director.deployments,
+                               readonly=director.readonly,
+                               bulk_jobs=director.get_deployment_jobs(deployment, groups=True),
+                               vitals_task=director.get_deployment_vitals_async(deployment),
+                               sparklines=vitals_sparklines(deployment),
+                               deployment_vitals=[])
+    vitals = director.iter_deployment_vitals(deployment)
     return render_template('bosh_vitals.html',
                            deployment_name=deployment,
                            deployments=director.deployments,
                            readonly=director.readonly,
-                           deployment_vitals=sorted_vitals)
+                           bulk_jobs=director.get_deployment_jobs(deployment, groups=True),
+                           sparklines=vitals_sparklines(deployment),
+                           deployment_vitals=sort_vitals(vitals))
+
+
+@bosh_bp.route('/deployment/summary', methods=['GET'])
+@flask_login.login_required
+@accesslog.log_access
+def get_deployment_vitals_summary():
+    director = current_app.config['DIRECTOR']
+    deployment = request.args.get('deployment')
+    if len(director.deployments) == 0:
+        return render_template('index.html', director=director)
+    if deployment is None:
+        deployment = director.deployments[0]
+    z = request.args.get('z', default=vitalsummary.Z_THRESHOLD, type=float)
+    best_response = request.accept_mimetypes.best_match(["application/json",
+                                                         "text/html"])
+    # collected in the background: until they are in, the page reloads
+    state, vitals, vitals_task = director.get_deployment_vitals_nowait(deployment,
+                                                                       retry=bool(request.args.get('retry')))
+    summary = vitalsummary.summarize(vitals, z=z) if state == 'done' else None
+    if best_response != 'text/html':
+        if summary is None:
+            return Response(json.dumps({'state': state, 'task': vitals_task}),
+                            status=202 if state == 'processing' else 500,
+                            content_type='application/json')
+        return jsonify(summary)
+    return render_template('bosh_vitals_summary.html',
+                           deployment_name=deployment,
+                           deployments=director.deployments,
+                           metrics=vitalsummary.METRICS,
+                           z=z,
+                           state=state,
+                           vitals_task=vitals_task,
+                           summary=summary)
+
+
+@bosh_bp.route('/deployment/vitals/<taskid>', methods=['GET'])
+@flask_login.login_required
+def get_deployment_vitals_result(taskid):
+    director = current_app.config['DIRECTOR']
+    state, vitals = director.get_deployment_vitals_result(taskid)
+    if state == 'processing':
+        return Response(json.dumps({'state': state}),
+                        status=202,
+                        content_type='application/json')
+    if state != 'done':
+        return Response(json.dumps({'state': state}),
+                        status=404 if state == 'unknown' else 500,
+                        content_type='application/json')
+    vitals = sort_vitals(vitals)
+    deployment = request.args.get('deployment')
+    rows = render_template('bosh_vitals_rows.html',
+                           readonly=director.readonly,
+                           deployment_name=deployment,
+                           sparklines=vitals_sparklines(deployment) if deployment else dict(),
+                           deployment_vitals=vitals)
+    return Response(json.dumps({'state': state, 'vitals': vitals, 'rows': rows}),
+                    status=200,
+                    content_type='application/json')
 
 
 @bosh_bp.route('/deployment/<deployment>/jobs', methods=['GET'])
@@ -211,6 +431,7 @@ def vm_control():
                                 verify=director.verify_tls)
     if director.debug:
         print("URL {} returns {}".format(action_url, a_r.text))
+    director.invalidate(deployment)
     if a_r.ok:
         return Response(status=a_r.status_code,
                         content_type='application/json',
@@ -220,3 +441,114 @@ def vm_control():
         return Response(error_msg,
                         status=a_r.status_code,
                         content_type='application/json')
+
+
+@bosh_bp.route('/deployment/<deployment>/bulk', methods=['POST'])
+@flask_login.login_required
+@accesslog.log_access
+def bulk_vm_control(deployment):
+    bulk = current_app.config['BULK']
+    args = request.get_json(silent=True)
+    if args is None:
+        args = {'instances': request.form.getlist('vmi'),
+                'action': request.form.get('action'),
+                'canaries': request.form.get('canaries', type=int),
+                'max_in_flight': request.form.get('max_in_flight', type=int),
+                'skip_drain': request.form.get('skip_drain') == 'true'}
+    try:
+        started = bulk.start(deployment, args.get('action'), args.get('instances') or [],
+                             canaries=args.get('canaries'),
+                             max_in_flight=args.get('max_in_flight'),
+                             skip_drain=args.get('skip_drain', False))
+    except PermissionError as e:
+        return Response(status=403, content_type='application/json',
+                        response=json.dumps({'error': str(e)}))
+    except ValueError as e:
+        return Response(status=400, content_type='application/json',
+                        response=json.dumps({'error': str(e)}))
+    return Response(status=202, content_type='application/json',
+                    response=json.dumps(started))
+
+
+@bosh_bp.route('/bulk/<bulk_id>', methods=['GET'])
+@flask_login.login_required
+def bulk_vm_status(bulk_id):
+    bulk = current_app.config['BULK']
+    progress = bulk.get(bulk_id)
+    if progress is None:
+        return Response(status=404, content_type='application/json',
+                        response=json.dumps({'error': 'unknown bulk action ' + bulk_id}))
+    return Response(status=200, content_type='application/json',
+                    response=json.dumps(progress))
+
+
+@bosh_bp.route('/collections', methods=['POST'])
+@flask_login.login_required
+@accesslog.log_access
+def collect_logs():
+    collect = current_app.config['LOG_COLLECT']
+    args = request.get_json(silent=True)
+    try:
+        if args is None:
+            targets = logcollect.parse_targets(request.form.get('targets'))
+        else:
+            targets = logcollect.parse_targets(','.join(args.get('targets') or []))
+        started = collect.start(targets)
+    except ValueError as e:
+        if args is None:
+            return Response(str(e), status=400, content_type='text/plain')
+        return Response(status=400, content_type='application/json',
+                        response=json.dumps({'error': str(e)}))
+    if args is None:
+        return redirect(url_for('bosh_bp.bosh_logs'))
+    return Response(status=202, content_type='application/json',
+                    response=json.dumps(started))
+
+
+@bosh_bp.route('/collections/<collection_id>', methods=['GET'])
+@flask_login.login_required
+def collection_status(collection_id):
+    collection = current_app.config['LOG_COLLECT'].get(collection_id)
+    if collection is None:
+        return Response(status=404, content_type='application/json',
+                        response=json.dumps({'error': 'unknown collection ' + collection_id}))
+    return Response(status=200, content_type='application/json',
+                    response=json.dumps(collection))
+
+
+@bosh_bp.route('/collections/<collection_id>/archive', methods=['GET'])
+@flask_login.login_required
+@accesslog.log_access
+def collection_archive(collection_id):
+    collect = current_app.config['LOG_COLLECT']
+    if collect.get(collection_id) is None:
+        return Response('Could not find collection', 404)
+    try:
+        archive = collect.archive(collection_id)
+    except ValueError as e:
+        return Response(str(e), status=409, content_type='text/plain')
+    return Response(stream_with_context(archive),
+                    content_type='application/gzip',
+                    headers={'Content-Disposition': "attachment; filename=logs-{}.tgz".format(collection_id)})
+
+
+@bosh_bp.route('/deployment/<deployment>/history/<job>/<instance_id>', methods=['GET'])
+@flask_login.login_required
+def get_instance_history(deployment, job, instance_id):
+    history = current_app.config.get('VITALS_HISTORY')
+    if history is None:
+        return Response(status=404, content_type='application/json',
+                        response=json.dumps({'error': 'no vitals history'}))
+    metrics = request.args.get('metrics')
+    try:
+        series = history.history(deployment, job, instance_id,
+                                 resolution=request.args.get('resolution', default=0, type=int),
+                                 metrics=metrics.split(',') if metrics else None)
+    except ValueError as e:
+        return Response(status=400, content_type='application/json',
+                        response=json.dumps({'error': str(e)}))
+    if series is None:
+        return Response(status=404, content_type='application/json',
+                        response=json.dumps({'error': 'no history for ' + instance_id}))
+    return Response(status=200, content_type='application/json',
+                    response=json.dumps(series, separators=(',', ':')))
@@ -1,10 +1,29 @@
 import requests
 import urllib3
+import threading
+import atexit
+import queue
 import json
+import time
+import os
 
 # audit_log - assumes a JSON structure should be sent, that uses basic auth
 # it includes a "name" identifying this application, the client_id/client_secret are
 # the basic auth parameters.
+#
+# Records are queued by send() and shipped from a background thread, many
+# to a POST (the payload is a JSON array), so requests never wait on the
+# audit endpoint.  Batches that can't be delivered after retries, or that
+# don't fit in the queue, are appended to a spool file (one JSON record per
+# line) that is replayed after the next successful POST.
+#
+# At exit, flush() stops the shipper - letting it send the batch it is
+# collecting - then sends whatever is left in the queue.
+
+# queued by flush() to stop the shipper
+STOP = object()
+# seconds flush() waits for the shipper's last batch
+EXIT_WAIT = 30
 
 
 class AuditLog(object):
@@ -18,8 +37,13 @@ class AuditLog(object):
         self.verify_tls = True
         self.debug = False
         self.test = False   # stub for testing mode?
-        self.active = True    # if audit logging is enabled, and not encountered an error
+        self.active = True    # if audit logging is enabled
         self.extra_fields = {}
+        self.batch_size = 100
+        self.flush_interval = 5
+        self.queue_size = 10000
+        self.max_retries = 3
+        self.spool_file = ''
 
         if 'verify_tls' in kwargs:
             self.verify_tls = kwargs['verify_tls']
@@ -36,10 +60,21 @@ class AuditLog(object):
                 print("Trouble parsing json section audit item extra_fields: {} - {}".format(
                     kwargs['extra_fields'], e))
                 raise ValueError
+        if 'batch_size' in kwargs and kwargs['batch_size']:
+            self.batch_size = kwargs['batch_size']
+        if 'flush_interval' in kwargs and kwargs['flush_interval'] is not None:
+            self.flush_interval = kwargs['flush_interval']
+        if 'queue_size' in kwargs and kwargs['queue_size']:
+            self.queue_size = kwargs['queue_size']
+        if 'max_retries' in kwargs and kwargs['max_retries'] is not None:
+            self.max_retries = kwargs['max_retries']
+        if 'spool_file' in kwargs and kwargs['spool_file']:
+            self.spool_file = kwargs['spool_file']
 
         if self.debug:
             print(f"audit log: debug={self.debug} test={self.test} vrfy_tls={self.verify_tls}")
             print(f"audit log: name={self.app_name} client_id={self.client_id} url={self.url}")
+            print(f"audit log: batch={self.batch_size} interval={self.flush_interval} spool={self.spool_file}")
 
         if self.test:
             return
@@ -49,27 +84,172 @@ class AuditLog(object):
             self.session.auth = (self.client_id, self.client_secret)
         self.session.headers.update({'Content-Type': 'application/json'})
         self.session.verify = self.verify_tls
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.ship_lock = threading.Lock()
+        self.shipper = threading.Thread(target=self.__ship_forever,
+                                        name='auditlog',
+                                        daemon=True)
+        self.shipper.start()
+        atexit.register(self.flush)
         start_msg = {'message': 'starting'}
         self.send(start_msg)
 
     def send(self, jobj):
-        '''send a json blob to the logging endpoint'''
+        '''queue a json blob for the logging endpoint'''
         if self.test or self.active is False:
             return
         jobj['application'] = self.app_name
         jobj['log_type'] = self.log_name
         log_dict = {**jobj, **self.extra_fields}
-        log_list = [log_dict]
-        if self.debug:
-            print("send to ", self.url, type(jobj), json.dumps(log_list))
         try:
-            r = self.session.post(self.url, json=log_list)
-        except requests.exceptions.RequestException as e:
-            print(f"audit log fail: {e}")
-            self.active = False
-            return
-        if not r.ok:
+            self.queue.put_nowait(log_dict)
+        except queue.Full:
+            self.__spool([log_dict])
+
+    def flush(self):
+        '''ship everything queued now (at exit)'''
+        if self.shipper.is_alive():
+            try:
+                self.queue.put(STOP, timeout=1)
+                self.shipper.join(EXIT_WAIT)
+            except queue.Full:
+                pass
+        batch = list()
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is STOP:
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self.__ship(batch)
+                batch = list()
+        if len(batch):
+            self.__ship(batch)
+
+    def __ship_forever(self):
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is STOP:
+                return
+            batch = [record]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is STOP:
+                    # ship what we have, then leave the rest to flush()
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                self.__ship(batch)
+            except Exception as e:
+                # the thread has to outlive any one batch
+                print(f"audit log: shipping {len(batch)} records failed: {e}")
+
+    def __ship(self, batch):
+        with self.ship_lock:
+            try:
+                delivered = self.__post(batch)
+            except Exception as e:
+                print(f"audit log post failed: {e}")
+                delivered = False
+            if not delivered:
+                self.__spool(batch)
+                return
+            try:
+                self.__replay()
+            except Exception as e:
+                print(f"audit log: replaying {self.spool_file} failed: {e}")
+
+    def __post(self, log_list):
+        '''post a batch, retrying with backoff; returns True once delivered'''
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            if self.debug:
+                print("send to ", self.url, len(log_list), "records")
+            try:
+                r = self.session.post(self.url, json=log_list)
+            except requests.exceptions.RequestException as e:
+                print(f"audit log fail: {e}")
+                continue
+            if r.ok:
+                if self.debug:
+                    print(f"audit log post {r.status_code}")
+                return True
             print("audit log post failed", r.status_code, r.content)
-            self.active = False
-        elif self.debug:
-            print(f"audit log post {r.status_code}")
+        return False
+
+    def __spool(self, records):
+        if not self.spool_file:
+            print(f"audit log: no spool file, dropping {len(records)} records")
+            return
+        # a single append per batch, so concurrent workers don't interleave records
+        try:
+            with append(self.spool_file) as f:
+                f.write(''.join([json.dumps(r, default=str) + '\n' for r in records]))
+        except OSError as e:
+            print(f"audit log: spool {self.spool_file} failed, dropping {len(records)} records: {e}")
+
+    def __replay(self):
+        '''re-send spooled records, now that the endpoint is accepting them'''
+        if not self.spool_file or not os.path.exists(self.spool_file):
+            return
+        replay_file = self.spool_file + '.replay'
+        try:
+            # only one worker gets to replay a given spool
+            os.rename(self.spool_file, replay_file)
+        except OSError:
+            return
+        with open(replay_file, 'r') as f:
+            batch = list()
+            failed = False
+            for line in f:
+                if line.strip():
+                    try:
+                        batch.append(json.loads(line))
+                    except ValueError:
+                        # a torn or garbled line; set aside rather than lost or retried forever
+                        self.__quarantine(line)
+                if len(batch) >= self.batch_size:
+                    if not self.__post(batch):
+                        failed = True
+                        break
+                    batch = list()
+            if not failed and len(batch):
+                failed = not self.__post(batch)
+            if failed:
+                # still failing - keep this batch and the rest for later
+                self.__spool(batch)
+                with append(self.spool_file) as spool:
+                    for line in f:
+                        spool.write(line)
+        if self.debug:
+            print("audit log: replayed spool", self.spool_file)
+        os.remove(replay_file)
+
+    def __quarantine(self, line):
+        bad_file = self.spool_file + '.bad'
+        print(f"audit log: unreadable spool record moved to {bad_file}")
+        try:
+            with append(bad_file) as f:
+                f.write(line if line.endswith('\n') else line + '\n')
+        except OSError as e:
+            print(f"audit log: {bad_file} failed, dropping the record: {e}")
+
+
+def append(path):
+    '''open path for appending, creating it readable by us only - it holds audit records'''
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a')
@@ -9,6 +9,7 @@ import sys
 import time
 import jwt
 from cryptography import x509
+from opcon.modules import statestore
 from cryptography.hazmat.backends import default_backend
 
 
@@ -39,7 +40,11 @@ class UserAuth(object):
             self.client_id,
             self.base_url + "/_callback")
         self.oidc_keys = self.get_oidc_keys()
-        self.ug_hash = dict()   # who has logged in
+        # who has logged in, shared by all workers
+        store = appopt.config.get('STATE_STORE')
+        if store is None:
+            store = statestore.MemoryStore()
+        self.ug_hash = store.mapping('logins')
 
     def prepare_token_request(self, code):
         token_url = self.oidc_config['token_endpoint']
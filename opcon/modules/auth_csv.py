@@ -1,4 +1,5 @@
 from werkzeug.security import generate_password_hash, check_password_hash
+from opcon.modules import statestore
 import sys
 import time
 
@@ -13,6 +14,11 @@ class UserAuth(object):
         self.uc_csvfile = appopt.config['USER_AUTH_DATA']
         self.uc_debug = appopt.config['USER_AUTH_DEBUG']
         self.uc_hash = dict()
+        # login expiry times, shared by all workers
+        store = appopt.config.get('STATE_STORE')
+        if store is None:
+            store = statestore.MemoryStore()
+        self.uc_logins = store.mapping('logins')
         self.auth_type = 'userpass'  # for app.py:login() method
         self.auth_brand = 'CSV, FTW'  # branding info
         with open(self.uc_csvfile, 'r') as f:
@@ -25,7 +31,7 @@ class UserAuth(object):
                 if user in self.uc_hash:
                     print("User ({}) already exists".format(user))
                     continue
-                self.uc_hash[user] = {"time": 0, "hash": phash}
+                self.uc_hash[user] = {"hash": phash}
                 if self.uc_debug:
                     print("adding {}/{}".format(user, phash))
         return
@@ -41,7 +47,7 @@ class UserAuth(object):
             if self.uc_debug:
                 print("hash: ", self.uc_hash[username])
             if check_password_hash(self.uc_hash[username]['hash'], password):
-                self.uc_hash[username]['time'] = time.time() + 3600
+                self.uc_logins[username] = time.time() + 3600
                 return True
         except TypeError as e:
             print("could not check hash {}".format(self.uc_hash[username]['hash']))
@@ -52,10 +58,10 @@ class UserAuth(object):
         username = username.decode('utf-8')
         if self.uc_debug:
             print("user_loader(user={})".format(username))
-        if username not in self.uc_hash:
+        if username not in self.uc_hash or username not in self.uc_logins:
             if self.uc_debug:
                 print("user_loader() returns None")
             return None
-        if self.uc_hash[username]['time'] >= time.time():
+        if self.uc_logins[username] >= time.time():
             return username
         return None
@@ -0,0 +1,225 @@
+import threading
+import time
+import os
+import re
+import sys
+from opcon.modules import outputcache
+
+# A disk cache of director blobstore resources (log bundles, errand
+# output), keyed by blobstore id.  Blobstore ids are never reused for
+# different content, so the first download fetches the resource into the
+# cache directory and every later one is served from there with
+# send_file (sendfile, Range and conditional requests).
+#
+# The fetch runs in its own thread, writing <id>.tmp; it is claimed with
+# an exclusive create, so concurrent downloads of the same id - from this
+# worker or another one sharing the directory - follow that one file as
+# it grows instead of each pulling the tarball through the director.  A
+# finished fetch is renamed to <id>, which the followers notice by inode.
+
+BLOB_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]*$')
+CHUNK = 64 * 1024
+
+
+class BlobCache(object):
+    '''BlobCache(directory, max_bytes=10GB, ttl=86400, stall=120) - cached blobstore resources'''
+    def __init__(self, directory, **kwargs):
+        self.directory = directory
+        self.max_bytes = 10 * 1024 * 1024 * 1024
+        self.ttl = 86400        # seconds since last use before an entry expires
+        self.stall = 120        # seconds without progress before a fetch is given up
+        self.poll = 0.1         # seconds between looks at a growing fetch
+        self.debug = False
+        if 'max_bytes' in kwargs and kwargs['max_bytes']:
+            self.max_bytes = kwargs['max_bytes']
+        if 'ttl' in kwargs and kwargs['ttl']:
+            self.ttl = kwargs['ttl']
+        if 'stall' in kwargs and kwargs['stall']:
+            self.stall = kwargs['stall']
+        if 'debug' in kwargs:
+            self.debug = kwargs['debug']
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def path(self, blob_id):
+        '''the cache file for a blobstore id, or None if it can't be cached'''
+        blob_id = str(blob_id)
+        if not BLOB_ID.match(blob_id):
+            return None
+        return os.path.join(self.directory, blob_id)
+
+    def lookup(self, blob_id):
+        '''return the path of the cached resource, or None'''
+        path = self.path(blob_id)
+        if path is None:
+            return None
+        try:
+            # mark it recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, director, blob_id):
+        '''fetch(director, blob id) - (path, None) if cached, else (None, chunk iterator)
+
+        The iterator follows a download into the cache, starting one if
+        nobody else is; (None, None) means the id can't be cached.'''
+        path = self.path(blob_id)
+        if path is None:
+            return None, None
+        cached = self.lookup(blob_id)
+        if cached is not None:
+            return cached, None
+        partial = path + '.tmp'
+        self.__claim(director, blob_id, path, partial)
+        return None, self.__follow(path, partial)
+
+    def __claim(self, director, blob_id, path, partial):
+        '''start fetching blob_id into partial, unless someone already is'''
+        for attempt in range(2):
+            try:
+                fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                if attempt == 0 and self.__stalled(partial):
+                    # its fetcher died; take over
+                    print("blob cache: restarting stalled fetch of {}".format(blob_id), file=sys.stderr)
+                    try:
+                        os.remove(partial)
+                    except OSError:
+                        pass
+                    continue
+                return
+            except OSError as e:
+                print("blob cache: can't write {}: {}".format(partial, e), file=sys.stderr)
+                return
+            if os.path.exists(path):
+                # finished between our lookup and the claim
+                os.close(fd)
+                os.remove(partial)
+                return
+            threading.Thread(target=self.__download,
+                             args=(director, blob_id, fd, path, partial),
+                             name='blob-{}'.format(blob_id),
+                             daemon=True).start()
+            return
+
+    def __stalled(self, partial):
+        try:
+            return time.time() - os.stat(partial).st_mtime > self.stall
+        except OSError:
+            return False
+
+    def __download(self, director, blob_id, fd, path, partial):
+        '''copy the resource into partial, then publish it as path'''
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                r = director.stream('/resources/{}'.format(blob_id))
+                if not r.ok:
+                    print("blob cache: error fetching {}: {}".format(blob_id, r.status_code), file=sys.stderr)
+                    r.close()
+                    return
+                for chunk in director.iter_stream(r, chunk_size=CHUNK):
+                    f.write(chunk)
+                    # followers read what has been written so far
+                    f.flush()
+            os.replace(partial, path)
+            complete = True
+            if self.debug:
+                print("blob cache: fetched", blob_id)
+        except Exception as e:
+            print("blob cache: error fetching {}: {}".format(blob_id, e), file=sys.stderr)
+        finally:
+            if not complete:
+                try:
+                    os.remove(partial)
+                except OSError:
+                    pass
+        self.evict()
+
+    def __follow(self, path, partial):
+        '''generate the content of a fetch in progress, as it arrives'''
+        try:
+            f = open(partial, 'rb')
+        except FileNotFoundError:
+            # it finished (or failed) before we got here
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                raise IOError("blob cache: fetch of {} failed".format(os.path.basename(path)))
+            with f:
+                yield from iter(lambda: f.read(CHUNK), b'')
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            progress = time.time()
+            while True:
+                chunk = f.read(CHUNK)
+                if chunk:
+                    progress = time.time()
+                    yield chunk
+                    continue
+                try:
+                    done = os.stat(path).st_ino == inode
+                except FileNotFoundError:
+                    done = False
+                if done:
+                    # renamed into place: what's left is the last of it
+                    yield from iter(lambda: f.read(CHUNK), b'')
+                    return
+                if not os.path.exists(partial):
+                    raise IOError("blob cache: fetch of {} failed".format(os.path.basename(path)))
+                if time.time() - progress > self.stall:
+                    raise IOError("blob cache: fetch of {} stalled".format(os.path.basename(path)))
+                time.sleep(self.poll)
+
+    def cleanup(self):
+        '''remove entries unused for ttl seconds and abandoned fetches, then enforce the quota'''
+        now = time.time()
+        removed = 0
+        with self.lock:
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                try:
+                    age = now - entry.stat().st_mtime
+                except OSError:
+                    continue
+                limit = self.stall if entry.name.endswith('.tmp') else self.ttl
+                if age <= limit:
+                    continue
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    continue
+        if self.debug and removed:
+            print("blob cache: {} expired entries removed".format(removed))
+        self.evict()
+
+    def evict(self):
+        '''remove least recently used resources until the cache fits in max_bytes'''
+        with self.lock:
+            outputcache.evict_lru(self.directory, self.max_bytes, self.debug)
+
+
+def resource_chunks(director, blob_id, blobs=None):
+    '''resource_chunks(director, blob id, BlobCache or None) - the resource's content as
+    chunks, from the cache when there is one (filling it if need be)'''
+    if blobs is not None:
+        cached, body = blobs.fetch(director, blob_id)
+        if cached is not None:
+            return read_chunks(cached)
+        if body is not None:
+            return body
+    r = director.stream('/resources/{}'.format(blob_id))
+    if not r.ok:
+        r.close()
+        raise IOError("error fetching {}: {}".format(blob_id, r.status_code))
+    return director.iter_stream(r, chunk_size=CHUNK)
+
+
+def read_chunks(path):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(CHUNK), b'')
@@ -0,0 +1,190 @@
+import concurrent.futures
+import threading
+import uuid
+import time
+import sys
+from opcon.modules import taskwatch
+
+# Bulk VM actions: one action (restart, stop, start, recreate) applied to
+# many instances of a deployment.  The first "canaries" instances are acted
+# on first; if any of their tasks fails the rest are skipped.  The others
+# follow with at most max_in_flight director tasks running at a time.
+# Progress is kept in the state store, so any worker can report it.
+
+ACTIONS = ['restart', 'stop', 'start', 'recreate']
+
+# per-instance states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+KEEP = 50     # finished bulk actions remembered in the store
+
+
+def expand_selection(selection, jobs):
+    '''expand_selection(["diego_cell/*", "api/<guid>"], deployment jobs) - list of group/instance
+
+    "group/*" selects every instance of the group, and "*" every instance
+    of the deployment.  Duplicates are dropped, order is kept.'''
+    targets = list()
+    seen = set()
+    for s in selection:
+        s = s.strip()
+        if s == '*':
+            matched = jobs
+        elif s.endswith('/*'):
+            matched = [j for j in jobs if j.startswith(s[:-1])]
+        else:
+            matched = [s]
+        for t in matched:
+            if t not in seen and t.count('/') == 1:
+                seen.add(t)
+                targets.append(t)
+    return targets
+
+
+class BulkActions(object):
+    '''BulkActions(director, store, max_in_flight=4, canaries=1) - run and track bulk VM actions'''
+    def __init__(self, director, store, **kwargs):
+        self.director = director
+        self.store = store
+        self.debug = director.debug
+        self.max_in_flight = 4
+        self.canaries = 1
+        self.task_timeout = 1800
+        if 'max_in_flight' in kwargs and kwargs['max_in_flight']:
+            self.max_in_flight = kwargs['max_in_flight']
+        if 'canaries' in kwargs and kwargs['canaries'] is not None:
+            self.canaries = kwargs['canaries']
+        if 'task_timeout' in kwargs and kwargs['task_timeout']:
+            self.task_timeout = kwargs['task_timeout']
+        self.lock = threading.Lock()
+
+    def start(self, deployment, action, selection, **kwargs):
+        '''start(deployment, action, selection) - return the new bulk action's progress
+
+        Raises ValueError for a bad request, PermissionError if the director is readonly.'''
+        if self.director.readonly:
+            raise PermissionError('administratively denied')
+        if action not in ACTIONS:
+            raise ValueError('action is required: ' + ','.join(ACTIONS))
+        if deployment not in self.director.deployments:
+            raise ValueError('no deployment ' + str(deployment))
+        targets = expand_selection(selection, self.director.get_deployment_jobs(deployment))
+        if len(targets) == 0:
+            raise ValueError('no instances selected')
+        max_in_flight = kwargs.get('max_in_flight') or self.max_in_flight
+        canaries = kwargs.get('canaries')
+        if canaries is None:
+            canaries = self.canaries
+        bulk = {'id': uuid.uuid4().hex[:12],
+                'deployment': deployment,
+                'action': action,
+                'skip_drain': bool(kwargs.get('skip_drain', False)),
+                'canaries': min(int(canaries), len(targets)),
+                'max_in_flight': max(int(max_in_flight), 1),
+                'state': RUNNING,
+                'created': time.time(),
+                'finished': None,
+                'instances': [{'instance': t, 'state': PENDING, 'task': None, 'error': None}
+                              for t in targets]}
+        self.__save(bulk)
+        self.__expire()
+        started = progress(bulk)
+        # the runner holds a background thread for as long as the action takes
+        threading.Thread(target=self.__run, args=(bulk,),
+                         name='bulk-' + bulk['id'], daemon=True).start()
+        return started
+
+    def get(self, bulk_id):
+        '''get(bulk id) - the bulk action's progress, or None'''
+        bulk = self.store.get('bulk', bulk_id)
+        if bulk is None:
+            return None
+        return progress(bulk)
+
+    def __save(self, bulk, inst=None, **fields):
+        '''update an instance of bulk with fields, and store bulk'''
+        with self.lock:
+            if inst is not None:
+                inst.update(fields)
+            self.store.set('bulk', bulk['id'], bulk)
+
+    def __expire(self):
+        '''forget all but the last KEEP finished bulk actions'''
+        finished = sorted([b for k, b in self.store.items('bulk') if b['state'] != RUNNING],
+                          key=lambda b: b['created'])
+        for b in finished[:-KEEP]:
+            self.store.delete('bulk', b['id'])
+
+    def __act(self, bulk, inst):
+        '''act on one instance and wait for its task to finish'''
+        group, instance = inst['instance'].split('/')
+        self.__save(bulk, inst, state=RUNNING)
+        ok, result = self.director.instance_action(bulk['deployment'], group, instance,
+                                                   bulk['action'], skip_drain=bulk['skip_drain'])
+        if not ok:
+            self.__save(bulk, inst, state=FAILED, error=result)
+            return False
+        self.__save(bulk, inst, task=result)
+        task = self.__wait(result)
+        if task is not None and task['state'] == 'done':
+            self.__save(bulk, inst, state=DONE)
+            return True
+        self.__save(bulk, inst, state=FAILED,
+                    error='task {}'.format(task['state'] if task is not None else 'unknown'))
+        return False
+
+    def __wait(self, task_url):
+        deadline = time.time() + self.task_timeout
+        while True:
+            remaining = deadline - time.time()
+            task = self.director.task_wait_ready(task_url, timeout=max(min(remaining, self.director.timeo), 1))
+            if task is None or task['state'] in taskwatch.TERMINAL_STATES or remaining <= 0:
+                return task
+
+    def __run_batch(self, bulk, instances, workers):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                   thread_name_prefix='bulk') as pool:
+            return all(list(pool.map(lambda inst: self.__act(bulk, inst), instances)))
+
+    def __run(self, bulk):
+        instances = bulk['instances']
+        canaries = instances[:bulk['canaries']]
+        rest = instances[bulk['canaries']:]
+        try:
+            ok = True
+            if len(canaries):
+                ok = self.__run_batch(bulk, canaries, min(len(canaries), bulk['max_in_flight']))
+            if ok and len(rest):
+                ok = self.__run_batch(bulk, rest, bulk['max_in_flight'])
+            elif not ok:
+                print("bulk {}: canary failed, skipping {} instances".format(bulk['id'], len(rest)),
+                      file=sys.stderr)
+                for inst in rest:
+                    self.__save(bulk, inst, state=SKIPPED)
+        except Exception as e:
+            print("bulk {} failed: {}".format(bulk['id'], e), file=sys.stderr)
+            ok = False
+        with self.lock:
+            bulk['state'] = DONE if ok else FAILED
+            bulk['finished'] = time.time()
+        self.__save(bulk)
+        self.director.invalidate(bulk['deployment'])
+        if self.debug:
+            print("bulk {}: {}".format(bulk['id'], progress(bulk)['counts']))
+
+
+def progress(bulk):
+    '''the bulk action, with per-state instance counts'''
+    counts = dict([(s, 0) for s in [PENDING, RUNNING, DONE, FAILED, SKIPPED]])
+    for inst in bulk['instances']:
+        counts[inst['state']] += 1
+    total = len(bulk['instances'])
+    r = dict(bulk)
+    r['total'] = total
+    r['counts'] = counts
+    r['percent'] = int(100 * (counts[DONE] + counts[FAILED] + counts[SKIPPED]) / total) if total else 100
+    return r
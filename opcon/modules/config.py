@@ -3,6 +3,7 @@ import configparser
 import os
 import json
 import sys
+from opcon.modules import errandacl
 
 
 class config(object):
@@ -16,11 +17,23 @@ class config(object):
                 g = configini['bosh']
                 self.config['o_debug'] = g.getboolean('debug', fallback=False)
                 self.config['o_director_url'] = g.get('director_url')
+                self.config['o_director_name'] = g.get('name', fallback='default')
                 self.config['o_director_timeo'] = g.getint('timeo', fallback=30)
+                self.config['o_director_workers'] = g.getint('workers', fallback=8)
+                self.config['o_pool_size'] = g.getint('pool_size', fallback=10)
+                self.config['o_http_retries'] = g.getint('retries', fallback=3)
+                self.config['o_http_backoff'] = g.getfloat('backoff', fallback=0.5)
                 self.config['o_verify_tls'] = g.getboolean('verify_tls',
                                                            fallback=True)
                 self.config['o_testing'] = g.getboolean('testing', fallback=False)
                 self.config['o_readonly'] = g.getboolean('readonly', fallback=False)
+                self.config['o_vitals_async'] = g.getboolean('vitals_async', fallback=True)
+                # each open stream holds a thread, unless the workers are cooperative (gunicorn-gevent.py)
+                self.config['o_event_streams'] = g.getint('event_streams',
+                                                          fallback=500 if os.getenv('OPCON_GEVENT') else 2)
+                self.config['o_inventory_interval'] = g.getint('inventory_interval', fallback=0)
+                self.config['o_bulk_max_in_flight'] = g.getint('bulk_max_in_flight', fallback=4)
+                self.config['o_bulk_canaries'] = g.getint('bulk_canaries', fallback=1)
                 self.config['o_bosh_user'] = g.get('user',
                                                    fallback=os.getenv('BOSH_USERNAME', ''))
                 self.config['o_bosh_pass'] = g.get('pass',
@@ -49,16 +62,96 @@ class config(object):
                 self.config['o_audit_data'] = a.get('data', fallback='')
                 self.config['o_audit_extra_fields'] = a.get('extra_fields', fallback='')
                 self.config['o_audit_debug'] = a.get('debug', fallback=False)
+                self.config['o_audit_batch_size'] = a.getint('batch_size', fallback=100)
+                self.config['o_audit_flush_interval'] = a.getfloat('flush_interval', fallback=5)
+                self.config['o_audit_queue_size'] = a.getint('queue_size', fallback=10000)
+                self.config['o_audit_spool'] = a.get('spool', fallback='')
             else:
                 self.config['o_audit_enable'] = False
+            if 'metrics' in configini:
+                m = configini['metrics']
+                self.config['o_metrics_enable'] = m.getboolean('enable', fallback=False)
+                self.config['o_metrics_allow'] = [n.strip() for n in m.get('allow', fallback='').split(',')
+                                                  if n.strip()]
+            else:
+                self.config['o_metrics_enable'] = False
+                self.config['o_metrics_allow'] = []
+            if 'tracing' in configini:
+                t = configini['tracing']
+                self.config['o_trace_enable'] = t.getboolean('enable', fallback=False)
+                self.config['o_trace_file'] = t.get('file', fallback='/tmp/opcon-trace.jsonl')
+                self.config['o_trace_sample'] = t.getfloat('sample_rate', fallback=0.1)
+                self.config['o_trace_max_bytes'] = t.getint('max_bytes', fallback=10485760)
+                self.config['o_trace_backups'] = t.getint('backups', fallback=5)
+                self.config['o_trace_debug'] = t.getboolean('debug', fallback=False)
+            else:
+                self.config['o_trace_enable'] = False
+            if 'logs' in configini:
+                lg = configini['logs']
+                self.config['o_search_max_matches'] = lg.getint('search_max_matches', fallback=1000)
+                self.config['o_search_max_bytes'] = lg.getint('search_max_mb', fallback=4096) * 1024 * 1024
+            else:
+                self.config['o_search_max_matches'] = 1000
+                self.config['o_search_max_bytes'] = 4096 * 1024 * 1024
+            if 'vitals' in configini:
+                v = configini['vitals']
+                self.config['o_vitals_history'] = v.get('history', fallback='/tmp/opcon-vitals.dat')
+                self.config['o_vitals_interval'] = v.getint('sample_interval', fallback=60)
+                self.config['o_vitals_instances'] = v.getint('max_instances', fallback=2048)
+            else:
+                # no sampling unless asked for
+                self.config['o_vitals_history'] = ''
+                self.config['o_vitals_interval'] = 60
+                self.config['o_vitals_instances'] = 2048
+            if 'state' in configini:
+                self.config['o_state_store'] = configini['state'].get('store', fallback='')
+            else:
+                self.config['o_state_store'] = ''
+            if 'cache' in configini:
+                c = configini['cache']
+                self.config['o_cache_size'] = c.getint('size', fallback=256)
+                self.config['o_history_size'] = c.getint('history', fallback=5000)
+                self.config['o_output_cache_dir'] = c.get('output_dir', fallback='')
+                self.config['o_output_cache_size'] = c.getint('output_size_mb', fallback=1024) * 1024 * 1024
+                self.config['o_blob_cache_dir'] = c.get('blob_dir', fallback='')
+                self.config['o_blob_cache_size'] = c.getint('blob_size_mb', fallback=10240) * 1024 * 1024
+                self.config['o_blob_cache_ttl'] = c.getint('blob_ttl', fallback=86400)
+                self.config['o_cache_ttls'] = {
+                    'vms': c.getint('vms', fallback=15),
+                    'errands': c.getint('errands', fallback=60),
+                    'vitals': c.getint('vitals', fallback=30),
+                    'tasks': c.getint('tasks', fallback=5)}
+            else:
+                self.config['o_cache_size'] = 256
+                self.config['o_history_size'] = 5000
+                self.config['o_output_cache_dir'] = ''
+                self.config['o_output_cache_size'] = 1024 * 1024 * 1024
+                self.config['o_blob_cache_dir'] = ''
+                self.config['o_blob_cache_size'] = 10240 * 1024 * 1024
+                self.config['o_blob_cache_ttl'] = 86400
+                self.config['o_cache_ttls'] = {'vms': 15, 'errands': 60, 'vitals': 30, 'tasks': 5}
+
+            # further directors - [bosh:<name>], anything not given comes from [bosh]
+            self.config['o_directors'] = list()
+            for section in configini:
+                if section.startswith('bosh:') and 'bosh' in configini:
+                    b = configini[section]
+                    self.config['o_directors'].append({
+                        'name': section.split(':', 1)[1],
+                        'url': b.get('director_url'),
+                        'user': b.get('user', fallback=self.config['o_bosh_user']),
+                        'pass': b.get('pass', fallback=self.config['o_bosh_pass']),
+                        'timeo': b.getint('timeo', fallback=self.config['o_director_timeo']),
+                        'verify_tls': b.getboolean('verify_tls', fallback=self.config['o_verify_tls']),
+                        'readonly': b.getboolean('readonly', fallback=self.config['o_readonly'])})
 
-            self.config['errands_acls'] = dict()
+            errands_acls = dict()
             for section in configini:
                 # get errand access lists -- a list of strings follows
                 if section.startswith('errands_'):
-                    depl = section.split('_')[1]
-                    if depl not in self.config['errands_acls']:
-                        self.config['errands_acls'][depl] = dict()
+                    depl = section.split('_', 1)[1]
+                    if depl not in errands_acls:
+                        errands_acls[depl] = dict()
                     if 'o_debug' in self.config and self.config['o_debug']:
                         print("section {}, deployment {}".format(section, depl))
                     for key in configini[section]:
@@ -71,7 +164,13 @@ class config(object):
                         if key not in ['allow']:
                             print("Errand acls 'allow' only: found ", key)
                             sys.exit(1)
-                        self.config['errands_acls'][depl][key] = value_json
+                        errands_acls[depl][key] = value_json
+            # compiled once here, rather than on every errand listing
+            try:
+                self.config['errands_acls'] = errandacl.ErrandACL(errands_acls)
+            except ValueError as e:
+                print("Trouble compiling errand acls: {}".format(e))
+                sys.exit(1)
 
         if 'o_debug' in self.config and self.config['o_debug']:
             print("Configuration")
@@ -1,23 +1,42 @@
 import requests
+import requests.adapters
 import urllib3
+import concurrent.futures
+import collections
+import threading
 import sys
 from urllib.parse import urlparse
 import time
 import hashlib
 import json
-import re
+from opcon.modules import statestore
+from opcon.modules import tracing
+from opcon.modules import errandacl
+from opcon.modules import taskhistory
+from opcon.modules import taskwatch
 
 TASK_LOGS = 1
 task_index = {
     TASK_LOGS: 'TASK_LOGS'
 }
 
+# chunk size for proxying downloads; small enough that many concurrent
+# downloads interleave fairly under cooperative (gevent) workers
+STREAM_CHUNK = 64 * 1024
+
+# markers returned by Director.fan_out() in place of a result
+FANOUT_TIMEOUT = 'timeout'
+FANOUT_ERROR = 'error'
+
+# seconds before vitals that failed to be collected are tried again
+VITALS_RETRY = 60
+
 
 class task_logs(object):
     '''object for tracking "bosh logs" requests'''
     def __init__(self, task_type, query, task_url):
         self.t_type = task_type
-        self.t_state = 0
+        self.t_state = 'queued'
         self.t_query = query
         self.t_url = task_url
         self.t_try_count = 0
@@ -28,6 +47,109 @@ class task_logs(object):
         return "%s:%s" % (task_index[self.t_type], self.t_url)
 
 
+class DirectorCache(object):
+    '''DirectorCache(size, ttls) - size-bounded LRU of director read results
+
+    ttls is a dictionary of endpoint -> seconds; endpoints without a ttl
+    (or with a ttl of 0) are not cached.  Entries are keyed by endpoint,
+    deployment and any extra arguments, so a deployment's entries can be
+    dropped when something changes it.'''
+    def __init__(self, size=256, ttls=None):
+        self.size = size
+        self.ttls = dict()
+        if ttls is not None:
+            self.ttls = ttls
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, endpoint, deployment, *args):
+        '''return cached value, or None if absent or expired'''
+        if not self.ttls.get(endpoint):
+            return None
+        key = (endpoint, deployment) + args
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, endpoint, deployment, value, *args):
+        if not self.ttls.get(endpoint) or value is None:
+            return
+        key = (endpoint, deployment) + args
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttls[endpoint], value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, deployment=None):
+        '''drop entries for deployment, and any task listings'''
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if key[0] == 'tasks' or (deployment is not None and key[1] == deployment):
+                    del self.entries[key]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class DirectorSession(requests.Session):
+    '''DirectorSession(pool_size, retries, backoff) - pooled HTTP session for the director
+
+    The Authorization header is taken from self.token on each request, so a
+    token swap is a single assignment that does not disturb requests in
+    flight or the warm connection pool.  GETs are retried with backoff on
+    connection errors and 502/503/504.  A 401 calls on_unauthorized(stale
+    token), which returns a fresh token to retry the request once with.'''
+    def __init__(self, pool_size=10, retries=3, backoff=0.5):
+        super().__init__()
+        self.token = None
+        self.on_unauthorized = None
+        retry = urllib3.util.Retry(total=retries,
+                                   backoff_factor=backoff,
+                                   status_forcelist=[502, 503, 504],
+                                   allowed_methods=frozenset(['GET', 'HEAD']),
+                                   raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        u = urlparse(url)
+        with tracing.span('http', method=method, host=u.netloc,
+                          path=tracing.path_template(u.path)) as span:
+            token = self.token
+            headers = dict(kwargs.pop('headers', None) or {})
+            if token is not None and 'auth' not in kwargs:
+                headers.setdefault('Authorization', token)
+            r = super().request(method, url, headers=headers, **kwargs)
+            if r.status_code == 401 and token is not None and 'auth' not in kwargs \
+               and self.on_unauthorized is not None:
+                fresh = self.on_unauthorized(token)
+                if fresh is not None and fresh != token:
+                    r.close()
+                    headers['Authorization'] = fresh
+                    r = super().request(method, url, headers=headers, **kwargs)
+                    span.set(reauthorized=True)
+            # don't read a streamed body just to measure it
+            size = r.headers.get('Content-Length')
+            if size is not None:
+                size = int(size)
+            elif not kwargs.get('stream'):
+                size = len(r.content)
+            span.set(status=r.status_code, bytes=size)
+        return r
+
+
 class Director(object):
     '''Director(bosh url, bosh username, bosh password) - generate an object to talk to BOSH'''
     def __init__(self, url, user, password, **kwargs):
@@ -36,6 +158,12 @@ class Director(object):
         self.verify_tls = True
         self.errands_acls = None
         self.readonly = False
+        self.timeo = 30
+        self.workers = 8
+        self.pool_size = 10
+        self.retries = 3
+        self.backoff = 0.5
+        self.store = statestore.MemoryStore()
         if 'testing' in kwargs:
             self.testing = kwargs['testing']
         if 'timeo' in kwargs:
@@ -50,11 +178,58 @@ class Director(object):
             self.readonly = kwargs['readonly']
         if 'errands' in kwargs:
             self.errands_acls = kwargs['errands']
+            if isinstance(self.errands_acls, dict):
+                self.errands_acls = errandacl.ErrandACL(self.errands_acls)
+        if 'workers' in kwargs and kwargs['workers']:
+            self.workers = kwargs['workers']
+        if 'pool_size' in kwargs and kwargs['pool_size']:
+            self.pool_size = kwargs['pool_size']
+        if 'retries' in kwargs and kwargs['retries'] is not None:
+            self.retries = kwargs['retries']
+        if 'backoff' in kwargs and kwargs['backoff'] is not None:
+            self.backoff = kwargs['backoff']
+        if 'store' in kwargs and kwargs['store'] is not None:
+            self.store = kwargs['store']
+        if 'cache_ttls' in kwargs and kwargs['cache_ttls']:
+            self.cache = DirectorCache(size=kwargs.get('cache_size') or 256,
+                                       ttls=kwargs['cache_ttls'])
+        else:
+            self.cache = DirectorCache(ttls=None)
+        # bounded pool for concurrent calls to the director (see fan_out());
+        # federated directors pass in one pool, so their total stays bounded
+        if 'executor' in kwargs and kwargs['executor'] is not None:
+            self.executor = kwargs['executor']
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='director')
+        # separate pool for long waits on tasks, so they can't starve fan_out()
+        if 'background' in kwargs and kwargs['background'] is not None:
+            self.background = kwargs['background']
+        else:
+            self.background = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='director-bg')
+        self.vitals_pending = dict()
+        self.vitals_collecting = dict()     # deployment -> task id, see get_deployment_vitals_nowait()
+        self.vitals_failed = dict()         # deployment -> (time, task id) of the last failure
+        self.vitals_lock = threading.Lock()
+        # shared poller for outstanding tasks (see taskwatch.TaskWatcher)
+        self.task_watcher = None
+        self.inventory = None
+        self.task_history = None
         self.bosh_url = url
+        self.name = url
+        if 'name' in kwargs and kwargs['name']:
+            self.name = kwargs['name']
         self.bosh_user = user
         self.bosh_pass = password
         self.uaa_url = ''
-        self.pending_tasks = list()
+        # pending tasks are left as they are in the store: another worker,
+        # or this one before a restart, may have submitted them
+        self.session = None
+        # serializes token refreshes (scheduler and 401 handling)
+        self.token_lock = threading.RLock()
 
     def connect(self):
         # get BOSH session initialization info
@@ -77,7 +252,38 @@ class Director(object):
         # set up internal cached data structures
         return True
 
+    @property
+    def pending_tasks(self):
+        '''tasks submitted from the console, kept in the state store so all workers see them'''
+        tasks = list()
+        for url, d in self.store.items(self.pending_ns()):
+            t = task_logs(d['t_type'], d['t_query'], d['t_url'])
+            t.__dict__.update(d)
+            tasks.append(t)
+        return sorted(tasks, key=lambda t: t.t_time)
+
+    @pending_tasks.setter
+    def pending_tasks(self, tasks):
+        self.store.clear(self.pending_ns())
+        for t in tasks:
+            self.save_pending_task(t)
+
+    def save_pending_task(self, task):
+        self.store.set(self.pending_ns(), task.t_url, task.__dict__)
+
+    def pending_ns(self):
+        # task URLs are only unique on one director
+        return 'pending_tasks:' + self.name
+
     def login(self):
+        shared = self.__shared_oauth()
+        if shared is not None:
+            # another worker has already logged in
+            with self.token_lock:
+                if not isinstance(self.session, DirectorSession):
+                    self.session = self.new_session()
+                self.__set_token(shared, share=False)
+            return
         self.init_auth(self.uaa_url, self.bosh_user, self.bosh_pass)
 
     def oauth_token_expires(self):
@@ -89,70 +295,167 @@ class Director(object):
     def __p_hash(self, key):
         return hashlib.md5(key.encode('ascii')).hexdigest()
 
-    def refresh_token(self):
-        '''refresh_token: update authorization tokens'''
-        if self.debug:
-            print("refreshing token hash({})".format(self.__p_hash(self.oauth['access_token'])))
-        r = self.session.post(
-            self.uaa_url + '/oauth/token',
-            data={'refresh_token': self.oauth['refresh_token'],
-                  'grant_type': 'refresh_token',
-                  'client_id': 'bosh_cli'},
-            auth=('bosh_cli', ''),
-            verify=self.verify_tls
-            )
-        if not r.ok:
-            print(f"director oauth refresh failed request({r.status_code}) {r.content}")
-            self.init_auth(self.uaa_url, self.bosh_user, self.bosh_pass)
-            return
-        j = r.json()
+    def new_session(self):
+        '''return a DirectorSession sized for our worker pool'''
+        session = DirectorSession(pool_size=max(self.pool_size, self.workers),
+                                  retries=self.retries,
+                                  backoff=self.backoff)
+        session.on_unauthorized = self.__reauthorize
+        return session
+
+    def __set_token(self, j, share=True):
         self.oauth = j.copy()
-        if self.debug:
-            print("new token hash({})".format(self.__p_hash(self.oauth['access_token'])))
-        self.session.headers.update(
-            {'Authorization': j['token_type'] + ' ' + j['access_token']})
+        # a single assignment; requests in flight keep the token they started with
+        self.session.token = j['token_type'] + ' ' + j['access_token']
+        if share:
+            self.store.set('oauth', self.bosh_url,
+                           {'oauth': j, 'expires': time.time() + int(j['expires_in'])})
+
+    def __shared_oauth(self):
+        '''return a token saved by another worker, if it has some life left'''
+        if not self.store.shared:
+            return None
+        saved = self.store.get('oauth', self.bosh_url)
+        if saved is None or saved['expires'] < time.time() + 30:
+            return None
+        return saved['oauth']
+
+    def __adopt_shared_token(self, stale_token):
+        '''use another worker's newer token instead of refreshing our own'''
+        shared = self.__shared_oauth()
+        if shared is None:
+            return False
+        if shared['token_type'] + ' ' + shared['access_token'] == stale_token:
+            return False
+        self.__set_token(shared, share=False)
+        return True
+
+    def __reauthorize(self, stale_token):
+        '''refresh the token after a 401 - only once for all requests that saw stale_token'''
+        with self.token_lock:
+            if self.session.token == stale_token and not self.__adopt_shared_token(stale_token):
+                if self.debug:
+                    print("director returned 401, refreshing token")
+                self.refresh_token()
+            return self.session.token
+
+    def refresh_token(self):
+        '''refresh_token: update authorization tokens
+
+        Falls back to a full login, which raises requests.HTTPError if it is refused.'''
+        with self.token_lock:
+            saved = self.store.get('oauth', self.bosh_url) if self.store.shared else None
+            if saved is not None and saved['expires'] > time.time() + int(self.oauth['expires_in']) / 2 \
+               and self.__adopt_shared_token(self.session.token):
+                # refreshed recently by another worker
+                return
+            if self.debug:
+                print("refreshing token hash({})".format(self.__p_hash(self.oauth['access_token'])))
+            r = self.session.post(
+                self.uaa_url + '/oauth/token',
+                data={'refresh_token': self.oauth['refresh_token'],
+                      'grant_type': 'refresh_token',
+                      'client_id': 'bosh_cli'},
+                auth=('bosh_cli', ''),
+                verify=self.verify_tls
+                )
+            if not r.ok:
+                print(f"director oauth refresh failed request({r.status_code}) {r.content}")
+                self.init_auth(self.uaa_url, self.bosh_user, self.bosh_pass)
+                return
+            self.__set_token(r.json())
+            if self.debug:
+                print("new token hash({})".format(self.__p_hash(self.oauth['access_token'])))
 
     def init_auth(self, auth_url, username, password):
-        '''init_auth(oauth url, username, password): initial login to BOSH director'''
-        self.session = requests.Session()
-        r = self.session.post(
-            auth_url + '/oauth/token',
-            data={'username': username,
-                  'password': password,
-                  'grant_type': 'password',
-                  'client_id': 'bosh_cli'},
-            auth=('bosh_cli', ''),
-            verify=self.verify_tls)
-        if not r.ok:
-            print(f"director login: oauth request({r.status_code}) {r.content}")
-            sys.exit(1)
-        j = r.json()
-        self.oauth = j.copy()
-        # update auth headers in persisted session
-        self.session.headers.update({'Authorization': j['token_type'] + ' ' + j['access_token']})
+        '''init_auth(oauth url, username, password): initial login to BOSH director
+
+        Raises requests.HTTPError if the login is refused.'''
+        with self.token_lock:
+            if not isinstance(self.session, DirectorSession):
+                # keep an existing session (and its connection pool) on re-login
+                self.session = self.new_session()
+            r = self.session.post(
+                auth_url + '/oauth/token',
+                data={'username': username,
+                      'password': password,
+                      'grant_type': 'password',
+                      'client_id': 'bosh_cli'},
+                auth=('bosh_cli', ''),
+                verify=self.verify_tls)
+            if not r.ok:
+                print(f"director login: oauth request({r.status_code}) {r.content}")
+                raise requests.HTTPError("director login failed ({})".format(r.status_code), response=r)
+            # update auth token in persisted session
+            self.__set_token(r.json())
+
+    def fan_out(self, func, items, timeout=None, executor=None):
+        '''fan_out(function, items, timeout, executor) - call function(item) concurrently for each item
+
+        The calls run on executor (default the request pool).  Returns a
+        dictionary of item -> result.  Items that raise are marked
+        FANOUT_ERROR, and items that do not complete within timeout seconds
+        (default timeo) are marked FANOUT_TIMEOUT, so one slow call does not
+        hold up the others.'''
+        if timeout is None:
+            timeout = self.timeo
+        if executor is None:
+            executor = self.executor
+        futures = dict()
+        for item in items:
+            # each call runs in a copy of our context, so it is traced under this request
+            futures[executor.submit(tracing.traced_call(func), item)] = item
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        results = dict()
+        for f in done:
+            try:
+                results[futures[f]] = f.result()
+            except Exception as e:
+                print("fan_out {} failed: {}".format(futures[f], e), file=sys.stderr)
+                results[futures[f]] = FANOUT_ERROR
+        for f in not_done:
+            f.cancel()
+            if self.debug:
+                print("fan_out {} timed out after {}s".format(futures[f], timeout))
+            results[futures[f]] = FANOUT_TIMEOUT
+        return results
 
     def get_director_stats(self):
         '''get key statistics about the system'''
         stats = dict()
+        missing = list()
         for d in self.deployments:
-            stats[d] = len(self.get_deployment_jobs(d))
+            inv = self.__inventory(d)
+            if inv is not None:
+                stats[d] = len(inv)
+            else:
+                missing.append(d)
+        jobs = self.fan_out(self.get_deployment_jobs, missing)
+        for d in jobs:
+            if jobs[d] in (FANOUT_TIMEOUT, FANOUT_ERROR):
+                stats[d] = jobs[d]
+            else:
+                stats[d] = len(jobs[d])
         return stats
 
     def get_deployments(self):
-        '''get a list of deployments on this director'''
+        '''get a list of deployments on this director; returns None on error'''
         if self.testing:
             return ['cf', 'zookeeper']
         d_r = self.session.get(self.bosh_url + "/deployments",
                                verify=self.verify_tls)
         if d_r.ok:
-            self.deployments = list()
+            # built aside and swapped in, so readers never see a partial list
+            deployments = list()
             for d in d_r.json():
-                self.deployments.append(d['name'])
+                deployments.append(d['name'])
+            self.deployments = deployments
             if self.debug:
                 print("deployments", self.deployments)
-        else:
-            print("error getting deployments: ", d_r.content)
-            self.deployments = list()
+            return deployments
+        print("error getting deployments: ", d_r.content)
+        self.deployments = list()
+        return None
 
     def add_job_wildcards(self, jobs):
         '''Enrich the list of deployment jobs with wildcards'''
@@ -180,23 +483,111 @@ class Director(object):
             r_jobs.extend(job_groups[g])
         return r_jobs
 
+    def stream(self, path, params=None, headers=None):
+        '''stream(director path, params, headers) - start a streamed GET of a (large) director resource
+
+        The read timeout applies between chunks, so a stalled director
+        releases the worker instead of holding it forever.'''
+        return self.session.get(self.bosh_url + path,
+                                params=params,
+                                headers=headers,
+                                verify=self.verify_tls,
+                                stream=True,
+                                timeout=(10, self.timeo))
+
+    def iter_stream(self, r, chunk_size=STREAM_CHUNK):
+        '''iter_stream(response) - generate the response body, and always release
+        the connection, even when the client goes away mid-download'''
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            r.close()
+
+    def task_state(self, task_url):
+        '''task_state(task url) - the task record, from the task watcher when it has
+        seen the task finish, otherwise from the director; None on error'''
+        task = None
+        if self.task_watcher is not None:
+            task = self.task_watcher.state(task_url)
+        if task is None or task['state'] not in taskwatch.TERMINAL_STATES:
+            t_r = self.session.get(self.bosh_url + task_url, verify=self.verify_tls)
+            if not t_r.ok:
+                return None
+            task = t_r.json()
+        return task
+
+    def task_finished(self, taskid):
+        '''task_finished(task id) - has the task reached a state it won't leave?'''
+        task = self.task_state('/tasks/{}'.format(taskid))
+        return task is not None and task['state'] in taskwatch.TERMINAL_STATES
+
+    def invalidate(self, deployment=None):
+        '''invalidate(deployment) - forget cached data after deployment is changed'''
+        if self.debug:
+            print("invalidating cache for {}".format(deployment))
+        self.cache.invalidate(deployment)
+        if self.inventory is not None and deployment is not None:
+            self.inventory.expire(deployment)
+        if self.task_history is not None:
+            self.task_history.expire()
+
+    def __inventory(self, deployment):
+        '''the inventory's record of deployment, or None'''
+        if self.inventory is None:
+            return None
+        return self.inventory.snapshot.get(deployment)
+
+    def inventory_age(self, deployment=None):
+        '''seconds since deployment's instances were listed by the inventory, or None'''
+        if self.inventory is None:
+            return None
+        return self.inventory.snapshot.age(deployment)
+
     def get_deployment_jobs(self, deployment, groups=False):
         '''return a list of jobs associated with this deployment'''
-        j_r = self.session.get(self.bosh_url + "/deployments/" + deployment + "/vms",
-                               params={
-                                   'exclude_configs': True,
-                                   'exclude_releases': True,
-                                   'exclude_stemcells': True},
-                               verify=self.verify_tls)
-        if j_r.ok:
-            r = list()
+        inv = self.__inventory(deployment)
+        cached = inv.jobs() if inv is not None else self.cache.get('vms', deployment)
+        if cached is None:
+            j_r = self.session.get(self.bosh_url + "/deployments/" + deployment + "/vms",
+                                   params={
+                                       'exclude_configs': True,
+                                       'exclude_releases': True,
+                                       'exclude_stemcells': True},
+                                   verify=self.verify_tls)
+            if not j_r.ok:
+                return list()
+            cached = list()
             for j in sorted(j_r.json(), key=lambda k: k['job']):
-                r.append("{}/{}".format(j['job'], j['id']))
-            if groups:
-                r = self.add_job_wildcards(r)
-            return r
-        else:
-            return list()
+                cached.append("{}/{}".format(j['job'], j['id']))
+            self.cache.put('vms', deployment, cached)
+        r = list(cached)
+        if groups:
+            r = self.add_job_wildcards(r)
+        return r
+
+    def instance_action(self, deployment, group, instance, action, skip_drain=False):
+        '''instance_action(deployment, group, instance, action) - start restart/stop/start/recreate
+
+        Returns (True, task url) or (False, error message).'''
+        if self.readonly:
+            return False, 'administratively denied'
+        action_url = '{}/deployments/{}/instance_groups/{}/{}/actions/{}'.format(
+            self.bosh_url, deployment, group, instance, action)
+        a_r = self.session.post(action_url,
+                                params={'skip_drain': skip_drain},
+                                allow_redirects=False,
+                                verify=self.verify_tls)
+        if self.debug:
+            print("URL {} returns {} {}".format(action_url, a_r.status_code, a_r.text))
+        if a_r.status_code == 302:
+            return True, urlparse(a_r.headers['Location']).path
+        if not a_r.ok:
+            return False, a_r.text
+        try:
+            return True, '/tasks/{}'.format(a_r.json()['id'])
+        except (ValueError, KeyError):
+            return False, 'no task in response: {}'.format(a_r.text)
 
     def get_deployment_jobs_filtered(self, deployment, filter):
         '''return a list of jobs from the deployment, filtered according to filter prefix'''
@@ -209,6 +600,10 @@ class Director(object):
 
     def submit_logs_job(self, deployment, jobs):
         '''Submit a job to BOSH to fetch logs'''
+        return self.submit_logs_task(deployment, jobs) is not None
+
+    def submit_logs_task(self, deployment, jobs):
+        '''submit_logs_task(deployment, jobs) - submit a logs task; returns its url, or None'''
         logs_url = "%s/deployments/%s/jobs/%s/logs" % (
             self.bosh_url, deployment, jobs)
         if self.debug:
@@ -219,31 +614,38 @@ class Director(object):
                                      verify=self.verify_tls)
         if not logs_resp.status_code == 302:
             print("error calling bosh:", logs_resp.content)
-            return False    # we need the location
+            return None     # we need the location
         logs_task = urlparse(logs_resp.headers['Location']).path
         if self.debug:
             print("logs task:", logs_task)
         # add to director's job queue -- director.TASK_LOGS type
-        self.pending_tasks.append(task_logs(TASK_LOGS,
-                                            "%s %s" % (deployment, jobs),
-                                            logs_task))
+        self.save_pending_task(task_logs(TASK_LOGS,
+                                         "%s %s" % (deployment, jobs),
+                                         logs_task))
         if self.debug:
             print("pending tasks:", self.pending_tasks)
-        return True
+        if self.task_watcher is not None:
+            self.task_watcher.watch(logs_task)
+        return logs_task
 
     def get_logs_job(self, link):
         '''get download URL for a bosh logs command'''
-        logs_t_r = self.task_wait_ready(link)
-        if logs_t_r.json()['state'] != 'done':
+        logs_t = self.task_wait_ready(link)
+        if logs_t['state'] != 'done':
             return None
         # get blobstore ID from 'result' field
-        download_url = "/resources/{}".format(logs_t_r.json()['result'])
+        download_url = "/resources/{}".format(logs_t['result'])
         if self.debug:
             print("downloading logs from blobstore", download_url)
         return download_url
 
-    def get_job_history(self, limit):
-        '''get task histories'''
+    def get_job_history(self, limit, **filters):
+        '''get task histories; with a task_history index, filters are passed to its query()'''
+        if self.task_history is not None:
+            return self.task_history.query(limit=limit, **filters)
+        cached = self.cache.get('tasks', None, limit)
+        if cached is not None:
+            return taskhistory.filter_tasks(cached, **filters)
         params = {'verbose': '1'}
         if limit:
             params['limit'] = limit
@@ -251,60 +653,43 @@ class Director(object):
                                     params=params,
                                     verify=self.verify_tls)
         if task_h_r.ok:
-            return task_h_r.json()
+            tasks = task_h_r.json()
+            self.cache.put('tasks', None, tasks, limit)
+            return taskhistory.filter_tasks(tasks, **filters)
         else:
             return {}
 
     def __filter_errands(self, deployment, errand_list):
         '''filter_errands(deployment_name, list of errands) - return allowed errands'''
-        def deployment_errands_acl(deployment):
-            for key in self.errands_acls.keys():
-                if deployment.startswith(key):
-                    return self.errands_acls[key]
-            if '*' in self.errands_acls.keys():
-                # "wildcard" default if no explict prefix match
-                return self.errands_acls['*']
-            return None
-        # find allow list in self
         if self.errands_acls is None:
             # allow all if no allow-lists are specified
             return errand_list
-        # for this deployment, look at our allow-lists, and return the relevant one
-        errands_allowed = deployment_errands_acl(deployment)
-        if errands_allowed is None:
-            # allow all if no allow-lists specified for this deployment
-            return errand_list
-        valid_errands = list()
-        if 'allow' not in errands_allowed:
-            # if no "allow" section exists, nothing is allowed
-            return valid_errands
-        for k in errand_list:
-            for allowed_errand_re in errands_allowed['allow']:
-                if re.match(allowed_errand_re, k):
-                    valid_errands.append(k)
-        return valid_errands
+        return self.errands_acls.filter(deployment, errand_list)
 
     def get_deployment_errands(self, deployment):
         '''get bosh errands for this deployment'''
         if deployment not in self.deployments:
             return None
-        errands_url = '%s/deployments/%s/errands' % (
-            self.bosh_url, deployment)
-        if self.debug:
-            print("fetching deployment errands from", errands_url)
-        errands_resp = self.session.get(errands_url,
-                                        verify=self.verify_tls)
-        if not errands_resp.ok:
-            print("Error {} fetching {} errands: {}".format(
-                errands_resp.status_code,
-                deployment,
-                errands_resp.text))
-            return None
-        errand_dict = errands_resp.json()
-        errand_ary = list()
-        # convert dictionary of names into simple list
-        for e in errand_dict:
-            errand_ary.append(e['name'])
+        errand_ary = self.cache.get('errands', deployment)
+        if errand_ary is None:
+            errands_url = '%s/deployments/%s/errands' % (
+                self.bosh_url, deployment)
+            if self.debug:
+                print("fetching deployment errands from", errands_url)
+            errands_resp = self.session.get(errands_url,
+                                            verify=self.verify_tls)
+            if not errands_resp.ok:
+                print("Error {} fetching {} errands: {}".format(
+                    errands_resp.status_code,
+                    deployment,
+                    errands_resp.text))
+                return None
+            errand_dict = errands_resp.json()
+            errand_ary = list()
+            # convert dictionary of names into simple list
+            for e in errand_dict:
+                errand_ary.append(e['name'])
+            self.cache.put('errands', deployment, errand_ary)
         if self.debug:
             print("Got errands: {}".format(errand_ary))
         errand_ary = self.__filter_errands(deployment, errand_ary)
@@ -335,6 +720,7 @@ class Director(object):
             print("error calling errand {} for {}: {}".format(
                 errand_name, deployment, errand_resp.text))
             return False, ''
+        self.invalidate(deployment)
         # we should have the URL to follow for this
         errand_results_url = urlparse(errand_resp.headers['Location']).path
         if self.debug:
@@ -365,54 +751,175 @@ class Director(object):
             print("vitals task:", vitals_task_url)
         return vitals_task_url
 
-    def get_deployment_vitals_task_output(self, task_url):
-        # this is unnecessarily tricky -
+    def iter_deployment_vitals_task_output(self, task_url):
+        '''generate the instance records from a vitals task, as they arrive'''
         # the output from the task is a series of json-as-text strings (one
-        # object per line),  so read that, convert it into dictionary, and
-        # append that to a list we can then take that list-of-dicts and return
-        # it as a reasonable answer.
-        # All this instead of a response.json() call - because it's not json...
+        # object per line) rather than a json document, so stream it and
+        # decode one line at a time instead of holding the whole thing.
         if self.debug:
             print("vitals output", self.bosh_url + task_url + '/output')
         task_r = self.session.get(self.bosh_url + task_url + '/output',
                                   params={'type': 'result'},
-                                  verify=self.verify_tls)
-        my_data = task_r.content.decode('ascii')  # convert \n to newline
-        ary_vms = list()
-        for i in my_data.splitlines():
-            ary_vms.append(json.loads(i))
-            if self.debug:
-                print("received data dumped to /tmp/response.json")
+                                  verify=self.verify_tls,
+                                  stream=True)
+        received = list()
+        try:
+            for line in task_r.iter_lines():
+                if not line:
+                    continue
+                vm = json.loads(line)
+                if self.debug:
+                    received.append(vm)
+                yield vm
+        finally:
+            task_r.close()
+        if self.debug:
+            print("received data dumped to /tmp/response.json")
             with open('/tmp/response.json', 'w') as f:
-                f.write(json.dumps(ary_vms))
-        return ary_vms
+                f.write(json.dumps(received))
+
+    def get_deployment_vitals_task_output(self, task_url):
+        '''return the list of instance records from a vitals task'''
+        return list(self.iter_deployment_vitals_task_output(task_url))
 
-    def task_wait_ready(self, task_url):
+    def task_wait_ready(self, task_url, timeout=None):
+        '''wait up to timeout (default timeo) seconds for a task to finish; returns the task'''
+        if timeout is None:
+            timeout = self.timeo
+        deadline = time.time() + timeout
+        if self.task_watcher is not None:
+            # woken by the shared poller rather than polling on our own
+            with tracing.span('task_wait', task=task_url, timeout=timeout) as span:
+                task = self.task_watcher.wait(task_url, timeout)
+                span.set(state=task['state'] if task is not None else None)
+            if task is not None:
+                return task
         tries = 0
-        sleep_time = 2;
-        max_tries = ( self.timeo / sleep_time) - 1   # ensure we return under the gunicorn TIMEOUT value
+        sleep_time = 2
         task_r = self.session.get(self.bosh_url + task_url,
                                   verify=self.verify_tls)
         task_state = task_r.json()['state']
         if self.debug:
-            print(f"waiting on task for {sleep_time} as many as {self.timeo} times")
-        while task_state != 'done' and tries < max_tries:
+            print(f"waiting on task every {sleep_time}s for up to {max(0, deadline - time.time()):.0f}s")
+        # only the time left, if the watcher already waited; and a sleep
+        # short of the deadline, to return under the gunicorn TIMEOUT value
+        while task_state != 'done' and time.time() + 2 * sleep_time <= deadline:
             # should "flash" a message here
             tries += 1
             if self.debug:
                 print(f"task state: sleep({sleep_time})x{tries} until job ready")
-            time.sleep(sleep_time)
-            task_r = self.session.get(self.bosh_url + task_url,
-                                      verify=self.verify_tls)
-            task_state = task_r.json()['state']
-        return task_r
+            with tracing.span('task_wait', task=task_url, attempt=tries, sleep=sleep_time) as span:
+                time.sleep(sleep_time)
+                task_r = self.session.get(self.bosh_url + task_url,
+                                          verify=self.verify_tls)
+                task_state = task_r.json()['state']
+                span.set(state=task_state)
+        return task_r.json()
 
-    def get_deployment_vitals(self, deployment):
-        '''get bosh vms --vitals'''
+    def iter_deployment_vitals(self, deployment):
+        '''get bosh vms --vitals, generating instance records as they are parsed'''
         vitals_task_url = self.get_deployment_vitals_submit_task(deployment)
-        task_w_r = self.task_wait_ready(vitals_task_url)
+        if vitals_task_url is None:
+            return iter([])
+        task_w = self.task_wait_ready(vitals_task_url)
         if self.debug:
-            print("vitals state: job is \"{}\"".format(task_w_r.json()['state']))
-        # get output from task -- this is tricky
-        ary_vms = self.get_deployment_vitals_task_output(vitals_task_url)
-        return ary_vms
+            print("vitals state: job is \"{}\"".format(task_w['state']))
+        return self.iter_deployment_vitals_task_output(vitals_task_url)
+
+    def get_deployment_vitals(self, deployment):
+        '''get bosh vms --vitals, and keep them for get_deployment_vitals_nowait()'''
+        vitals = list(self.iter_deployment_vitals(deployment))
+        if vitals:
+            self.cache.put('vitals', deployment, vitals)
+        return vitals
+
+    def get_deployment_vitals_async(self, deployment):
+        '''submit the vitals task and collect its output in the background
+
+        Returns the task id to pass to get_deployment_vitals_result(), or
+        None if the task could not be submitted.'''
+        vitals_task_url = self.get_deployment_vitals_submit_task(deployment)
+        if vitals_task_url is None:
+            return None
+        task_id = vitals_task_url.split('/')[-1]
+        # forget results nobody came back for
+        for t in list(self.vitals_pending.keys()):
+            if self.vitals_pending[t][0] < time.time() - 10 * self.timeo:
+                self.vitals_pending.pop(t, None)
+        self.vitals_pending[task_id] = (time.time(),
+                                        self.background.submit(self.__vitals_collect,
+                                                               deployment,
+                                                               vitals_task_url))
+        return task_id
+
+    def __vitals_collect(self, deployment, vitals_task_url):
+        task_w = self.task_wait_ready(vitals_task_url)
+        if task_w['state'] != 'done':
+            raise RuntimeError("vitals task {} is {}".format(vitals_task_url,
+                                                             task_w['state']))
+        vitals = self.get_deployment_vitals_task_output(vitals_task_url)
+        if vitals:
+            self.cache.put('vitals', deployment, vitals)
+        return vitals
+
+    def get_deployment_vitals_nowait(self, deployment, retry=False):
+        '''get_deployment_vitals_nowait(deployment, retry) - return (state, vitals, task id)
+
+        Vitals up to the vitals ttl old are "done"; otherwise a vitals task
+        is started in the background (or the one already running for the
+        deployment is reused) and the state is "processing", with its id
+        for get_deployment_vitals_result().  Once a task has failed (or
+        could not be submitted) the state is "error" for VITALS_RETRY
+        seconds, unless retry is asked for.  Requests never wait on the
+        director's vitals task.'''
+        vitals = self.cache.get('vitals', deployment)
+        if vitals is not None:
+            return 'done', vitals, None
+        with self.vitals_lock:
+            task_id = self.vitals_collecting.get(deployment)
+            pending = self.vitals_pending.get(task_id)
+            if pending is not None and pending[1].done():
+                self.vitals_collecting.pop(deployment, None)
+                state, vitals = self.get_deployment_vitals_result(task_id)
+                if state == 'done':
+                    return state, vitals, None
+                self.vitals_failed[deployment] = (time.time(), task_id)
+                pending = None
+            if pending is None:
+                failed = self.vitals_failed.get(deployment)
+                if failed is not None and not retry and time.time() - failed[0] < VITALS_RETRY:
+                    return 'error', None, failed[1]
+                task_id = self.get_deployment_vitals_async(deployment)
+                if task_id is None:
+                    self.vitals_failed[deployment] = (time.time(), None)
+                    return 'error', None, None
+                self.vitals_failed.pop(deployment, None)
+                self.vitals_collecting[deployment] = task_id
+        return 'processing', None, task_id
+
+    def get_deployment_vitals_result(self, task_id):
+        '''get_deployment_vitals_result(task id) - return (state, vitals)
+
+        state is "processing" until the output is collected, then "done"
+        (with the list of vitals) or "error"; unknown tasks are "unknown".'''
+        pending = self.vitals_pending.get(task_id)
+        if pending is None:
+            # submitted by another worker (or already collected); ask the director
+            task_r = self.session.get(self.bosh_url + '/tasks/' + task_id,
+                                      verify=self.verify_tls)
+            if not task_r.ok:
+                return 'unknown', None
+            task = task_r.json()
+            if task['state'] in ['queued', 'processing']:
+                return 'processing', None
+            if task['state'] != 'done':
+                return 'error', None
+            return 'done', self.get_deployment_vitals_task_output('/tasks/' + task_id)
+        if not pending[1].done():
+            return 'processing', None
+        self.vitals_pending.pop(task_id, None)
+        try:
+            return 'done', pending[1].result()
+        except Exception as e:
+            print("vitals task {} failed: {}".format(task_id, e), file=sys.stderr)
+            return 'error', None
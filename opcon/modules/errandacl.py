@@ -0,0 +1,97 @@
+import threading
+import re
+
+# Errand ACLs, from the [errands_<deployment-prefix>] sections of the
+# configuration.  A deployment uses the ACL with the longest prefix of its
+# name ("*" if nothing matches); if there is no ACL for it, all errands
+# are allowed.  An ACL's "allow" list of regular expressions (matched at
+# the start of the errand name) is compiled into a single alternation, so
+# an errand list is checked with one match per errand.
+
+WILDCARD = '*'
+
+
+class DeploymentACL(object):
+    '''DeploymentACL(prefix, acl dict) - the compiled allow list of one section'''
+    def __init__(self, prefix, acl):
+        self.prefix = prefix
+        self.patterns = None    # None - no "allow" list, nothing is allowed
+        self.regex = None
+        self.regexes = list()
+        if 'allow' not in acl:
+            return
+        self.patterns = list(acl['allow'])
+        try:
+            self.regexes = [re.compile(p) for p in self.patterns]
+        except re.error as e:
+            raise ValueError("errands_{}: bad allow pattern: {}".format(prefix, e))
+        if len(self.patterns) == 0:
+            return
+        try:
+            self.regex = re.compile('|'.join(['(?:{})'.format(p) for p in self.patterns]))
+        except re.error:
+            # e.g. repeated group names - check the patterns one at a time
+            self.regex = None
+
+    def allowed(self, errand):
+        if self.patterns is None:
+            return False
+        if self.regex is not None:
+            return self.regex.match(errand) is not None
+        for r in self.regexes:
+            if r.match(errand):
+                return True
+        return False
+
+
+class ErrandACL(object):
+    '''ErrandACL(acls) - compiled errand ACLs; acls is {prefix: {"allow": [regexps]}}'''
+    def __init__(self, acls=None):
+        self.acls = dict()
+        for prefix, acl in (acls or {}).items():
+            self.acls[prefix] = DeploymentACL(prefix, acl)
+        self.wildcard = self.acls.pop(WILDCARD, None)
+        # prefix lengths, longest first: a lookup is one dict probe per length
+        self.lengths = sorted(set([len(p) for p in self.acls]), reverse=True)
+        self.lock = threading.Lock()
+        self.lookups = dict()   # deployment -> DeploymentACL (or None)
+
+    def __repr__(self):
+        acls = dict([(p, a.patterns) for p, a in self.acls.items()])
+        if self.wildcard is not None:
+            acls[WILDCARD] = self.wildcard.patterns
+        return 'ErrandACL({})'.format(acls)
+
+    def lookup(self, deployment):
+        '''return the DeploymentACL for deployment, or None if unrestricted'''
+        with self.lock:
+            if deployment in self.lookups:
+                return self.lookups[deployment]
+        acl = self.wildcard
+        for n in self.lengths:
+            if n <= len(deployment) and deployment[:n] in self.acls:
+                acl = self.acls[deployment[:n]]
+                break
+        with self.lock:
+            if len(self.lookups) >= 1024:
+                self.lookups.clear()
+            self.lookups[deployment] = acl
+        return acl
+
+    def allowed(self, deployment, errand):
+        '''allowed(deployment, errand) - may errand be run on deployment?'''
+        acl = self.lookup(deployment)
+        return acl is None or acl.allowed(errand)
+
+    def filter(self, deployment, errands):
+        '''filter(deployment, errand names) - the allowed errands, in order, without duplicates'''
+        acl = self.lookup(deployment)
+        seen = set()
+        result = list()
+        for e in errands:
+            if e in seen:
+                continue
+            seen.add(e)
+            if acl is None or acl.allowed(e):
+                result.append(e)
+        return result
@@ -0,0 +1,195 @@
+import concurrent.futures
+import collections
+import sys
+import requests
+from opcon.modules import director as bosh_director
+from opcon.modules import taskhistory
+from opcon.modules import tracing
+
+# Several BOSH directors behind one console.  Each director keeps its own
+# session, token and caches; the federation runs a call on all of them at
+# once and merges the results, tagging each row with the director's name.
+#
+# The directors share one worker pool (see new_pools()), so a busy
+# foundation can't push the total number of upstream requests past it;
+# the federation's own threads only wait on the directors, one per
+# director, and never run in that pool (a call made from inside it could
+# otherwise wait on itself).
+
+
+def new_pools(workers):
+    '''new_pools(workers) - (executor, background) pools for Director() to share'''
+    return (concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                  thread_name_prefix='director'),
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                  thread_name_prefix='director-bg'))
+
+
+class Federation(object):
+    '''Federation([director, ...]) - query several directors as one
+
+    The first director is the primary one, used for everything that acts
+    on a single director (logs, errands, bulk actions, ...).'''
+    def __init__(self, directors, **kwargs):
+        self.directors = collections.OrderedDict()
+        for d in directors:
+            if d.name in self.directors:
+                raise ValueError("duplicate director name {}".format(d.name))
+            self.directors[d.name] = d
+        if len(self.directors) == 0:
+            raise ValueError("no directors")
+        self.primary = directors[0]
+        self.debug = self.primary.debug
+        self.timeout = self.primary.timeo
+        if 'timeout' in kwargs and kwargs['timeout']:
+            self.timeout = kwargs['timeout']
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.directors),
+            thread_name_prefix='federation')
+
+    def __iter__(self):
+        return iter(self.directors.values())
+
+    def __len__(self):
+        return len(self.directors)
+
+    def names(self):
+        return list(self.directors.keys())
+
+    def get(self, name=None):
+        '''get(name) - the named director, the primary one if name is empty, or None'''
+        if not name:
+            return self.primary
+        return self.directors.get(name)
+
+    def remove(self, name):
+        '''remove(name) - leave a (secondary) director out of the federation'''
+        if self.directors.get(name) is self.primary:
+            raise ValueError("cannot remove the primary director")
+        self.directors.pop(name, None)
+
+    def login(self):
+        '''login() - log in to every director, leaving out a secondary one that fails
+
+        Raises if the primary director can't log in.'''
+        for d in list(self):
+            try:
+                d.login()
+            except requests.RequestException as e:
+                if d is self.primary:
+                    raise
+                print("Cannot log in to director {} ({}): {}; leaving it out".format(d.name, d.bosh_url, e),
+                      file=sys.stderr)
+                self.remove(d.name)
+
+    def each(self, func, timeout=None):
+        '''each(func, timeout) - call func(director) on all directors concurrently
+
+        Returns an ordered dictionary of name -> result; like
+        Director.fan_out(), a call that raises is marked FANOUT_ERROR and
+        one that takes longer than timeout is marked FANOUT_TIMEOUT.'''
+        if timeout is None:
+            timeout = self.timeout
+        futures = collections.OrderedDict()
+        for name, d in self.directors.items():
+            futures[name] = self.executor.submit(tracing.traced_call(func), d)
+        concurrent.futures.wait(futures.values(), timeout=timeout)
+        results = collections.OrderedDict()
+        for name, f in futures.items():
+            if not f.done():
+                f.cancel()
+                if self.debug:
+                    print("director {} timed out after {}s".format(name, timeout))
+                results[name] = bosh_director.FANOUT_TIMEOUT
+                continue
+            try:
+                results[name] = f.result()
+            except Exception as e:
+                print("director {} failed: {}".format(name, e), file=sys.stderr)
+                results[name] = bosh_director.FANOUT_ERROR
+        return results
+
+    def stats(self):
+        '''[{"director", "url", "deployment", "vms"}, ...] - instance counts of every deployment'''
+        rows = list()
+        for name, stats in self.each(lambda d: d.get_director_stats()).items():
+            url = self.directors[name].bosh_url
+            if not isinstance(stats, dict):
+                rows.append({'director': name, 'url': url, 'deployment': None, 'vms': stats})
+                continue
+            for deployment in sorted(stats):
+                rows.append({'director': name, 'url': url, 'deployment': deployment,
+                             'vms': stats[deployment]})
+        return rows
+
+    def inventory_age(self):
+        '''age in seconds of the oldest inventory, or None if none is kept'''
+        ages = [d.inventory_age() for d in self]
+        ages = [a for a in ages if a is not None]
+        return max(ages) if ages else None
+
+    def get_job_history(self, limit, **filters):
+        '''get_job_history(limit, filter=value, ...) - task histories of all directors,
+        newest first, each task with a "director" field; raises ValueError on bad filters'''
+        # bad patterns are reported here, rather than as a failed director
+        taskhistory.filter_tasks([], **filters)
+        merged = list()
+        errors = dict()
+        for name, tasks in self.each(lambda d: d.get_job_history(limit, **filters)).items():
+            if not isinstance(tasks, list):
+                errors[name] = tasks
+                continue
+            for t in tasks:
+                t = dict(t)
+                t['director'] = name
+                merged.append(t)
+        if errors:
+            print("task history incomplete: {}".format(errors), file=sys.stderr)
+        merged.sort(key=lambda t: t.get('timestamp') or 0, reverse=True)
+        if limit:
+            merged = merged[:limit]
+        return merged
+
+    def deployments(self):
+        '''[(director name, deployment), ...]'''
+        return [(d.name, name) for d in self for name in sorted(d.deployments)]
+
+    def get_deployment_vitals(self, deployment, retry=False):
+        '''get_deployment_vitals(deployment, retry) - return (records, pending)
+
+        records are the vitals of the named deployment on every director that
+        has them at hand, each with "director" and "deployment" fields;
+        pending is {director name: vitals task id} for the directors still
+        collecting theirs (see Director.get_deployment_vitals_nowait()).'''
+        def vitals(d):
+            if deployment not in d.deployments:
+                return 'done', [], None
+            return d.get_deployment_vitals_nowait(deployment, retry=retry)
+        records = list()
+        pending = dict()
+        for name, result in self.each(vitals).items():
+            if not isinstance(result, tuple):
+                print("vitals of {} on {}: {}".format(deployment, name, result), file=sys.stderr)
+                continue
+            state, result, task_id = result
+            if state == 'processing':
+                pending[name] = task_id
+                continue
+            if state != 'done':
+                print("vitals of {} on {}: {}".format(deployment, name, state), file=sys.stderr)
+                continue
+            for r in result:
+                r = dict(r)
+                r['director'] = name
+                r['deployment'] = deployment
+                records.append(r)
+        return records, pending
+
+
+def select(config, name=None):
+    '''select(app.config, name) - the named director, the primary one if name
+    is empty, or None if there is no such director'''
+    directors = config.get('DIRECTORS')
+    if directors is None:
+        return None if name else config['DIRECTOR']
+    return directors.get(name)
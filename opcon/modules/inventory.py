@@ -0,0 +1,163 @@
+import collections
+import threading
+import zlib
+import time
+import sys
+
+# An in-memory inventory of deployments -> instance groups -> instances,
+# refreshed in the background so pages can list jobs without calling the
+# director.  Readers take inventory.snapshot, which is never modified: a
+# refresh builds a new Snapshot (sharing the unchanged deployments with the
+# old one) and swaps it in with a single assignment.
+
+Instance = collections.namedtuple('Instance', ['job', 'id', 'index', 'ips', 'state', 'az'])
+
+
+class Deployment(object):
+    '''Deployment(name, instances, refreshed) - one deployment's instances, by group'''
+    __slots__ = ('name', 'groups', 'refreshed')
+
+    def __init__(self, name, instances, refreshed):
+        groups = dict()
+        for i in sorted(instances, key=lambda i: (i.job, i.index if i.index is not None else -1, i.id)):
+            groups.setdefault(i.job, list()).append(i)
+        self.name = name
+        self.groups = dict([(g, tuple(v)) for g, v in groups.items()])
+        self.refreshed = refreshed
+
+    def instances(self):
+        for g in sorted(self.groups):
+            for i in self.groups[g]:
+                yield i
+
+    def jobs(self):
+        '''the "job/id" names of this deployment's instances, sorted'''
+        return ["{}/{}".format(i.job, i.id) for i in self.instances()]
+
+    def __len__(self):
+        return sum([len(v) for v in self.groups.values()])
+
+
+class Snapshot(object):
+    '''Snapshot(deployments, taken) - the inventory at one point in time'''
+    def __init__(self, deployments=None, taken=None):
+        self.deployments = dict(deployments or {})
+        self.taken = taken
+
+    def get(self, deployment):
+        return self.deployments.get(deployment)
+
+    def age(self, deployment=None):
+        '''seconds since the snapshot (or one deployment in it) was refreshed, or None'''
+        if deployment is None:
+            when = self.taken
+        else:
+            d = self.deployments.get(deployment)
+            when = d.refreshed if d is not None else None
+        if when is None:
+            return None
+        return time.time() - when
+
+
+def instance_from_vm(vm):
+    '''build an Instance from a /deployments/<name>/vms record'''
+    if 'process_state' in vm:
+        state = vm['process_state']
+    else:
+        state = 'active' if vm.get('active', True) else 'inactive'
+    return Instance(job=vm['job'],
+                    id=vm['id'],
+                    index=vm.get('index'),
+                    ips=tuple(vm.get('ips') or ()),
+                    state=state,
+                    az=vm.get('az'))
+
+
+class Inventory(object):
+    '''Inventory(director, interval=60) - background-refreshed deployment inventory
+
+    refresh() is run on every scheduler tick.  The deployment list is
+    re-read every interval seconds; each deployment's instances are
+    re-read every interval seconds too, but deployments are spread across
+    the interval (by a hash of their name) so they are not all fetched on
+    the same tick.'''
+    def __init__(self, director, **kwargs):
+        self.director = director
+        self.debug = director.debug
+        self.interval = 60
+        if 'interval' in kwargs and kwargs['interval']:
+            self.interval = kwargs['interval']
+        self.snapshot = Snapshot()
+        self.next_listing = 0
+        self.due = dict()       # deployment -> time its instances are next refreshed
+        self.expired = set()    # deployments to refresh on the next tick
+        self.lock = threading.Lock()    # serializes refreshes, readers never wait
+
+    def __offset(self, deployment):
+        return zlib.crc32(deployment.encode()) % max(int(self.interval), 1)
+
+    def __fetch(self, deployment):
+        d = self.director
+        r = d.session.get(d.bosh_url + "/deployments/" + deployment + "/vms",
+                          params={
+                              'exclude_configs': True,
+                              'exclude_releases': True,
+                              'exclude_stemcells': True},
+                          verify=d.verify_tls)
+        if not r.ok:
+            print("inventory: error getting {} vms: {}".format(deployment, r.status_code), file=sys.stderr)
+            return None
+        return Deployment(deployment, [instance_from_vm(vm) for vm in r.json()], time.time())
+
+    def __swap(self, updates, names=None):
+        '''install a new snapshot: the old one, with updates, limited to names'''
+        old = self.snapshot
+        deployments = dict(old.deployments)
+        deployments.update(updates)
+        if names is not None:
+            deployments = dict([(n, deployments[n]) for n in names if n in deployments])
+        self.snapshot = Snapshot(deployments, time.time())
+
+    def refresh(self):
+        '''refresh the deployment list and any deployments that are due'''
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            now = time.time()
+            names = None
+            if now >= self.next_listing:
+                names = self.director.get_deployments()
+            if names is not None:
+                self.next_listing = now + self.interval
+                for n in names:
+                    if n not in self.due:
+                        # first sighting: fetch now if we have nothing, then settle into its slot
+                        self.due[n] = now if self.snapshot.get(n) is None else now + self.__offset(n)
+                for n in list(self.due.keys()):
+                    if n not in names:
+                        del self.due[n]
+            while len(self.expired):
+                n = self.expired.pop()
+                if n in self.due:
+                    self.due[n] = now
+            due = [n for n, t in self.due.items() if t <= now]
+            updated = dict()
+            if len(due):
+                fetched = self.director.fan_out(self.__fetch, due)
+                for n, d in fetched.items():
+                    if isinstance(d, Deployment):
+                        updated[n] = d
+                        # next refresh in this deployment's slot of the following interval
+                        self.due[n] = now + self.interval - (now - self.__offset(n)) % self.interval
+                    else:
+                        self.due[n] = now + min(self.interval, 15)
+            if names is not None or len(updated):
+                self.__swap(updated, names)
+            if self.debug and len(due):
+                print("inventory: refreshed {} of {} deployments".format(len(updated), len(self.due)))
+        finally:
+            self.lock.release()
+
+    def expire(self, deployment):
+        '''refresh deployment's instances on the next tick (after acting on it)'''
+        self.expired.add(deployment)
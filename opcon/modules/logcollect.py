@@ -0,0 +1,244 @@
+import threading
+import tarfile
+import zlib
+import uuid
+import copy
+import time
+import sys
+import re
+from opcon.modules import taskwatch
+from opcon.modules import blobcache
+from opcon.modules import logsearch
+
+# Log collections: `bosh logs` for several deployment/jobs targets at
+# once (say router, api and diego_cell across two deployments).  All the
+# logs tasks are submitted together and tracked as one collection; once
+# they have finished, their bundles are merged into a single tar.gz, each
+# under a deployment/jobs/ prefix.  The merge re-frames the members of
+# each bundle as it streams in from the director (or the blob cache), so
+# nothing is staged on disk or held in memory.
+#
+# Running collections are brought up to date by refresh(), from the
+# scheduler, and when one is looked at on its own; the list of recent
+# collections shows them as stored.
+
+# collection states
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+KEEP = 50       # collections remembered in the store
+LOOKUPS = 5     # failed task lookups before a target is given up on
+BLOCK = tarfile.BLOCKSIZE
+
+
+def parse_targets(selection):
+    '''parse_targets("cf:router, cf:api\\ncf-diego:diego_cell/0") - list of (deployment, jobs)
+
+    Entries are separated by commas or new lines; duplicates are dropped.'''
+    targets = list()
+    for s in re.split(r'[,\n]', selection or ''):
+        s = s.strip()
+        if not s:
+            continue
+        if ':' not in s:
+            raise ValueError('expected deployment:jobs, got ' + s)
+        deployment, jobs = [p.strip() for p in s.split(':', 1)]
+        if not deployment or not jobs:
+            raise ValueError('expected deployment:jobs, got ' + s)
+        if (deployment, jobs) not in targets:
+            targets.append((deployment, jobs))
+    return targets
+
+
+def target_prefix(target):
+    '''the directory a target's logs are put under in the merged archive'''
+    return '{}/{}/'.format(target['deployment'], target['jobs'].strip('/'))
+
+
+class LogCollections(object):
+    '''LogCollections(director, store, blobs=None) - collect logs from several targets into one archive'''
+    def __init__(self, director, store, **kwargs):
+        self.director = director
+        self.store = store
+        self.debug = director.debug
+        self.blobs = None
+        if 'blobs' in kwargs:
+            self.blobs = kwargs['blobs']
+        self.lock = threading.Lock()
+
+    def start(self, targets):
+        '''start([(deployment, jobs), ...]) - submit a logs task for every target;
+        returns the new collection.  Raises ValueError for a bad request.'''
+        if len(targets) == 0:
+            raise ValueError('no targets selected')
+        for deployment, jobs in targets:
+            if deployment not in self.director.deployments:
+                raise ValueError('no deployment ' + str(deployment))
+        submitted = self.director.fan_out(lambda t: self.director.submit_logs_task(t[0], t[1]),
+                                          targets)
+        collection = {'id': uuid.uuid4().hex[:12],
+                      'created': time.time(),
+                      'state': RUNNING,
+                      'targets': list()}
+        for t in targets:
+            task = submitted.get(t)
+            # a task url, or None or a fan_out() error/timeout marker
+            if task is None or not task.startswith('/'):
+                collection['targets'].append({'deployment': t[0], 'jobs': t[1], 'task': None,
+                                              'state': 'error', 'blob': None,
+                                              'error': 'logs task not submitted'})
+            else:
+                collection['targets'].append({'deployment': t[0], 'jobs': t[1], 'task': task,
+                                              'state': 'queued', 'blob': None, 'error': None})
+        self.__update(collection)
+        self.__expire()
+        return collection
+
+    def get(self, collection_id):
+        '''get(collection id) - the collection with its tasks' current states, or None'''
+        collection = self.store.get('log_collections', collection_id)
+        if collection is None:
+            return None
+        if collection['state'] == RUNNING:
+            self.__update(collection)
+        return collection
+
+    def recent(self, limit=10):
+        '''the newest limit collections, newest first, as last stored'''
+        collections = sorted([c for k, c in self.store.items('log_collections')],
+                             key=lambda c: c['created'], reverse=True)
+        return collections[:limit]
+
+    def refresh(self):
+        '''bring running collections up to date; called from the scheduler'''
+        for k, c in self.store.items('log_collections'):
+            if c['state'] == RUNNING:
+                self.__update(c, executor=self.director.background)
+
+    def __update(self, collection, executor=None):
+        '''look at unfinished tasks, and store the collection'''
+        targets = [t for t in collection['targets']
+                   if t['task'] is not None and t['state'] not in taskwatch.TERMINAL_STATES]
+        tasks = self.director.fan_out(self.director.task_state, [t['task'] for t in targets],
+                                      executor=executor)
+        for t in targets:
+            task = tasks.get(t['task'])
+            if not isinstance(task, dict):
+                # None, or a fan_out() error/timeout marker
+                t['lookups'] = t.get('lookups', 0) + 1
+                if t['lookups'] >= LOOKUPS:
+                    t['state'] = 'error'
+                    t['error'] = 'logs task {} could not be looked up'.format(t['task'])
+                continue
+            t['lookups'] = 0
+            t['state'] = task['state']
+            if task['state'] == 'done':
+                t['blob'] = task.get('result')
+            elif task['state'] in taskwatch.TERMINAL_STATES:
+                t['error'] = 'logs task {}: {}'.format(task['state'], task.get('result'))
+        states = [t['state'] for t in collection['targets']]
+        if all([s in taskwatch.TERMINAL_STATES for s in states]):
+            collection['state'] = DONE if 'done' in states else FAILED
+        with self.lock:
+            self.store.set('log_collections', collection['id'], collection)
+
+    def __expire(self):
+        '''forget all but the last KEEP collections'''
+        collections = sorted([c for k, c in self.store.items('log_collections')],
+                             key=lambda c: c['created'])
+        for c in collections[:-KEEP]:
+            self.store.delete('log_collections', c['id'])
+
+    def archive(self, collection_id):
+        '''archive(collection id) - generate the merged tar.gz of a finished collection
+
+        Raises ValueError if there's no such collection or it is still running.'''
+        collection = self.get(collection_id)
+        if collection is None:
+            raise ValueError('no collection ' + str(collection_id))
+        if collection['state'] == RUNNING:
+            raise ValueError('collection {} is still running'.format(collection_id))
+        return merge_archives(self.__sources(collection))
+
+    def __sources(self, collection):
+        for t in collection['targets']:
+            if t['blob'] is None:
+                yield target_prefix(t), None, t['error'] or 'no logs'
+                continue
+            try:
+                chunks = blobcache.resource_chunks(self.director, t['blob'], self.blobs)
+            except IOError as e:
+                print("log collection: {}".format(e), file=sys.stderr)
+                yield target_prefix(t), None, str(e)
+                continue
+            yield target_prefix(t), chunks, None
+
+
+def merge_archives(sources):
+    '''merge_archives(iterable of (prefix, chunk iterator or None, error)) - generate a
+    tar.gz of every source tarball's members under its prefix
+
+    A source that can't be read (or has no chunks) is represented by an
+    ERROR.txt under its prefix holding the error.'''
+    gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for prefix, chunks, error in sources:
+        if chunks is not None:
+            reader = logsearch.ChunkReader(chunks)
+            try:
+                with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                    for member in tar:
+                        for block in copy_member(tar, member, prefix):
+                            out = gz.compress(block)
+                            if out:
+                                yield out
+                continue
+            except (tarfile.TarError, OSError, EOFError, zlib.error) as e:
+                # what was copied stays; note where it stopped
+                print("log collection: {}: {}".format(prefix, e), file=sys.stderr)
+                error = 'unreadable logs bundle: {}'.format(e)
+            finally:
+                reader.close()
+        for block in error_member(prefix, error):
+            yield gz.compress(block)
+    yield gz.compress(b'\0' * (2 * BLOCK)) + gz.flush()
+
+
+def copy_member(tar, member, prefix):
+    '''the tar blocks of member, renamed under prefix'''
+    info = copy.copy(member)
+    name = member.name[2:] if member.name.startswith('./') else member.name
+    info.name = prefix + name
+    if member.islnk():
+        info.linkname = prefix + member.linkname
+    yield info.tobuf(tarfile.PAX_FORMAT)
+    if not member.isfile():
+        return
+    f = tar.extractfile(member)
+    padded = -(-member.size // BLOCK) * BLOCK
+    written = 0
+    try:
+        while written < member.size:
+            data = f.read(blobcache.CHUNK)
+            if not data:
+                raise EOFError('unexpected end of data')
+            written += len(data)
+            yield data
+    except (tarfile.TarError, OSError, EOFError, zlib.error):
+        # keep the archive well-formed: fill out the member before giving up
+        while written < padded:
+            n = min(padded - written, blobcache.CHUNK)
+            written += n
+            yield b'\0' * n
+        raise
+    if padded > written:
+        yield b'\0' * (padded - written)
+
+
+def error_member(prefix, error):
+    data = (error + '\n').encode()
+    info = tarfile.TarInfo(prefix + 'ERROR.txt')
+    info.size = len(data)
+    info.mtime = int(time.time())
+    yield info.tobuf(tarfile.PAX_FORMAT)
+    yield data + b'\0' * ((BLOCK - len(data) % BLOCK) % BLOCK)
@@ -0,0 +1,163 @@
+import fnmatch
+import tarfile
+import gzip
+import zlib
+import io
+import re
+
+# Search inside a `bosh logs` bundle without downloading or extracting
+# it.  The bundle is a gzip'd tar whose members are usually themselves
+# gzip'd tars (one per instance) holding plain and gzip'd (rotated) log
+# files; all of it is read front to back with tarfile's stream mode, so
+# memory use doesn't depend on the size of the bundle.
+
+MAX_MATCHES = 1000
+MAX_BYTES = 4 * 1024 * 1024 * 1024     # uncompressed bytes scanned
+MAX_LINE = 64 * 1024                    # longer lines are matched in pieces
+TAR_SUFFIXES = ('.tgz', '.tar.gz', '.tar')
+
+
+class ChunkReader(io.RawIOBase):
+    '''a read-only file over an iterator of byte chunks'''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            # release the director connection if we stop early
+            self.chunks.close()
+        super().close()
+
+
+class StopSearch(Exception):
+    pass
+
+
+def compile_pattern(pattern, fixed=False, ignore_case=False):
+    '''a function matching bytes lines against a regex or fixed string;
+    raises ValueError on an empty or bad pattern'''
+    if not pattern:
+        raise ValueError("no search pattern")
+    if fixed and not ignore_case:
+        needle = pattern.encode()
+        return lambda line: needle in line
+    if fixed:
+        pattern = re.escape(pattern)
+    try:
+        regex = re.compile(pattern.encode(), re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise ValueError("bad search pattern: {}".format(e))
+    return regex.search
+
+
+class LogSearch(object):
+    '''LogSearch(pattern, fixed=False, ignore_case=False, files=None,
+                 max_matches=1000, max_bytes=4GB) - search a log bundle'''
+    def __init__(self, pattern, **kwargs):
+        self.files = None
+        self.max_matches = MAX_MATCHES
+        self.max_bytes = MAX_BYTES
+        fixed = 'fixed' in kwargs and kwargs['fixed']
+        ignore_case = 'ignore_case' in kwargs and kwargs['ignore_case']
+        if 'files' in kwargs and kwargs['files']:
+            self.files = kwargs['files']
+        if 'max_matches' in kwargs and kwargs['max_matches']:
+            self.max_matches = kwargs['max_matches']
+        if 'max_bytes' in kwargs and kwargs['max_bytes']:
+            self.max_bytes = kwargs['max_bytes']
+        self.match = compile_pattern(pattern, fixed, ignore_case)
+        self.matches = 0
+        self.scanned = 0
+        self.members = 0
+        self.truncated = None
+
+    def run(self, chunks):
+        '''run(chunk iterator) - generate (file, line number, text) for each matching line'''
+        reader = ChunkReader(chunks)
+        try:
+            yield from self.__tar(reader, '')
+        except (tarfile.TarError, OSError, EOFError, zlib.error) as e:
+            self.truncated = 'unreadable bundle: {}'.format(e)
+        except StopSearch:
+            pass
+        finally:
+            reader.close()
+
+    def summary(self):
+        return {'matches': self.matches,
+                'files': self.members,
+                'bytes_scanned': self.scanned,
+                'truncated': self.truncated}
+
+    def __tar(self, fileobj, prefix):
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name
+                if name.startswith('./'):
+                    name = name[2:]
+                name = prefix + name
+                f = tar.extractfile(member)
+                if name.endswith(TAR_SUFFIXES):
+                    yield from self.__tar(f, name + '/')
+                    continue
+                if self.files is not None and not fnmatch.fnmatch(name, self.files):
+                    continue
+                if name.endswith('.gz'):
+                    f = gzip.GzipFile(fileobj=f, mode='rb')
+                yield from self.__lines(f, name)
+
+    def __lines(self, f, name):
+        self.members += 1
+        lineno = 0
+        start = True
+        while True:
+            line = f.readline(MAX_LINE)
+            if not line:
+                return
+            if start:
+                lineno += 1
+            start = line.endswith(b'\n')
+            self.scanned += len(line)
+            if self.match(line):
+                self.matches += 1
+                yield name, lineno, line.rstrip(b'\r\n').decode('utf-8', errors='replace')
+                if self.matches >= self.max_matches:
+                    self.truncated = 'max matches ({})'.format(self.max_matches)
+                    raise StopSearch()
+            if self.scanned >= self.max_bytes:
+                self.truncated = 'max bytes scanned ({})'.format(self.max_bytes)
+                raise StopSearch()
+
+
+def options_from_args(args, max_matches=MAX_MATCHES, max_bytes=MAX_BYTES):
+    '''options_from_args(request.args, limits) - LogSearch arguments from a query string;
+    the caller's limits can be lowered but not raised'''
+    options = {'fixed': args.get('fixed') in ('1', 'true', 'yes'),
+               'ignore_case': args.get('i') in ('1', 'true', 'yes'),
+               'files': args.get('files') or None,
+               'max_matches': max_matches,
+               'max_bytes': max_bytes}
+    requested = args.get('max_matches', type=int)
+    if requested and 0 < requested < max_matches:
+        options['max_matches'] = requested
+    requested = args.get('max_mb', type=int)
+    if requested and 0 < requested * 1024 * 1024 < max_bytes:
+        options['max_bytes'] = requested * 1024 * 1024
+    return args.get('q', ''), options
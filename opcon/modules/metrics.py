@@ -0,0 +1,229 @@
+import functools
+import ipaddress
+import threading
+import time
+from flask import g, request, Response
+
+# A small in-process metrics registry, rendered in the Prometheus text
+# exposition format by /metrics.  Each gunicorn worker keeps (and reports)
+# its own numbers.  /metrics itself is not behind the login; it answers
+# only the networks it is allowed to (by default, this host).
+
+ALLOW = ['127.0.0.1/32', '::1/128']
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_str(labels):
+    if not labels:
+        return ''
+    pairs = list()
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(k, v))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _label_key(labels):
+    if labels is None:
+        return tuple()
+    return tuple(sorted(labels.items()))
+
+
+class Counter(object):
+    mtype = 'counter'
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.values = dict()
+
+    def inc(self, labels=None, amount=1):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, labels=None):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    mtype = 'gauge'
+
+    def dec(self, labels=None, amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=None):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Counter):
+    mtype = 'histogram'
+
+    def __init__(self, name, help, lock, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, lock)
+        self.buckets = buckets
+
+    def observe(self, value, labels=None):
+        key = _label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                # per-bucket counts (not cumulative), sum, count
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            h = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def get(self, labels=None):
+        h = self.values.get(_label_key(labels))
+        if h is None:
+            return 0
+        return h[2]
+
+    def samples(self):
+        for key, h in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, h[0]):
+                cumulative += n
+                yield self.name + '_bucket', key + (('le', bound),), cumulative
+            yield self.name + '_bucket', key + (('le', '+Inf'),), h[2]
+            yield self.name + '_sum', key, h[1]
+            yield self.name + '_count', key, h[2]
+
+
+class Registry(object):
+    '''Registry() - named counters, gauges and histograms'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = dict()
+        self.collectors = list()
+
+    def __metric(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, threading.Lock(), **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.__metric(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self.__metric(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.__metric(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, fn):
+        '''fn() is called before rendering, to update gauges from other objects'''
+        self.collectors.append(fn)
+
+    def render(self):
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as e:
+                print("metrics collector {} failed: {}".format(fn, e))
+        lines = list()
+        for name in sorted(self.metrics.keys()):
+            m = self.metrics[name]
+            lines.append('# HELP {} {}'.format(name, m.help))
+            lines.append('# TYPE {} {}'.format(name, m.mtype))
+            with m.lock:
+                samples = list(m.samples())
+            for sname, labels, value in samples:
+                lines.append('{}{} {}'.format(sname, _label_str(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+requests_total = REGISTRY.counter('opcon_http_requests_total',
+                                  'HTTP requests by route, method and status')
+request_seconds = REGISTRY.histogram('opcon_http_request_duration_seconds',
+                                     'HTTP request latency by route')
+requests_in_flight = REGISTRY.gauge('opcon_http_requests_in_flight',
+                                    'HTTP requests being handled')
+job_seconds = REGISTRY.histogram('opcon_scheduler_job_duration_seconds',
+                                 'scheduler job run time by job')
+job_failures = REGISTRY.counter('opcon_scheduler_job_failures_total',
+                                'scheduler job runs that raised, by job')
+
+
+def _route():
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    requests_in_flight.inc({'route': _route()})
+
+
+def _after_request(response):
+    route = _route()
+    requests_total.inc({'route': route, 'method': request.method, 'status': response.status_code})
+    request_seconds.observe(time.perf_counter() - g.metrics_start, {'route': route})
+    g.metrics_done = True
+    return response
+
+
+def _teardown_request(exc):
+    # may be called more than once for a request (e.g. preserved test contexts)
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    route = _route()
+    requests_in_flight.dec({'route': route})
+    if not g.pop('metrics_done', False):
+        # the view raised, so after_request never ran
+        requests_total.inc({'route': route, 'method': request.method, 'status': 500})
+        request_seconds.observe(time.perf_counter() - start, {'route': route})
+
+
+def init_app(app, registry=REGISTRY, path='/metrics', allow=None):
+    '''instrument every route of app (and its blueprints), and serve path
+    to clients in the allow networks (default ALLOW); raises ValueError'''
+    networks = [ipaddress.ip_network(n, strict=False) for n in (allow or ALLOW)]
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+    def allowed(addr):
+        try:
+            addr = ipaddress.ip_address(addr)
+        except ValueError:
+            return False
+        return any([addr in n for n in networks if n.version == addr.version])
+
+    def metrics():
+        if not allowed(request.remote_addr):
+            return Response('forbidden\n', status=403, content_type='text/plain')
+        return Response(registry.render(),
+                        status=200,
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+    app.add_url_rule(path, 'metrics', metrics)
+
+
+def timed_job(job_id, fn):
+    '''wrap a scheduler job function to record its run time and failures'''
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            job_failures.inc({'job': job_id})
+            raise
+        finally:
+            job_seconds.observe(time.perf_counter() - start, {'job': job_id})
+    return timed
@@ -0,0 +1,118 @@
+import threading
+import uuid
+import os
+import sys
+
+# A disk cache of task output (result, debug and event logs).  The output
+# of a finished task never changes, so it is written to a local directory
+# as it is streamed to the first reader; later readers are served the file
+# (send_file, so Range and conditional requests work, and the server can
+# use sendfile).  The directory is kept under max_bytes by removing the
+# least recently read files; reads bump a file's mtime, so this works with
+# several workers sharing the directory.
+
+OUTPUT_TYPES = ['result', 'debug', 'event']
+
+
+class OutputCache(object):
+    '''OutputCache(directory, max_bytes=1GB) - cached output of finished tasks'''
+    def __init__(self, directory, **kwargs):
+        self.directory = directory
+        self.max_bytes = 1024 * 1024 * 1024
+        self.debug = False
+        if 'max_bytes' in kwargs and kwargs['max_bytes']:
+            self.max_bytes = kwargs['max_bytes']
+        if 'debug' in kwargs:
+            self.debug = kwargs['debug']
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def path(self, taskid, output_type):
+        '''the cache file for a task's output, or None if it can't be cached'''
+        taskid = str(taskid)
+        if not taskid.isdigit() or output_type not in OUTPUT_TYPES:
+            return None
+        return os.path.join(self.directory, '{}.{}'.format(taskid, output_type))
+
+    def lookup(self, taskid, output_type):
+        '''return the path of the cached output, or None'''
+        path = self.path(taskid, output_type)
+        if path is None:
+            return None
+        try:
+            # mark it recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def tee(self, taskid, output_type, chunks):
+        '''tee(taskid, type, chunk iterator) - generate chunks, writing them to the cache
+
+        The file only becomes visible once the whole output has been read;
+        if the reader goes away part way through, it is discarded.'''
+        path = self.path(taskid, output_type)
+        if path is None:
+            yield from chunks
+            return
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+        try:
+            f = open(tmp, 'wb')
+        except OSError as e:
+            print("output cache: can't write {}: {}".format(tmp, e), file=sys.stderr)
+            yield from chunks
+            return
+        complete = False
+        failed = False
+        try:
+            for chunk in chunks:
+                if not failed:
+                    try:
+                        f.write(chunk)
+                    except OSError as e:
+                        # e.g. disk full - keep serving the reader, just don't cache
+                        print("output cache: can't write {}: {}".format(tmp, e), file=sys.stderr)
+                        failed = True
+                yield chunk
+            complete = not failed
+        finally:
+            try:
+                f.close()
+                if complete:
+                    os.replace(tmp, path)
+                else:
+                    os.remove(tmp)
+            except OSError as e:
+                print("output cache: {}".format(e), file=sys.stderr)
+            if complete:
+                self.evict()
+
+    def evict(self):
+        '''remove least recently used outputs until the cache fits in max_bytes'''
+        with self.lock:
+            evict_lru(self.directory, self.max_bytes, self.debug)
+
+
+def evict_lru(directory, max_bytes, debug=False):
+    '''remove the least recently used (oldest mtime) files in directory until
+    they total no more than max_bytes; files being written (*.tmp) are left alone'''
+    files = list()
+    total = 0
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.tmp') or not entry.is_file():
+            continue
+        st = entry.stat()
+        files.append((st.st_mtime, st.st_size, entry.path))
+        total += st.st_size
+    if total <= max_bytes:
+        return
+    for mtime, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if debug:
+            print("evicted", path)
+        if total <= max_bytes:
+            break
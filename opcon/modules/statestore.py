@@ -0,0 +1,151 @@
+import collections.abc
+import threading
+import sqlite3
+import json
+import time
+import os
+
+# state_store(url) - return the configured store
+#   '' or 'memory'           - per-process dictionary (a single worker)
+#   'sqlite:///path/to/file' - SQLite file in WAL mode, shared by all workers
+#                              on the host and kept across restarts
+# Values are anything json.dumps() can handle; they are grouped in namespaces
+# ("logins", "pending_tasks:<director>", ...) and returned as copies.
+
+
+def state_store(url):
+    if url is None or url in ['', 'memory']:
+        return MemoryStore()
+    if url.startswith('sqlite://'):
+        return SQLiteStore(url[len('sqlite://'):])
+    raise ValueError("unknown state store {}".format(url))
+
+
+class MemoryStore(object):
+    '''MemoryStore() - state kept in this process only'''
+    shared = False
+
+    def __init__(self):
+        self.data = dict()
+        self.lock = threading.Lock()
+
+    def get(self, ns, key, default=None):
+        with self.lock:
+            if (ns, key) not in self.data:
+                return default
+            return json.loads(self.data[(ns, key)])
+
+    def set(self, ns, key, value):
+        with self.lock:
+            self.data[(ns, key)] = json.dumps(value)
+
+    def setdefault(self, ns, key, value):
+        '''set key if absent; return the stored value either way'''
+        with self.lock:
+            if (ns, key) not in self.data:
+                self.data[(ns, key)] = json.dumps(value)
+            return json.loads(self.data[(ns, key)])
+
+    def delete(self, ns, key):
+        with self.lock:
+            self.data.pop((ns, key), None)
+
+    def items(self, ns):
+        with self.lock:
+            return [(k[1], json.loads(v)) for k, v in self.data.items() if k[0] == ns]
+
+    def clear(self, ns):
+        with self.lock:
+            for k in [k for k in self.data if k[0] == ns]:
+                del self.data[k]
+
+    def mapping(self, ns):
+        return StoreMapping(self, ns)
+
+
+class SQLiteStore(MemoryStore):
+    '''SQLiteStore(path) - state in a SQLite (WAL) file shared across processes'''
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.__db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS state ('
+                   'ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                   'updated REAL NOT NULL, PRIMARY KEY (ns, key))')
+        db.commit()
+        # tokens and logins live here
+        os.chmod(self.path, 0o600)
+
+    def __db(self):
+        # sqlite connections can't be shared between threads
+        if getattr(self.local, 'db', None) is None:
+            self.local.db = sqlite3.connect(self.path, timeout=10)
+            self.local.db.execute('PRAGMA synchronous=NORMAL')
+        return self.local.db
+
+    def get(self, ns, key, default=None):
+        row = self.__db().execute('SELECT value FROM state WHERE ns=? AND key=?',
+                                  (ns, key)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, ns, key, value):
+        db = self.__db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO state (ns, key, value, updated) VALUES (?, ?, ?, ?)',
+                       (ns, key, json.dumps(value), time.time()))
+
+    def setdefault(self, ns, key, value):
+        db = self.__db()
+        with db:
+            db.execute('INSERT OR IGNORE INTO state (ns, key, value, updated) VALUES (?, ?, ?, ?)',
+                       (ns, key, json.dumps(value), time.time()))
+        return self.get(ns, key)
+
+    def delete(self, ns, key):
+        db = self.__db()
+        with db:
+            db.execute('DELETE FROM state WHERE ns=? AND key=?', (ns, key))
+
+    def items(self, ns):
+        rows = self.__db().execute('SELECT key, value FROM state WHERE ns=?', (ns,)).fetchall()
+        return [(r[0], json.loads(r[1])) for r in rows]
+
+    def clear(self, ns):
+        db = self.__db()
+        with db:
+            db.execute('DELETE FROM state WHERE ns=?', (ns,))
+
+
+class StoreMapping(collections.abc.MutableMapping):
+    '''StoreMapping(store, namespace) - a dictionary view of one namespace'''
+    def __init__(self, store, ns):
+        self.store = store
+        self.ns = ns
+
+    def __getitem__(self, key):
+        value = self.store.get(self.ns, key, default=KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.set(self.ns, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.store.delete(self.ns, key)
+
+    def __contains__(self, key):
+        return self.store.get(self.ns, key, default=KeyError) is not KeyError
+
+    def __iter__(self):
+        return iter([k for k, v in self.store.items(self.ns)])
+
+    def __len__(self):
+        return len(self.store.items(self.ns))
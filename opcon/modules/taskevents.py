@@ -0,0 +1,162 @@
+import collections
+import threading
+import json
+import time
+import os
+
+# Task state changes as Server-Sent Events, so the logs and history pages
+# update in place instead of being reloaded.  The task watchers publish
+# to one TaskEvents; each page holds a stream() open, and every stream
+# waits on the same recent events - however many pages are open, the
+# director is only polled by the watchers.
+#
+# The feed is per worker: each has its own watchers and events.  Event
+# ids are the worker's process id and the time they were published, so a
+# browser reconnecting with Last-Event-ID to the same worker gets what it
+# missed, and gets a "reset" (read the page again) if it reconnects to
+# another worker or those events are no longer kept.
+#
+# Every open stream ties up one of the worker's threads, so Streams caps
+# how many it holds at once; pages turned away just don't update in place.
+
+KEEPALIVE = 10      # seconds between comments on a quiet stream
+DURATION = 25       # seconds a stream is held open; the browser reconnects
+RETRY = 1000        # ms the browser waits before reconnecting
+BUSY_RETRY = 30000  # ms a browser turned away waits before trying again
+
+
+def message(data, event=None, event_id=None):
+    '''one SSE message, with data as JSON'''
+    lines = list()
+    if event is not None:
+        lines.append('event: ' + event)
+    if event_id is not None:
+        lines.append('id: ' + event_id)
+    lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Streams(object):
+    '''Streams(limit) - the long-held streams (task events, task tails) a
+    worker serves at once'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def full(self):
+        with self.lock:
+            return self.open >= self.limit
+
+    def acquire(self):
+        with self.lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+    def hold(self, messages, busy='retry: {}\n\n'.format(BUSY_RETRY)):
+        '''generate messages while holding a stream, or just busy if there is none
+        (the routes check full() first, so this only happens on a race)'''
+        if not self.acquire():
+            yield busy
+            return
+        try:
+            yield from messages
+        finally:
+            self.release()
+
+
+class TaskEvents(object):
+    '''TaskEvents(size=256) - the recent task state changes, for any number of subscribers'''
+    def __init__(self, **kwargs):
+        self.size = 256
+        if 'size' in kwargs and kwargs['size']:
+            self.size = kwargs['size']
+        self.origin = '{:x}'.format(os.getpid())
+        self.started = self.parse_id(self.event_id(time.time()))
+        self.events = collections.deque(maxlen=self.size)
+        self.last = self.started
+        self.subscribers = 0
+        self.changed = threading.Condition()
+
+    def publish(self, event):
+        '''publish(event dict) - return its id'''
+        with self.changed:
+            # ids only ever go up, even if the clock doesn't; times are kept
+            # as their ids give them back, so a resumed stream doesn't repeat one
+            self.last = self.parse_id(self.event_id(max(time.time(), self.last + 0.000001)))
+            self.events.append((self.last, event))
+            self.changed.notify_all()
+            return self.event_id(self.last)
+
+    def event_id(self, t):
+        return '{}:{:.6f}'.format(self.origin, t)
+
+    def last_id(self):
+        '''id of the latest event, for a page to start its stream from'''
+        with self.changed:
+            return self.event_id(self.last)
+
+    def parse_id(self, event_id):
+        '''the time in one of our event ids, or None (another worker's, or not an id)'''
+        try:
+            origin, t = event_id.split(':', 1)
+            if origin != self.origin:
+                return None
+            return float(t)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def since(self, t, timeout=None):
+        '''since(t, timeout) - [(t, event), ...] published after t, waiting up
+        to timeout seconds for one; None if some of them are no longer kept'''
+        with self.changed:
+            self.changed.wait_for(lambda: self.last > t, timeout)
+            if t < self.started:
+                return None
+            if len(self.events) == self.events.maxlen and t < self.events[0][0]:
+                return None
+            return [(et, e) for et, e in self.events if et > t]
+
+    def subscribe(self):
+        with self.changed:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.changed:
+            self.subscribers -= 1
+
+    def stream(self, last_id=None, keepalive=KEEPALIVE, duration=DURATION):
+        '''stream(last event id) - generate SSE messages for duration seconds
+
+        Without a last_id the stream starts with the next event; one that
+        isn't ours gets a reset.'''
+        self.subscribe()
+        try:
+            yield 'retry: {}\n\n'.format(RETRY)
+            t = self.parse_id(last_id)
+            if last_id and t is None:
+                # another worker's id: its events aren't ours to resume from
+                yield message({}, event='reset')
+                return
+            if t is None:
+                with self.changed:
+                    t = self.last
+            end = time.time() + duration
+            while time.time() < end:
+                events = self.since(t, timeout=min(keepalive, max(0, end - time.time())))
+                if events is None:
+                    yield message({}, event='reset')
+                    return
+                if not events:
+                    yield ': keepalive\n\n'
+                for et, e in events:
+                    t = et
+                    yield message(e, event='task', event_id=self.event_id(et))
+        finally:
+            self.unsubscribe()
@@ -0,0 +1,197 @@
+import threading
+import bisect
+import time
+import sys
+import re
+from opcon.modules import taskwatch
+
+# A local index of the director's task history.  Finished tasks never
+# change, so once a task is indexed in a final state it is not fetched
+# again; a sync only asks for tasks newer than the newest one indexed and
+# for the ones still queued or running.  History queries (by state,
+# deployment, user, description and time) are answered from the index.
+
+PAGE = 50       # tasks asked for when looking for new ones
+
+
+def filters_from_args(args):
+    '''filters_from_args(request.args) - query() filters given in a query string'''
+    filters = dict()
+    for key in ['state', 'deployment', 'user', 'description', 'exclude']:
+        if args.get(key):
+            filters[key] = args.get(key)
+    for key in ['since', 'until']:
+        if args.get(key):
+            filters[key] = args.get(key, type=int)
+    return filters
+
+
+class TaskHistory(object):
+    '''TaskHistory(director, min_interval=5, max_tasks=5000) - indexed BOSH task history'''
+    def __init__(self, director, **kwargs):
+        self.director = director
+        self.debug = director.debug
+        self.min_interval = 5
+        self.max_tasks = 5000
+        if 'min_interval' in kwargs and kwargs['min_interval'] is not None:
+            self.min_interval = kwargs['min_interval']
+        if 'max_tasks' in kwargs and kwargs['max_tasks']:
+            self.max_tasks = kwargs['max_tasks']
+        self.tasks = dict()     # id -> task record
+        self.ids = list()       # indexed ids, ascending
+        self.active = set()     # ids last seen queued or processing
+        self.depth = 0          # most tasks asked for in one listing
+        self.complete = False   # the director has no tasks older than ours
+        self.next_sync = 0
+        self.lock = threading.Lock()        # guards the index
+        self.sync_lock = threading.Lock()   # one sync at a time
+
+    def __list(self, params):
+        d = self.director
+        params = dict(params)
+        params['verbose'] = '1'
+        r = d.session.get(d.bosh_url + '/tasks', params=params, verify=d.verify_tls)
+        if not r.ok:
+            print("task history: error listing tasks: {}".format(r.status_code), file=sys.stderr)
+            return None
+        return r.json()
+
+    def __get(self, tid):
+        d = self.director
+        r = d.session.get(d.bosh_url + '/tasks/{}'.format(tid), verify=d.verify_tls)
+        if not r.ok:
+            print("task history: error getting task {}: {}".format(tid, r.status_code), file=sys.stderr)
+            return None
+        return r.json()
+
+    def __add(self, tasks):
+        with self.lock:
+            for t in tasks:
+                tid = int(t['id'])
+                if tid not in self.tasks:
+                    bisect.insort(self.ids, tid)
+                self.tasks[tid] = t
+                if t['state'] in taskwatch.TERMINAL_STATES:
+                    self.active.discard(tid)
+                else:
+                    self.active.add(tid)
+            while len(self.ids) > self.max_tasks:
+                tid = self.ids.pop(0)
+                self.tasks.pop(tid, None)
+                self.active.discard(tid)
+                self.complete = False
+
+    def newest(self):
+        with self.lock:
+            return self.ids[-1] if len(self.ids) else 0
+
+    def __fetch_new(self):
+        '''list tasks until one we already have is reached'''
+        newest = self.newest()
+        limit = PAGE
+        while True:
+            tasks = self.__list({'limit': limit})
+            if tasks is None:
+                return False
+            self.__add(tasks)
+            if newest == 0 or len(tasks) < limit or min([int(t['id']) for t in tasks]) <= newest:
+                if newest == 0:
+                    self.depth = max(self.depth, limit)
+                    self.complete = len(tasks) < limit
+                return True
+            if limit >= self.max_tasks:
+                return True
+            # more than a page of new tasks since the last sync
+            limit *= 2
+
+    def __refresh_active(self):
+        '''re-read tasks that were running; finished ones get their final record'''
+        running = self.__list({'state': 'queued,processing'})
+        if running is None:
+            return
+        self.__add(running)
+        still = set([int(t['id']) for t in running])
+        with self.lock:
+            finished = [tid for tid in self.active if tid not in still]
+        for tid in finished:
+            task = self.__get(tid)
+            if task is not None:
+                self.__add([task])
+
+    def sync(self, force=False):
+        '''bring the index up to date (at most every min_interval seconds)'''
+        if not force and time.time() < self.next_sync:
+            return
+        with self.sync_lock:
+            if not force and time.time() < self.next_sync:
+                return
+            if self.__fetch_new():
+                self.__refresh_active()
+            self.next_sync = time.time() + self.min_interval
+        if self.debug:
+            print("task history: {} tasks indexed, {} active".format(len(self.ids), len(self.active)))
+
+    def expire(self):
+        '''sync on the next query (after acting on tasks)'''
+        self.next_sync = 0
+
+    def backfill(self, depth):
+        '''make sure the index reaches back at least depth tasks, if the director has them'''
+        if self.complete or depth <= self.depth:
+            return
+        with self.sync_lock:
+            if self.complete or depth <= self.depth:
+                return
+            tasks = self.__list({'limit': depth})
+            if tasks is None:
+                return
+            self.__add(tasks)
+            self.depth = depth
+            self.complete = len(tasks) < depth
+
+    def query(self, limit=100, **filters):
+        '''query(limit, filter=value, ...) - indexed tasks, newest first, see filter_tasks()'''
+        self.sync()
+        if limit:
+            self.backfill(min(limit, self.max_tasks))
+        with self.lock:
+            tasks = [self.tasks[tid] for tid in reversed(self.ids)]
+        return filter_tasks(tasks, limit, **filters)
+
+
+def filter_tasks(tasks, limit=None, state=None, deployment=None, user=None,
+                 description=None, exclude=None, since=None, until=None):
+    '''filter_tasks(tasks, limit, ...) - the first limit tasks matching all the given filters
+
+    state is a list (or comma separated string) of states; description
+    and exclude are regular expressions searched for in the description;
+    since and until bound the task timestamp (epoch seconds).'''
+    if isinstance(state, str):
+        state = [s for s in state.split(',') if s]
+    try:
+        desc_re = re.compile(description) if description else None
+        excl_re = re.compile(exclude) if exclude else None
+    except re.error as e:
+        raise ValueError("bad description pattern: {}".format(e))
+    result = list()
+    for t in tasks:
+        ts = t.get('timestamp') or 0
+        if until is not None and ts > until:
+            continue
+        if since is not None and ts < since:
+            continue
+        if state and t.get('state') not in state:
+            continue
+        if deployment and t.get('deployment') != deployment:
+            continue
+        if user and t.get('user') != user:
+            continue
+        desc = t.get('description') or ''
+        if desc_re is not None and not desc_re.search(desc):
+            continue
+        if excl_re is not None and excl_re.search(desc):
+            continue
+        result.append(t)
+        if limit and len(result) >= limit:
+            break
+    return result
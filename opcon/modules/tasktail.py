@@ -0,0 +1,153 @@
+import re
+import sys
+import time
+from opcon.modules import taskwatch
+from opcon.modules import taskevents
+
+# Following the event or debug output of a running task, instead of
+# downloading the whole (growing) log again and again.  Each poll asks
+# the director for the bytes after those already delivered (Range:
+# bytes=<offset>-); if it ignores the Range header and sends all of the
+# output, what was already delivered is skipped as it streams past.
+# Polls are a second apart, backing off to MAX_POLL while nothing is
+# appended, and the tail ends once the task has finished and the last
+# of its output has been read - or after taskevents.DURATION seconds, so
+# a long deploy doesn't hold a thread for hours; the client goes on from
+# the offset it got to.
+
+POLL = 1
+MAX_POLL = 8
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-')
+
+
+class TaskTail(object):
+    '''TaskTail(director, taskid, output_type, offset=0) - output a task adds from offset on'''
+    def __init__(self, director, taskid, output_type, **kwargs):
+        if not str(taskid).isdigit():
+            raise ValueError('bad task id {}'.format(taskid))
+        self.director = director
+        self.task_url = '/tasks/{}'.format(taskid)
+        self.output_type = output_type
+        self.offset = 0
+        self.poll = POLL
+        self.max_poll = MAX_POLL
+        if 'offset' in kwargs and kwargs['offset']:
+            offset = str(kwargs['offset'])
+            if not offset.isdigit():
+                raise ValueError('bad offset {}'.format(offset))
+            self.offset = int(offset)
+        if 'poll' in kwargs and kwargs['poll']:
+            self.poll = kwargs['poll']
+        if 'max_poll' in kwargs and kwargs['max_poll']:
+            self.max_poll = kwargs['max_poll']
+        self.state = None
+
+    def fetch(self):
+        '''generate the output past offset as it is now, moving offset along; raises IOError'''
+        r = self.director.stream(self.task_url + '/output',
+                                 params={'type': self.output_type},
+                                 headers={'Range': 'bytes={}-'.format(self.offset)})
+        if r.status_code == 416:
+            # nothing past offset yet
+            r.close()
+            return
+        if not r.ok:
+            r.close()
+            raise IOError('task output {}: {}'.format(self.task_url, r.status_code))
+        skip = self.offset
+        if r.status_code == 206:
+            m = CONTENT_RANGE.match(r.headers.get('Content-Range', ''))
+            skip = self.offset - int(m.group(1)) if m else 0
+            if skip < 0:
+                r.close()
+                raise IOError('task output {}: range starts past {}'.format(self.task_url, self.offset))
+        for chunk in self.director.iter_stream(r):
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            self.offset += len(chunk)
+            yield chunk
+
+    def finished(self):
+        '''has the task reached a state it won't leave?  (its state is kept in state)'''
+        watcher = self.director.task_watcher
+        if watcher is not None:
+            # the shared poller; no request of our own once it is watching the task
+            future = watcher.watch(self.task_url)
+            task = future.result() if future.done() else watcher.state(self.task_url)
+        else:
+            task = self.director.task_state(self.task_url)
+        if task is None:
+            return False
+        self.state = task['state']
+        return self.state in taskwatch.TERMINAL_STATES
+
+    def follow(self, sleep=time.sleep):
+        '''generate output as it is added, until the task has finished; an empty
+        chunk follows each poll that found nothing new'''
+        interval = self.poll
+        while True:
+            done = self.finished()
+            found = False
+            for chunk in self.fetch():
+                found = True
+                yield chunk
+            if done:
+                return
+            if found:
+                interval = self.poll
+            else:
+                yield b''
+                interval = min(interval * 2, self.max_poll)
+            sleep(interval)
+
+    def text(self, duration=taskevents.DURATION):
+        '''the output as it is added, for a chunked response, for up to duration
+        seconds; the client goes on from the offset plus what it was sent'''
+        end = time.time() + duration
+        try:
+            for chunk in self.follow():
+                if chunk:
+                    yield chunk
+                if time.time() > end:
+                    return
+        except IOError as e:
+            print("tail: {}".format(e), file=sys.stderr)
+
+    def sse(self, duration=taskevents.DURATION):
+        '''the output as SSE messages: "output" events of whole lines, with the
+        offset after them as the id, and an "end" event with the task's state
+
+        The stream closes after duration seconds; the browser reconnects
+        with Last-Event-ID, and the tail goes on from that offset.'''
+        yield 'retry: {}\n\n'.format(taskevents.RETRY)
+        delivered = self.offset
+        pending = b''
+        end = time.time() + duration
+        try:
+            for chunk in self.follow():
+                if chunk:
+                    pending += chunk
+                    cut = pending.rfind(b'\n') + 1
+                    if cut:
+                        delivered += cut
+                        yield taskevents.message({'text': pending[:cut].decode('utf-8', 'replace')},
+                                                 event='output', event_id=str(delivered))
+                        pending = pending[cut:]
+                else:
+                    yield ': keepalive\n\n'
+                if time.time() > end:
+                    return
+        except IOError as e:
+            print("tail: {}".format(e), file=sys.stderr)
+            yield taskevents.message({'state': self.state, 'offset': delivered, 'error': str(e)},
+                                     event='end')
+            return
+        if pending:
+            delivered += len(pending)
+            yield taskevents.message({'text': pending.decode('utf-8', 'replace')},
+                                     event='output', event_id=str(delivered))
+        yield taskevents.message({'state': self.state, 'offset': delivered}, event='end')
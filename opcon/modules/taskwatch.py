@@ -0,0 +1,188 @@
+import concurrent.futures
+import collections
+import threading
+import time
+import sys
+
+# BOSH task states that will not change again
+TERMINAL_STATES = ['done', 'error', 'cancelled', 'timeout']
+
+
+def task_id(task_url):
+    '''task_id("/tasks/123") - return "123"'''
+    return str(task_url).rstrip('/').split('/')[-1]
+
+
+class TaskWatcher(object):
+    '''TaskWatcher(director) - one shared poller for outstanding BOSH tasks
+
+    Callers watch() a task and get a future that is resolved with the task
+    record once it reaches a terminal state.  sweep() is run on every
+    scheduler tick; it polls all watched tasks with a single
+    /tasks?state=queued,processing call, backing off exponentially while
+    nothing changes.
+
+    With events (a taskevents.TaskEvents), every state change seen is
+    published there; while it has subscribers, tasks started elsewhere
+    are followed too, and polling stays at min_interval while any task
+    is active.'''
+    def __init__(self, director, **kwargs):
+        self.director = director
+        self.debug = director.debug
+        self.min_interval = 1
+        self.max_interval = 16
+        if 'min_interval' in kwargs:
+            self.min_interval = kwargs['min_interval']
+        if 'max_interval' in kwargs:
+            self.max_interval = kwargs['max_interval']
+        self.events = None
+        if 'events' in kwargs:
+            self.events = kwargs['events']
+        self.interval = self.min_interval
+        self.next_sweep = 0
+        self.lock = threading.Lock()
+        self.watched = dict()       # task id -> future
+        self.states = collections.OrderedDict()   # task id -> last seen task record
+        self.sweep_lock = threading.Lock()
+
+    def __get_task(self, tid):
+        d = self.director
+        r = d.session.get(d.bosh_url + '/tasks/' + tid, verify=d.verify_tls)
+        if not r.ok:
+            print("task watch: error getting task {}: {}".format(tid, r.status_code), file=sys.stderr)
+            return None
+        return r.json()
+
+    def __remember(self, tid, task):
+        last = self.states.get(tid)
+        if self.events is not None and (last is None or last['state'] != task['state']):
+            self.events.publish({'director': self.director.name,
+                                 'id': task.get('id'),
+                                 'state': task.get('state'),
+                                 'description': task.get('description'),
+                                 'deployment': task.get('deployment'),
+                                 'user': task.get('user'),
+                                 'timestamp': task.get('timestamp'),
+                                 'result': task.get('result')})
+        self.states[tid] = task
+        self.states.move_to_end(tid)
+        while len(self.states) > 256:
+            self.states.popitem(last=False)
+
+    def __resolve(self, tid, task):
+        future = self.watched.pop(tid, None)
+        if future is not None and not future.done():
+            future.set_result(task)
+
+    def following(self):
+        '''True if there are pages waiting on events'''
+        return self.events is not None and self.events.subscribers > 0
+
+    def watch(self, task_url):
+        '''watch(task url) - return a future resolved with the finished task record'''
+        tid = task_id(task_url)
+        with self.lock:
+            if tid in self.watched:
+                return self.watched[tid]
+            last = self.states.get(tid)
+        if last is None or last['state'] not in TERMINAL_STATES:
+            # one look now, so a finished task resolves without waiting for a sweep
+            last = self.__get_task(tid)
+        future = concurrent.futures.Future()
+        with self.lock:
+            if last is not None:
+                self.__remember(tid, last)
+            if last is not None and last['state'] in TERMINAL_STATES:
+                future.set_result(last)
+            elif tid in self.watched:
+                future = self.watched[tid]
+            else:
+                self.watched[tid] = future
+                # new work, so poll eagerly again
+                self.interval = self.min_interval
+                self.next_sweep = 0
+        self.__update_pending()
+        return future
+
+    def watch_pending(self):
+        '''watch the console's unfinished tasks, including those from before a restart'''
+        for t in self.director.pending_tasks:
+            if t.t_state not in TERMINAL_STATES:
+                self.watch(t.t_url)
+
+    def state(self, task_url):
+        '''state(task url) - return the last seen task record, or None'''
+        with self.lock:
+            return self.states.get(task_id(task_url))
+
+    def wait(self, task_url, timeout):
+        '''wait(task url, timeout) - return the task record once finished, or the
+        last seen record if it did not finish within timeout seconds'''
+        future = self.watch(task_url)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return self.state(task_url)
+
+    def sweep(self):
+        '''poll all watched tasks in one pass; called from the scheduler'''
+        if not self.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                if len(self.watched) == 0 and not self.following():
+                    return
+                if time.time() < self.next_sweep:
+                    return
+            d = self.director
+            r = d.session.get(d.bosh_url + '/tasks',
+                              params={'state': 'queued,processing', 'verbose': '1'},
+                              verify=d.verify_tls)
+            if not r.ok:
+                print("task watch: error listing tasks: {}".format(r.status_code), file=sys.stderr)
+                return
+            active = dict()
+            for t in r.json():
+                active[str(t['id'])] = t
+            with self.lock:
+                if self.following():
+                    # follow tasks started elsewhere, so their end is published
+                    for tid in active:
+                        if tid not in self.watched:
+                            self.watched[tid] = concurrent.futures.Future()
+                watched = list(self.watched.keys())
+            changed = False
+            for tid in watched:
+                if tid in active:
+                    task = active[tid]
+                else:
+                    # no longer active, fetch the final record (with its result)
+                    task = self.__get_task(tid)
+                    if task is None:
+                        continue
+                with self.lock:
+                    last = self.states.get(tid)
+                    if last is None or last['state'] != task['state']:
+                        changed = True
+                    self.__remember(tid, task)
+                    if task['state'] in TERMINAL_STATES:
+                        self.__resolve(tid, task)
+            with self.lock:
+                if changed or (active and self.following()):
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+                self.next_sweep = time.time() + self.interval
+            if self.debug:
+                print("task watch: {} watched, next sweep in {}s".format(len(self.watched), self.interval))
+            self.__update_pending()
+        finally:
+            self.sweep_lock.release()
+
+    def __update_pending(self):
+        '''carry live task state on the director's pending tasks'''
+        for t in self.director.pending_tasks:
+            task = self.state(t.t_url)
+            if task is not None and t.t_state != task['state']:
+                t.t_state = task['state']
+                self.director.save_pending_task(t)
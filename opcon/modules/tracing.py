@@ -0,0 +1,211 @@
+import contextvars
+import functools
+import logging
+import logging.handlers
+import random
+import json
+import time
+import uuid
+import os
+import re
+from flask import g, request, before_render_template, template_rendered
+
+# Per-request tracing.  A sampled Flask request opens a root span; calls
+# made while it is current (director HTTP calls, task waits, template
+# renders) open child spans with span().  Finished spans are written, one
+# JSON object per line, to a size-rotated file.  Outside a sampled request
+# span() does nothing, so instrumented code costs a context variable lookup.
+
+_current = contextvars.ContextVar('opcon_trace_span', default=None)
+
+# BOSH collection -> placeholder for the path segment that follows it
+PATH_PLACEHOLDERS = {
+    'deployments': '<deployment>',
+    'tasks': '<id>',
+    'errands': '<errand>',
+    'jobs': '<job>',
+    'instances': '<instance>',
+    'resources': '<blobstore_id>',
+    'releases': '<release>',
+    'stemcells': '<stemcell>',
+}
+ID_SEGMENT = re.compile(r'^([0-9]+|[0-9a-f]{8}-[0-9a-f-]{27})$')
+
+
+def path_template(path):
+    '''path_template("/deployments/cf/vms") - return "/deployments/<deployment>/vms"'''
+    segments = path.split('?')[0].split('/')
+    for i in range(1, len(segments)):
+        if segments[i] == '':
+            continue
+        if segments[i - 1] in PATH_PLACEHOLDERS:
+            segments[i] = PATH_PLACEHOLDERS[segments[i - 1]]
+        elif ID_SEGMENT.match(segments[i]):
+            segments[i] = '<id>'
+    return '/'.join(segments)
+
+
+class Span(object):
+    '''Span(tracer, name, parent) - a timed operation; use as a context manager'''
+    def __init__(self, tracer, name, parent=None, **attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attrs = attrs
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        self.duration = None
+        _current.set(self)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.perf_start
+        # back to the parent, even if a child was left open
+        _current.set(self.parent)
+        self.tracer.export(self)
+
+    def record(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent.span_id if self.parent is not None else None,
+                'name': self.name,
+                'start': self.start,
+                'duration_ms': round(self.duration * 1000, 3),
+                'pid': os.getpid(),
+                'attrs': self.attrs}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.finish()
+        return False
+
+
+class _NoSpan(object):
+    '''stand-in when the current request is not being traced'''
+    def set(self, **attrs):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def current():
+    '''return the current span, or None'''
+    return _current.get()
+
+
+def span(name, **attrs):
+    '''span(name, attr=value, ...) - child of the current span, or a no-op'''
+    parent = _current.get()
+    if parent is None:
+        return NO_SPAN
+    return Span(parent.tracer, name, parent, **attrs)
+
+
+def traced_call(func):
+    '''wrap func so it runs in a copy of the caller's context (for thread pools)'''
+    ctx = contextvars.copy_context()
+    return functools.partial(ctx.run, func)
+
+
+class Tracer(object):
+    '''Tracer(path, sample_rate=0.1, max_bytes=10MB, backups=5) - write sampled spans as JSONL'''
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.sample_rate = 0.1
+        self.max_bytes = 10 * 1024 * 1024
+        self.backups = 5
+        self.debug = False
+        if 'sample_rate' in kwargs and kwargs['sample_rate'] is not None:
+            self.sample_rate = kwargs['sample_rate']
+        if 'max_bytes' in kwargs and kwargs['max_bytes']:
+            self.max_bytes = kwargs['max_bytes']
+        if 'backups' in kwargs and kwargs['backups'] is not None:
+            self.backups = kwargs['backups']
+        if 'debug' in kwargs:
+            self.debug = kwargs['debug']
+        # a private logger, so spans don't end up in the application log
+        self.logger = logging.getLogger('opcon.tracing.{}'.format(id(self)))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path,
+                                                       maxBytes=self.max_bytes,
+                                                       backupCount=self.backups,
+                                                       delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+        if self.debug:
+            print(f"tracing: file={path} sample_rate={self.sample_rate} max_bytes={self.max_bytes}")
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def start_trace(self, name, **attrs):
+        '''open a root span if this trace is sampled, else return None'''
+        if not self.sampled():
+            _current.set(None)
+            return None
+        return Span(self, name, None, **attrs)
+
+    def export(self, span):
+        try:
+            self.logger.info(json.dumps(span.record(), default=str))
+        except Exception as e:
+            print("tracing: export failed: {}".format(e))
+
+    def __before_request(self):
+        g.trace_span = self.start_trace('request',
+                                        method=request.method,
+                                        path=request.path,
+                                        route=request.url_rule.rule if request.url_rule else 'unmatched')
+
+    def __after_request(self, response):
+        root = g.get('trace_span')
+        if root is not None:
+            root.set(status=response.status_code)
+        return response
+
+    def __teardown_request(self, exc):
+        root = g.pop('trace_span', None)
+        if root is None:
+            return
+        if exc is not None:
+            root.set(error=type(exc).__name__)
+        root.finish()
+
+    def __before_render(self, sender, template, context, **extra):
+        s = span('render_template', template=template.name)
+        if s is not NO_SPAN:
+            g.setdefault('trace_renders', list()).append(s)
+
+    def __rendered(self, sender, template, context, **extra):
+        renders = g.get('trace_renders')
+        if renders:
+            renders.pop().finish()
+
+    def init_app(self, app):
+        '''open a span for every request to app, and for every template it renders'''
+        app.before_request(self.__before_request)
+        app.after_request(self.__after_request)
+        app.teardown_request(self.__teardown_request)
+        before_render_template.connect(self.__before_render, app)
+        template_rendered.connect(self.__rendered, app)
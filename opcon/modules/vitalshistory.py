@@ -0,0 +1,352 @@
+import threading
+import struct
+import array
+import fcntl
+import mmap
+import math
+import time
+import zlib
+import sys
+import os
+
+# A history of instance vitals, so the vitals page can tell a cell that
+# has been at 90% memory for a week from one that just got there.
+#
+# Samples are kept in a memory-mapped file of fixed-size slots, one slot
+# per instance, so memory and disk use are bounded by max_instances and
+# the history survives restarts.  Each slot holds one ring buffer per
+# resolution (1 minute for 6 hours, 15 minutes for 7 days); a ring
+# position holds the bucket number it was last written for, a sample
+# count and a float32 per metric, the running mean of the samples that
+# fell in that bucket.  Reading a ring only returns positions whose
+# bucket is in the window, so stale positions never need clearing.
+#
+# One process (the first to take the lock on <path>.lock) samples;
+# every worker maps the same file and can serve the history.
+
+METRICS = ['cpu_sys', 'cpu_user', 'cpu_wait', 'load1', 'load5', 'load15',
+           'mem', 'swap', 'disk_system', 'disk_ephemeral', 'disk_persistent']
+RESOLUTIONS = [(60, 360),       # (seconds per bucket, buckets): 1 min for 6 h
+               (900, 672)]      # 15 min for 7 d
+
+MAGIC = b'OPVH'
+HEADER = struct.Struct('<4sIQ')     # magic, layout checksum, index generation
+HEADER_SIZE = 64
+ENTRY = struct.Struct('<120sd')     # instance key, last seen
+FORGET = 7 * 86400                  # instances not seen for this long give up their slot
+
+
+def align(n):
+    return (n + 7) // 8 * 8
+
+
+def metric_value(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def metrics_from_vitals(vitals):
+    '''the METRICS of a BOSH instance vitals record, as floats (nan when missing)'''
+    cpu = vitals.get('cpu') or {}
+    load = list(vitals.get('load') or []) + [None, None, None]
+    disk = vitals.get('disk') or {}
+    return [metric_value(cpu.get('sys')),
+            metric_value(cpu.get('user')),
+            metric_value(cpu.get('wait')),
+            metric_value(load[0]),
+            metric_value(load[1]),
+            metric_value(load[2]),
+            metric_value((vitals.get('mem') or {}).get('percent')),
+            metric_value((vitals.get('swap') or {}).get('percent')),
+            metric_value((disk.get('system') or {}).get('percent')),
+            metric_value((disk.get('ephemeral') or {}).get('percent')),
+            metric_value((disk.get('persistent') or {}).get('percent'))]
+
+
+def instance_key(deployment, job, instance_id):
+    return '{}/{}/{}'.format(deployment, job, instance_id)
+
+
+class Ring(object):
+    '''views of one resolution's ring buffer in a slot'''
+    def __init__(self, view, offset, step, size):
+        n_metrics = len(METRICS)
+        self.step = step
+        self.size = size
+        self.buckets = view[offset:offset + 8 * size].cast('q')
+        offset = align(offset + 8 * size)
+        self.counts = view[offset:offset + 4 * size].cast('f')
+        offset = align(offset + 4 * size)
+        self.values = view[offset:offset + 4 * size * n_metrics].cast('f')
+
+    @staticmethod
+    def nbytes(size):
+        return align(8 * size) + align(4 * size) + align(4 * size * len(METRICS))
+
+    def add(self, now, sample):
+        n_metrics = len(METRICS)
+        bucket = int(now // self.step)
+        pos = bucket % self.size
+        base = pos * n_metrics
+        if self.buckets[pos] != bucket:
+            self.buckets[pos] = bucket
+            self.counts[pos] = 1
+            for i, v in enumerate(sample):
+                self.values[base + i] = v
+            return
+        count = self.counts[pos] + 1
+        self.counts[pos] = count
+        for i, v in enumerate(sample):
+            mean = self.values[base + i]
+            if math.isnan(mean):
+                self.values[base + i] = v
+            elif not math.isnan(v):
+                self.values[base + i] = mean + (v - mean) / count
+
+    def series(self, now, metric, points):
+        '''array of the last points buckets of metric (nan where there's no sample)'''
+        n_metrics = len(METRICS)
+        points = min(points, self.size)
+        last = int(now // self.step)
+        out = array.array('f', [math.nan]) * points
+        for i, bucket in enumerate(range(last - points + 1, last + 1)):
+            pos = bucket % self.size
+            if self.buckets[pos] == bucket:
+                out[i] = self.values[pos * n_metrics + metric]
+        return out
+
+
+class VitalsHistory(object):
+    '''VitalsHistory(director, path, max_instances=2048) - sampled instance vitals history'''
+    def __init__(self, director, path, **kwargs):
+        self.director = director
+        self.path = path
+        self.debug = director.debug
+        self.max_instances = 2048
+        if 'max_instances' in kwargs and kwargs['max_instances']:
+            self.max_instances = kwargs['max_instances']
+        self.slot_size = sum([Ring.nbytes(size) for step, size in RESOLUTIONS])
+        self.data_offset = align(HEADER_SIZE + ENTRY.size * self.max_instances)
+        self.lock = threading.Lock()
+        self.writer = False
+        self.lock_fd = None         # held by the sampler
+        self.slots = dict()         # instance key -> slot
+        self.generation = None
+        self.__open()
+
+    def __layout(self):
+        return zlib.crc32(repr((METRICS, RESOLUTIONS, self.max_instances)).encode())
+
+    def __initialized(self):
+        magic, layout, generation = HEADER.unpack(os.pread(self.fd, HEADER.size, 0).ljust(HEADER.size, b'\0'))
+        return magic == MAGIC and layout == self.__layout()
+
+    def __open(self):
+        size = self.data_offset + self.slot_size * self.max_instances
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if not self.__initialized():
+            # the data file's lock is only held while a worker sets the file
+            # up; the sampler is elected on the .lock file, so this never
+            # waits on it
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if not self.__initialized():
+                    if os.fstat(self.fd).st_size:
+                        print("vitals history: layout of {} changed, starting over".format(self.path),
+                              file=sys.stderr)
+                    # sparse: only the slots in use take disk space
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, HEADER.pack(MAGIC, self.__layout(), 1), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, size)
+        self.view = memoryview(self.mm)
+        self.rings = dict()     # slot -> [Ring per resolution]
+
+    def close(self):
+        with self.lock:
+            self.rings = dict()
+            self.view.release()
+            self.mm.close()
+            os.close(self.fd)
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+                self.writer = False
+
+    def __rings(self, slot):
+        if slot not in self.rings:
+            offset = self.data_offset + slot * self.slot_size
+            rings = list()
+            for step, size in RESOLUTIONS:
+                rings.append(Ring(self.view, offset, step, size))
+                offset += Ring.nbytes(size)
+            self.rings[slot] = rings
+        return self.rings[slot]
+
+    def __entry(self, slot):
+        key, seen = ENTRY.unpack_from(self.mm, HEADER_SIZE + slot * ENTRY.size)
+        return key.rstrip(b'\0').decode(), seen
+
+    def __load_index(self):
+        '''re-read the instance index if another process changed it'''
+        magic, layout, generation = HEADER.unpack_from(self.mm, 0)
+        if generation == self.generation:
+            return
+        slots = dict()
+        for slot in range(self.max_instances):
+            key, seen = self.__entry(slot)
+            if key:
+                slots[key] = slot
+        self.slots = slots
+        self.generation = generation
+
+    def __bump_generation(self):
+        magic, layout, generation = HEADER.unpack_from(self.mm, 0)
+        HEADER.pack_into(self.mm, 0, magic, layout, generation + 1)
+        self.generation = generation + 1
+
+    def __slot(self, key, now):
+        '''the slot of key, allocating (or reusing the stalest) one if need be'''
+        slot = self.slots.get(key)
+        if slot is None:
+            used = set(self.slots.values())
+            free = [s for s in range(self.max_instances) if s not in used]
+            if free:
+                slot = free[0]
+            else:
+                slot = min(self.slots.values(), key=lambda s: self.__entry(s)[1])
+                self.slots.pop(self.__entry(slot)[0], None)
+            for ring in self.__rings(slot):
+                for i in range(ring.size):
+                    ring.buckets[i] = -1
+            self.slots[key] = slot
+            self.__bump_generation()
+        ENTRY.pack_into(self.mm, HEADER_SIZE + slot * ENTRY.size, key.encode()[:ENTRY.size - 8], now)
+        return slot
+
+    def record(self, deployment, vitals, now=None):
+        '''record(deployment, instance vitals records) - add a sample for each instance'''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.__load_index()
+            for inst in vitals:
+                if not inst.get('vitals') or not inst.get('job_name') or not inst.get('id'):
+                    continue
+                sample = metrics_from_vitals(inst['vitals'])
+                slot = self.__slot(instance_key(deployment, inst['job_name'], inst['id']), now)
+                for ring in self.__rings(slot):
+                    ring.add(now, sample)
+
+    def expire(self, now=None):
+        '''free the slots of instances not seen for FORGET seconds'''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.__load_index()
+            stale = [(k, s) for k, s in self.slots.items() if self.__entry(s)[1] < now - FORGET]
+            for key, slot in stale:
+                ENTRY.pack_into(self.mm, HEADER_SIZE + slot * ENTRY.size, b'', 0)
+                self.slots.pop(key, None)
+            if stale:
+                self.__bump_generation()
+
+    def sample(self):
+        '''fetch every deployment's vitals and record them; run from the scheduler'''
+        if not self.writer:
+            # one sampler for all the workers sharing the file, elected on a
+            # lock file of its own; it holds the lock until it closes
+            if self.lock_fd is None:
+                self.lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.writer = True
+            except OSError:
+                return
+        deployments = list(self.director.deployments)
+        # on the background pool, so a sample never holds up the pages
+        fetched = self.director.fan_out(self.director.get_deployment_vitals, deployments,
+                                        timeout=RESOLUTIONS[0][0],
+                                        executor=self.director.background)
+        now = time.time()
+        for deployment, vitals in fetched.items():
+            if isinstance(vitals, list):
+                self.record(deployment, vitals, now)
+        self.expire(now)
+        self.mm.flush()
+        if self.debug:
+            print("vitals history: {} instances".format(len(self.slots)))
+
+    def __series(self, key, metric, resolution, points, now):
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return self.__rings(slot)[resolution].series(now, METRICS.index(metric), points)
+
+    def history(self, deployment, job, instance_id, resolution=0, metrics=None, now=None):
+        '''history(deployment, job, id, resolution index, metrics) - the instance's series,
+        {step, start, metrics: {name: [value or None, ...]}}, or None if it has none'''
+        if now is None:
+            now = time.time()
+        if metrics is None:
+            metrics = METRICS
+        if resolution not in range(len(RESOLUTIONS)) or [m for m in metrics if m not in METRICS]:
+            raise ValueError('unknown resolution or metric')
+        step, size = RESOLUTIONS[resolution]
+        key = instance_key(deployment, job, instance_id)
+        result = {'step': step,
+                  'start': (int(now // step) - size + 1) * step,
+                  'metrics': dict()}
+        with self.lock:
+            self.__load_index()
+            if key not in self.slots:
+                return None
+            for m in metrics:
+                result['metrics'][m] = compact(self.__series(key, m, resolution, size, now))
+        return result
+
+    def sparklines(self, deployment, metric='mem', resolution=0, points=60, now=None):
+        '''sparklines(deployment, metric) - {"job/id": [value or None, ...]} of the last points buckets'''
+        if now is None:
+            now = time.time()
+        prefix = deployment + '/'
+        lines = dict()
+        with self.lock:
+            self.__load_index()
+            for key in self.slots:
+                if key.startswith(prefix):
+                    lines[key[len(prefix):]] = compact(self.__series(key, metric, resolution, points, now))
+        return lines
+
+
+def compact(series):
+    '''series values rounded for JSON, None where there's no sample'''
+    return [None if math.isnan(v) else round(v, 1) for v in series]
+
+
+def sparkline_svg(values, width=80, height=16):
+    '''an inline SVG polyline of values (None are gaps), scaled to 0..100'''
+    if not values or all([v is None for v in values]):
+        return ''
+    step = width / max(len(values) - 1, 1)
+    lines = list()
+    points = list()
+    for i, v in enumerate(values):
+        if v is None:
+            if points:
+                lines.append(points)
+            points = list()
+            continue
+        y = height - min(max(v, 0), 100) * height / 100
+        points.append('{:.1f},{:.1f}'.format(i * step, y))
+    if points:
+        lines.append(points)
+    return ('<svg width="{}" height="{}" class="sparkline">'.format(width, height) +
+            ''.join(['<polyline fill="none" stroke="currentColor" points="{}"/>'.format(' '.join(p))
+                     for p in lines]) +
+            '</svg>')
@@ -0,0 +1,159 @@
+import base64
+import bisect
+import json
+import re
+
+# Queries over a deployment's vitals records, for automation that only
+# needs a few fields of a few instances: fields= picks (dotted) fields,
+# sort= orders by any of them, filter= keeps matching instances, and
+# results come a page at a time with an opaque cursor.  The cursor holds
+# the sort key of the last instance returned, so paging stays consistent
+# when instances come and go between requests.
+
+# short names for the usual fields
+ALIASES = {'cpu_sys': 'vitals.cpu.sys',
+           'cpu_user': 'vitals.cpu.user',
+           'cpu_wait': 'vitals.cpu.wait',
+           'load1': 'vitals.load.0',
+           'load5': 'vitals.load.1',
+           'load15': 'vitals.load.2',
+           'mem': 'vitals.mem.percent',
+           'swap': 'vitals.swap.percent',
+           'disk': 'vitals.disk.system.percent',
+           'ephemeral': 'vitals.disk.ephemeral.percent',
+           'persistent': 'vitals.disk.persistent.percent',
+           'ip': 'ips.0'}
+DEFAULT_FIELDS = ['job_name', 'id', 'job_state', 'ips', 'vitals']
+PAGE = 100
+MAX_PAGE = 1000
+
+FILTER = re.compile(r'^\s*([\w.]+)\s*(==|!=|>=|<=|=|>|<|~)\s*(.*?)\s*$')
+
+
+def lookup(record, field):
+    '''lookup(record, "vitals.mem.percent") - the value at a dotted path (list indexes
+    allowed), or None'''
+    value = record
+    for part in ALIASES.get(field, field).split('.'):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+
+def number(value):
+    '''value as a float, or None if it isn't numeric'''
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sort_value(value, descending=False):
+    '''a comparable form of value: numbers before strings, missing values last
+    (in either direction)'''
+    n = number(value)
+    if n is not None:
+        return (0, -n if descending else n, [])
+    if value is None or isinstance(value, (dict, list)):
+        return (2, 0, [])
+    # code points, so descending order can negate them; the final 1
+    # sorts a string after its prefixes when descending
+    text = [-ord(c) for c in str(value)] + [1] if descending else [ord(c) for c in str(value)]
+    return (1, 0, text)
+
+
+def compile_filter(spec):
+    '''compile_filter("mem>80") - a predicate on records; raises ValueError
+
+    Operators are = (or ==), !=, >, >=, <, <= and ~ (regular expression
+    search).  Comparisons are numeric when both sides are numbers.'''
+    m = FILTER.match(spec)
+    if m is None:
+        raise ValueError('bad filter: ' + spec)
+    field, op, operand = m.groups()
+    if op == '~':
+        try:
+            regex = re.compile(operand)
+        except re.error as e:
+            raise ValueError('bad filter {}: {}'.format(spec, e))
+        return lambda r: lookup(r, field) is not None and regex.search(str(lookup(r, field))) is not None
+    want = number(operand)
+
+    def predicate(record):
+        value = lookup(record, field)
+        have = number(value)
+        if want is not None and have is not None:
+            a, b = have, want
+        elif op in ('=', '==', '!='):
+            a, b = ('' if value is None else str(value)), operand
+        else:
+            return False
+        if op in ('=', '=='):
+            return a == b
+        if op == '!=':
+            return a != b
+        if op == '>':
+            return a > b
+        if op == '>=':
+            return a >= b
+        if op == '<':
+            return a < b
+        return a <= b
+    return predicate
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        # json turned the key's tuples into lists
+        return tuple([(k[0], k[1], list(k[2])) for k in key])
+    except (ValueError, TypeError, IndexError, KeyError):
+        raise ValueError('bad cursor')
+
+
+def project(record, fields):
+    '''the given fields of record, keyed by field name'''
+    return dict([(f, lookup(record, f)) for f in fields])
+
+
+def query(records, fields=None, sort=None, filters=None, limit=PAGE, cursor=None):
+    '''query(vitals records, fields, sort, filters, limit, cursor) -
+    {"count": matching, "data": [projected records], "next": cursor or None}
+
+    sort is a list of fields, each optionally prefixed with - for
+    descending; job_name and id always break ties.  Raises ValueError on
+    a bad filter or cursor.'''
+    fields = fields or DEFAULT_FIELDS
+    sort = list(sort or []) + ['job_name', 'id']
+    predicates = [compile_filter(f) for f in filters or []]
+    limit = max(1, min(limit or PAGE, MAX_PAGE))
+    keyed = list()
+    for r in records:
+        if not all([p(r) for p in predicates]):
+            continue
+        key = tuple([sort_value(lookup(r, s.lstrip('-')), s.startswith('-')) for s in sort])
+        keyed.append((key, r))
+    keyed.sort(key=lambda kr: kr[0])
+    start = 0
+    if cursor:
+        after = decode_cursor(cursor)
+        start = bisect.bisect_right([k for k, r in keyed], after)
+    page = keyed[start:start + limit]
+    next_cursor = None
+    if start + limit < len(keyed):
+        next_cursor = encode_cursor(page[-1][0])
+    return {'count': len(keyed),
+            'data': [project(r, fields) for k, r in page],
+            'next': next_cursor}
@@ -0,0 +1,138 @@
+import warnings
+import math
+import array
+from opcon.modules import vitalshistory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Per instance group summaries of a deployment's vitals, for triaging a
+# large deployment from one screen: mean, median, 95th percentile and
+# maximum of every metric for each job, and the instances whose value is
+# more than z standard deviations from their group's mean.
+#
+# The records are turned into columns (one float per instance per
+# metric), and each group's statistics are computed over whole columns:
+# with numpy when it is installed, otherwise with array.array columns
+# and sorted() - same results, just slower on very large deployments.
+
+METRICS = vitalshistory.METRICS
+STATS = ['mean', 'p50', 'p95', 'max']
+Z_THRESHOLD = 3.0
+
+
+def columns(vitals):
+    '''columns(vitals records) - (job names, instance ids, {metric: array of floats})
+
+    Instances without a VM (or vitals) are left out; missing values are nan.'''
+    jobs = list()
+    ids = list()
+    cols = [array.array('d') for m in METRICS]
+    for inst in vitals:
+        if inst.get('vm_cid') is None or not inst.get('vitals'):
+            continue
+        jobs.append(inst.get('job_name') or '')
+        ids.append(inst.get('id') or '')
+        for col, v in zip(cols, vitalshistory.metrics_from_vitals(inst['vitals'])):
+            col.append(v)
+    return jobs, ids, dict(zip(METRICS, cols))
+
+
+def rounded(v):
+    return None if v is None or math.isnan(v) else round(float(v), 2)
+
+
+def percentile(ordered, q):
+    '''q'th percentile of sorted values, interpolated linearly (as numpy does)'''
+    k = (len(ordered) - 1) * q / 100.0
+    lo = int(math.floor(k))
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def group_python(values):
+    '''(stats, mean, std) of one group's column, nan ignored'''
+    present = sorted([v for v in values if not math.isnan(v)])
+    if not present:
+        return dict([(s, None) for s in STATS]), math.nan, math.nan
+    mean = math.fsum(present) / len(present)
+    std = math.sqrt(math.fsum([(v - mean) ** 2 for v in present]) / len(present))
+    stats = {'mean': mean, 'p50': percentile(present, 50), 'p95': percentile(present, 95),
+             'max': present[-1]}
+    return stats, mean, std
+
+
+def summarize_python(jobs, ids, cols, z):
+    groups = dict()
+    for i, job in enumerate(jobs):
+        groups.setdefault(job, list()).append(i)
+    summary = list()
+    outliers = list()
+    for job in sorted(groups):
+        rows = groups[job]
+        entry = {'job_name': job, 'count': len(rows), 'metrics': dict()}
+        for m in METRICS:
+            values = [cols[m][i] for i in rows]
+            stats, mean, std = group_python(values)
+            entry['metrics'][m] = dict([(s, rounded(v)) for s, v in stats.items()])
+            if not std > 0:
+                continue
+            for i, v in zip(rows, values):
+                score = (v - mean) / std
+                if abs(score) >= z:
+                    outliers.append({'job_name': job, 'id': ids[i], 'metric': m,
+                                     'value': rounded(v), 'z': rounded(score)})
+        summary.append(entry)
+    return summary, outliers
+
+
+def summarize_numpy(jobs, ids, cols, z):
+    data = numpy.column_stack([numpy.frombuffer(cols[m], dtype=numpy.float64) for m in METRICS])
+    names = numpy.array(jobs, dtype=object)
+    order = numpy.argsort(names, kind='stable')
+    groups, starts = numpy.unique(names[order], return_index=True)
+    ends = list(starts[1:]) + [len(order)]
+    summary = list()
+    outliers = list()
+    with warnings.catch_warnings(), numpy.errstate(invalid='ignore', divide='ignore'):
+        # all-nan columns (no persistent disk, say) just give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for job, start, end in zip(groups, starts, ends):
+            rows = order[start:end]
+            g = data[rows]
+            mean = numpy.nanmean(g, axis=0)
+            p50, p95 = numpy.nanpercentile(g, [50, 95], axis=0)
+            high = numpy.nanmax(g, axis=0)
+            std = numpy.nanstd(g, axis=0)
+            # a column of equal values can come out with a rounding-error std
+            # rather than 0; that is no spread at all, not a huge z
+            spread = std > 1e-9 * numpy.maximum(numpy.abs(mean), 1)
+            scores = (g - mean) / numpy.where(spread, std, numpy.nan)
+            entry = {'job_name': job, 'count': int(end - start), 'metrics': dict()}
+            for j, m in enumerate(METRICS):
+                entry['metrics'][m] = {'mean': rounded(mean[j]), 'p50': rounded(p50[j]),
+                                       'p95': rounded(p95[j]), 'max': rounded(high[j])}
+            for r, j in zip(*numpy.nonzero(numpy.abs(scores) >= z)):
+                outliers.append({'job_name': job, 'id': ids[rows[r]], 'metric': METRICS[j],
+                                 'value': rounded(g[r, j]), 'z': rounded(scores[r, j])})
+            summary.append(entry)
+    return summary, outliers
+
+
+def summarize(vitals, z=Z_THRESHOLD):
+    '''summarize(vitals records, z) - {"jobs": [per job stats], "outliers": [...], "instances": n}
+
+    An outlier is an instance whose metric is at least z standard
+    deviations from its job's mean; outliers are listed worst first.'''
+    jobs, ids, cols = columns(vitals)
+    if numpy is not None and len(jobs):
+        summary, outliers = summarize_numpy(jobs, ids, cols, z)
+    else:
+        summary, outliers = summarize_python(jobs, ids, cols, z)
+    outliers.sort(key=lambda o: -abs(o['z']))
+    return {'instances': len(jobs),
+            'jobs': summary,
+            'outliers': outliers,
+            'z': z}
@@ -0,0 +1,39 @@
+import tarfile
+import io
+from unittest.mock import MagicMock
+
+# Test data shared by several test modules.
+
+
+def tar_bytes(files, compress=True):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz' if compress else 'w') as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def chunked(data, size=7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def instance(job, iid, mem, state='running', cpu_user='1.0', vm_cid='vm-1'):
+    '''a `bosh vms --vitals` record'''
+    return {'job_name': job, 'id': iid, 'job_state': state, 'vm_cid': vm_cid,
+            'ips': ['10.0.0.{}'.format(mem)],
+            'vitals': {'cpu': {'sys': '0.5', 'user': cpu_user, 'wait': '0.0'},
+                       'load': ['0.1', '0.2', '0.3'],
+                       'mem': {'kb': '1000', 'percent': str(mem)},
+                       'swap': {'kb': '0', 'percent': '0'},
+                       'disk': {'system': {'percent': '40'}, 'ephemeral': {'percent': '10'}}}}
+
+
+def response(payload):
+    '''a successful director response with a JSON payload'''
+    r = MagicMock()
+    r.ok = True
+    r.json.return_value = payload
+    return r
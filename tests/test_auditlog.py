@@ -0,0 +1,112 @@
+import unittest
+import tempfile
+import json
+import os
+import time
+from unittest.mock import patch
+from opcon.modules import auditlog
+
+
+class TestAuditLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = os.path.join(self.tmpdir.name, 'audit.spool')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def new_auditlog(self, **kwargs):
+        with patch('opcon.modules.auditlog.threading.Thread'), \
+             patch('opcon.modules.auditlog.atexit.register'):
+            return auditlog.AuditLog('opcon,audit,user,pass,https://audit.example.com',
+                                     extra_fields='{"custom": "value"}',
+                                     spool_file=self.spool,
+                                     max_retries=0,
+                                     **kwargs)
+
+    def test_auditlog_test_mode(self):
+        alog = auditlog.AuditLog('opcon,audit,user,pass,https://audit.example.com', test=True)
+        alog.send({'path': '/'})
+        self.assertEqual(alog.active, True)
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_batches(self, mock_post):
+        mock_post.return_value.ok = True
+        alog = self.new_auditlog(batch_size=2)
+        # send() only queues
+        alog.send({'path': '/'})
+        alog.send({'path': '/bosh'})
+        self.assertEqual(mock_post.call_count, 0)
+        alog.flush()
+        # starting message plus two records, in batches of two
+        self.assertEqual(mock_post.call_count, 2)
+        batch = mock_post.call_args_list[0].kwargs['json']
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch[1]['custom'], 'value')
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_spool_replay(self, mock_post):
+        mock_post.return_value.ok = False
+        alog = self.new_auditlog(batch_size=10)
+        alog.send({'path': '/'})
+        alog.flush()
+        with open(self.spool) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        # endpoint is back: the next batch is sent, then the spool
+        mock_post.return_value.ok = True
+        alog.send({'path': '/bosh'})
+        alog.flush()
+        self.assertFalse(os.path.exists(self.spool))
+        replayed = mock_post.call_args_list[-1].kwargs['json']
+        self.assertEqual([r.get('path') for r in replayed], [None, '/'])
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_bad_spool(self, mock_post):
+        with open(self.spool, 'w') as f:
+            f.write('{"path": "/"}\n{"path": "/bo\n')
+        mock_post.side_effect = ValueError('unexpected')
+        alog = self.new_auditlog(batch_size=10)
+        # a post that raises is spooled, not raised
+        alog.flush()
+        mock_post.side_effect = None
+        mock_post.return_value.ok = True
+        alog.send({'path': '/bosh'})
+        alog.flush()
+        self.assertFalse(os.path.exists(self.spool))
+        with open(self.spool + '.bad') as f:
+            self.assertEqual(f.read(), '{"path": "/bo\n')
+        replayed = mock_post.call_args_list[-1].kwargs['json']
+        self.assertEqual([r.get('path') for r in replayed], ['/', None])
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_flush_shipper_batch(self, mock_post):
+        mock_post.return_value.ok = True
+        alog = auditlog.AuditLog('opcon,audit,user,pass,https://audit.example.com',
+                                 spool_file=self.spool, batch_size=10, flush_interval=60)
+        alog.send({'path': '/'})
+        # the shipper is holding both records, waiting for more
+        while not alog.queue.empty():
+            time.sleep(0.01)
+        self.assertEqual(mock_post.call_count, 0)
+        alog.flush()
+        self.assertFalse(alog.shipper.is_alive())
+        shipped = mock_post.call_args_list[0].kwargs['json']
+        self.assertEqual([r.get('path') for r in shipped], [None, '/'])
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_spool_mode(self, mock_post):
+        mock_post.return_value.ok = False
+        alog = self.new_auditlog()
+        alog.flush()
+        self.assertEqual(os.stat(self.spool).st_mode & 0o777, 0o600)
+
+    @patch('opcon.modules.auditlog.requests.Session.post')
+    def test_auditlog_queue_overflow(self, mock_post):
+        alog = self.new_auditlog(queue_size=1)
+        alog.send({'path': '/'})
+        with open(self.spool) as f:
+            self.assertEqual(json.loads(f.readline())['path'], '/')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import tempfile
+import threading
+import time
+import os
+from unittest.mock import MagicMock
+from opcon.modules import blobcache
+
+
+class SlowDirector(object):
+    '''a director whose /resources download is released chunk by chunk'''
+    def __init__(self, chunks, ok=True):
+        self.chunks = chunks
+        self.ok = ok
+        self.release = threading.Semaphore(0)
+        self.streams = 0
+
+    def stream(self, path, params=None):
+        self.streams += 1
+        r = MagicMock()
+        r.ok = self.ok
+        r.status_code = 200 if self.ok else 404
+        return r
+
+    def iter_stream(self, r, chunk_size=None):
+        for chunk in self.chunks:
+            self.release.acquire()
+            yield chunk
+
+
+class TestBlobCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = blobcache.BlobCache(self.tmpdir.name, max_bytes=10, stall=5)
+        self.cache.poll = 0.01
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_path(self):
+        self.assertTrue(self.cache.path('5b5b-0a1f').endswith('5b5b-0a1f'))
+        self.assertIsNone(self.cache.path('../etc'))
+        self.assertIsNone(self.cache.path('a/b'))
+        self.assertEqual(self.cache.fetch(SlowDirector([]), '.hidden'), (None, None))
+
+    def test_shared_fetch(self):
+        director = SlowDirector([b'abc', b'def'])
+        cached, first = self.cache.fetch(director, 'blob1')
+        self.assertIsNone(cached)
+        # a second download while the first is still in progress
+        cached, second = self.cache.fetch(director, 'blob1')
+        self.assertIsNone(cached)
+        director.release.release()
+        self.assertEqual(next(first), b'abc')
+        self.assertEqual(next(second), b'abc')
+        director.release.release()
+        self.assertEqual(b''.join(first), b'def')
+        self.assertEqual(b''.join(second), b'def')
+        self.assertEqual(director.streams, 1)
+        cached, body = self.cache.fetch(director, 'blob1')
+        self.assertIsNone(body)
+        with open(cached, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+        self.assertEqual(director.streams, 1)
+
+    def test_failed_fetch(self):
+        director = SlowDirector([], ok=False)
+        cached, body = self.cache.fetch(director, 'missing')
+        with self.assertRaises(IOError):
+            list(body)
+        self.assertIsNone(self.cache.lookup('missing'))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_cleanup(self):
+        for name in ['old', 'new']:
+            with open(os.path.join(self.tmpdir.name, name), 'wb') as f:
+                f.write(b'123')
+        with open(os.path.join(self.tmpdir.name, 'gone.tmp'), 'wb') as f:
+            f.write(b'123')
+        past = time.time() - 2 * self.cache.ttl
+        os.utime(os.path.join(self.tmpdir.name, 'old'), (past, past))
+        os.utime(os.path.join(self.tmpdir.name, 'gone.tmp'), (past, past))
+        self.cache.cleanup()
+        self.assertEqual(os.listdir(self.tmpdir.name), ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,8 @@
 import flask_unittest
 import unittest
+import requests
 from flask import Flask
-from opcon.bosh.bosh_bp import bosh_bp
+from opcon.bosh.bosh_bp import bosh_bp, bosh_director_error
 from opcon.modules import auth
 
 
@@ -71,6 +72,11 @@ class TestConfig(flask_unittest.AppTestCase):
             # should be redirect to task job
             self.assertEqual(rv.status_code, 302)
 
+    def test_bosh_bp_task_events(self, app):
+        with app.test_client() as client:
+            rv = client.get('/bosh/tasks/events')
+            self.assertEqual(rv.status_code, 302)
+
     def test_bosh_bp_download_logs(self, app):
         with app.test_client() as client:
             rv = client.get('/bosh/tasks/42')
@@ -101,3 +107,14 @@ class TestConfig(flask_unittest.AppTestCase):
             rv = client.get('/bosh/deployment/cf/errand/smoke_test/run')
             print("RV code {} and {}".format(rv.status_code, rv))
             self.assertEqual(rv.status_code, 302)
+
+    def test_bosh_bp_director_error(self, app):
+        with app.app_context():
+            rv = bosh_director_error(requests.HTTPError('director login failed (401)'))
+        self.assertEqual(rv.status_code, 502)
+
+    def test_bosh_bp_get_deployment_vitals_result(self, app):
+        with app.test_client() as client:
+            rv = client.get('/bosh/deployment/vitals/111')
+            print("RV code {} and {}".format(rv.status_code, rv))
+            self.assertEqual(rv.status_code, 302)
@@ -0,0 +1,92 @@
+import unittest
+import threading
+import requests
+from unittest.mock import patch, MagicMock
+from opcon.modules import director
+from opcon.modules import statestore
+from opcon.modules import bulkaction
+
+
+class SyncThread(threading.Thread):
+    '''runs the bulk action in the test's thread (other threads as usual)'''
+    def start(self):
+        if self.name.startswith('bulk-'):
+            self.run()
+        else:
+            super().start()
+
+
+def action_response(task_id):
+    r = MagicMock()
+    r.status_code = 302
+    r.headers = {'Location': 'https://192.168.50.6:25555/tasks/{}'.format(task_id)}
+    return r
+
+
+JOBS = ['api/a1', 'diego_cell/c1', 'diego_cell/c2', 'diego_cell/c3']
+
+
+class TestBulkAction(unittest.TestCase):
+    def setUp(self):
+        self.director = director.Director('https://192.168.0.0:25555',
+                                          'admin',
+                                          'nothing',
+                                          debug=False,
+                                          verify_tls=False)
+        self.director.deployments = ['cf', 'zookeeper']
+        self.director.session = requests.Session()
+        self.director.get_deployment_jobs = MagicMock(return_value=JOBS)
+        self.bulk = bulkaction.BulkActions(self.director, statestore.MemoryStore(),
+                                           max_in_flight=2, canaries=1)
+
+    def test_expand_selection(self):
+        self.assertEqual(bulkaction.expand_selection(['diego_cell/*', 'diego_cell/c1', 'api/a1'], JOBS),
+                         ['diego_cell/c1', 'diego_cell/c2', 'diego_cell/c3', 'api/a1'])
+        self.assertEqual(bulkaction.expand_selection(['*'], JOBS), JOBS)
+
+    def test_readonly(self):
+        self.director.readonly = True
+        with self.assertRaises(PermissionError):
+            self.bulk.start('cf', 'restart', ['diego_cell/*'])
+        self.assertEqual(self.director.instance_action('cf', 'api', 'a1', 'restart'),
+                         (False, 'administratively denied'))
+
+    def test_bad_request(self):
+        with self.assertRaises(ValueError):
+            self.bulk.start('cf', 'explode', ['diego_cell/*'])
+        with self.assertRaises(ValueError):
+            self.bulk.start('notthere', 'restart', ['diego_cell/*'])
+        with self.assertRaises(ValueError):
+            self.bulk.start('cf', 'restart', ['router/*'])
+
+    @patch('opcon.modules.bulkaction.threading.Thread', SyncThread)
+    @patch('opcon.modules.director.requests.Session.post')
+    def test_bulk_restart(self, mock_post):
+        mock_post.side_effect = [action_response(n) for n in (1, 2, 3)]
+        self.director.task_wait_ready = MagicMock(return_value={'state': 'done'})
+        started = self.bulk.start('cf', 'restart', ['diego_cell/*'])
+        self.assertEqual(started['total'], 3)
+        progress = self.bulk.get(started['id'])
+        self.assertEqual(progress['state'], 'done')
+        self.assertEqual(progress['counts']['done'], 3)
+        self.assertEqual(progress['percent'], 100)
+        self.assertEqual(sorted([i['task'] for i in progress['instances']]),
+                         ['/tasks/1', '/tasks/2', '/tasks/3'])
+        self.assertTrue(mock_post.call_args_list[0].args[0].endswith(
+            '/deployments/cf/instance_groups/diego_cell/c1/actions/restart'))
+
+    @patch('opcon.modules.bulkaction.threading.Thread', SyncThread)
+    @patch('opcon.modules.director.requests.Session.post')
+    def test_bulk_canary_fails(self, mock_post):
+        mock_post.return_value = action_response(1)
+        self.director.task_wait_ready = MagicMock(return_value={'state': 'error'})
+        started = self.bulk.start('cf', 'recreate', ['diego_cell/*'])
+        progress = self.bulk.get(started['id'])
+        self.assertEqual(progress['state'], 'failed')
+        self.assertEqual(progress['counts'], {'pending': 0, 'running': 0, 'done': 0,
+                                              'failed': 1, 'skipped': 2})
+        self.assertEqual(mock_post.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
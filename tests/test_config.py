@@ -49,6 +49,25 @@ class TestConfig(unittest.TestCase):
         nonevar = self.config['nothere']
         self.assertEqual(nonevar, None)
 
+    def test_config_errands_acls(self):
+        acls = self.config.get('errands_acls')
+        self.assertEqual(acls.filter('cf', ['smoke-tests', 'smoke-tests']), ['smoke-tests'])
+
+    def test_config_directors(self):
+        self.assertEqual(self.config['o_director_name'], 'default')
+        self.assertEqual(self.config['o_directors'],
+                         [{'name': 'lab', 'url': 'https://127.0.0.1:25556',
+                           'user': 'username', 'pass': 'password', 'timeo': 30,
+                           'verify_tls': False, 'readonly': True}])
+
+    def test_config_opt_in(self):
+        # background jobs that write to disk are off without their sections
+        self.assertEqual(self.config['o_vitals_history'], '')
+        self.assertEqual(self.config['o_output_cache_dir'], '')
+        self.assertEqual(self.config['o_blob_cache_dir'], '')
+        self.assertEqual(self.config['o_metrics_enable'], False)
+        self.assertEqual(self.config['o_inventory_interval'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,9 @@
 import unittest
+import concurrent.futures
 import json
+import time
 import requests
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from opcon.modules import director
 
 
@@ -22,6 +24,35 @@ class TestDirector(unittest.TestCase):
     def test_director(self):
         self.assertNotEqual(self.director, None)
 
+    @patch('opcon.modules.director.time.sleep')
+    def test_director_task_wait_ready_deadline(self, mock_sleep):
+        self.director.session = MagicMock()
+        self.director.session.get.return_value.json.return_value = {'state': 'processing'}
+        # the watcher used up the time: one look at the task, no more waiting
+        self.director.task_watcher = MagicMock()
+        clock = [100]
+
+        def wait(url, timeout):
+            clock[0] += timeout
+        self.director.task_watcher.wait.side_effect = wait
+        with patch('opcon.modules.director.time.time', side_effect=lambda: clock[0]):
+            task = self.director.task_wait_ready('/tasks/1', timeout=10)
+        self.assertEqual(task['state'], 'processing')
+        self.assertEqual(self.director.session.get.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    def test_director_keeps_pending_tasks(self):
+        self.director.save_pending_task(director.task_logs(director.TASK_LOGS, 'cf router', '/tasks/112'))
+        other = director.Director('https://192.168.0.0:25555', 'admin', 'nothing',
+                                  store=self.director.store)
+        self.assertEqual([t.t_url for t in other.pending_tasks], ['/tasks/112'])
+        # another director's tasks are its own
+        lab = director.Director('https://192.168.1.0:25555', 'admin', 'nothing', name='lab',
+                                store=self.director.store)
+        self.assertEqual(lab.pending_tasks, [])
+        lab.pending_tasks = list()
+        self.assertEqual(len(other.pending_tasks), 1)
+
     @patch('opcon.modules.director.requests.get')
     def test_director_connect(self, mock_get):
         mock_get.return_value.status_code.return_value = 200
@@ -53,6 +84,46 @@ class TestDirector(unittest.TestCase):
         self.director.refresh_token()
         self.assertEqual(self.director.oauth['expires_in'], 120)
 
+    @patch('opcon.modules.director.requests.Session.post')
+    def test_director_init_auth_refused(self, mock_post):
+        mock_post.return_value.ok = False
+        mock_post.return_value.status_code = 401
+        with self.assertRaises(requests.HTTPError):
+            self.director.init_auth('https://192.168.50.6:8443', 'admin', 'wrong')
+
+    @patch('opcon.modules.director.requests.Session.post')
+    def test_director_session_reauthorize(self, mock_post):
+        with open('tests/data/director_oauth.json') as f:
+            oauth_d = json.load(f)
+        mock_post.return_value.json.return_value = oauth_d.copy()
+        self.director.init_auth('https://192.168.50.6:8443', 'admin', 'nothing')
+        session = self.director.session
+        self.assertIsInstance(session, director.DirectorSession)
+        stale = session.token
+        # re-login keeps the session (and its connection pool)
+        self.director.login()
+        self.assertIs(self.director.session, session)
+        # only the first caller holding the stale token refreshes it
+        mock_post.return_value.json.return_value['access_token'] = 'fresh'
+        fresh = session.on_unauthorized(stale)
+        self.assertTrue(fresh.endswith('fresh'))
+        calls = mock_post.call_count
+        self.assertEqual(session.on_unauthorized(stale), fresh)
+        self.assertEqual(mock_post.call_count, calls)
+
+    @patch('opcon.modules.director.requests.Session.post')
+    def test_director_session_reauthorize_refused(self, mock_post):
+        with open('tests/data/director_oauth.json') as f:
+            mock_post.return_value.json.return_value = json.load(f)
+        self.director.init_auth('https://192.168.50.6:8443', 'admin', 'nothing')
+        stale = self.director.session.token
+        # refresh and re-login both refused: raised to the request, not exited
+        mock_post.return_value.ok = False
+        mock_post.return_value.status_code = 401
+        with self.assertRaises(requests.HTTPError):
+            self.director.session.on_unauthorized(stale)
+        self.assertEqual(mock_post.call_count, 3)
+
     @patch('opcon.modules.director.requests.Session.get')
     def test_director_deployments(self, mock_get):
         mock_get.return_value.status_code.return_value = 200
@@ -76,6 +147,38 @@ class TestDirector(unittest.TestCase):
         stats = self.director.get_director_stats()
         self.assertEqual(len(stats), 2)
 
+    def test_director_fan_out(self):
+        def work(item):
+            if item == 'slow':
+                time.sleep(1)
+            if item == 'broken':
+                raise ValueError(item)
+            return item.upper()
+        results = self.director.fan_out(work, ['cf', 'slow', 'broken'], timeout=0.5)
+        self.assertEqual(results['cf'], 'CF')
+        self.assertEqual(results['slow'], director.FANOUT_TIMEOUT)
+        self.assertEqual(results['broken'], director.FANOUT_ERROR)
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_director_cache(self, mock_get):
+        self.director.cache = director.DirectorCache(size=2, ttls={'vms': 60, 'tasks': 60})
+        mock_get.return_value.json.return_value = [
+            {'job': 'router', 'id': 0}, {'job': 'uaa', 'id': 0}]
+        self.director.get_deployment_jobs('cf')
+        jobs = self.director.get_deployment_jobs('cf', groups=True)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(self.director.cache.hits, 1)
+        # changing the deployment drops its entries
+        self.director.invalidate('cf')
+        self.director.get_deployment_jobs('cf')
+        self.assertEqual(mock_get.call_count, 2)
+        # least recently used entries are evicted
+        self.director.get_deployment_jobs('zookeeper')
+        self.director.get_job_history(limit=4)
+        self.assertEqual(self.director.cache.stats()['entries'], 2)
+        self.assertEqual(self.director.cache.get('vms', 'cf'), None)
+
     @patch('opcon.modules.director.requests.Session.get')
     def test_director_deployment_jobs_filtered(self, mock_get):
         mock_get.return_value.status_code.return_value = 200
@@ -168,14 +271,100 @@ class TestDirector(unittest.TestCase):
     @patch('opcon.modules.director.requests.Session.get')
     def test_director_get_deployment_vitals_output(self, mock_get):
         mock_get.return_value.status_code = 200
-        mock_get.return_value.content = "\"{'agent_id': '9999-999-9999', 'job': 'router', 'cid': '888-888-face', 'state': 'running'}\"\n\"{'agent_id': '9999-999-9998', 'job': 'uaa', 'id': '888-dea-dbee', 'state': 'running'}\"".encode('utf-8')
+        mock_get.return_value.iter_lines.return_value = [
+            b'{"agent_id": "9999-999-9999", "job_name": "router", "id": "888-888-face", "job_state": "running"}',
+            b'',
+            b'{"agent_id": "9999-999-9998", "job_name": "uaa", "id": "888-dea-dbee", "job_state": "running"}']
         vitals_j = self.director.get_deployment_vitals_task_output('/task/111')
         self.assertEqual(len(vitals_j), 2)
+        vitals_g = self.director.iter_deployment_vitals_task_output('/task/111')
+        self.assertEqual(next(vitals_g)['job_name'], 'router')
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_director_get_deployment_vitals_async(self, mock_get):
+        mock_get.return_value.status_code = 302
+        mock_get.return_value.headers = {'Location': 'https://192.168.50.6:25555/tasks/111'}
+        mock_get.return_value.json.return_value = {'state': 'done'}
+        mock_get.return_value.iter_lines.return_value = [b'{"job_name": "router", "id": "888-888-face"}']
+        task_id = self.director.get_deployment_vitals_async('cf')
+        self.assertEqual(task_id, '111')
+        self.director.vitals_pending[task_id][1].result(timeout=5)
+        state, vitals = self.director.get_deployment_vitals_result(task_id)
+        self.assertEqual(state, 'done')
+        self.assertEqual(vitals[0]['job_name'], 'router')
+        # tasks submitted elsewhere are looked up on the director
+        self.director.vitals_pending = dict()
+        state, vitals = self.director.get_deployment_vitals_result(task_id)
+        self.assertEqual(state, 'done')
+        mock_get.return_value.ok = False
+        state, vitals = self.director.get_deployment_vitals_result('112')
+        self.assertEqual(state, 'unknown')
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_director_stream(self, mock_get):
+        mock_get.return_value.iter_content.return_value = iter([b'abc', b'def'])
+        r = self.director.stream('/resources/guid')
+        self.assertEqual(mock_get.call_args.kwargs['stream'], True)
+        chunks = self.director.iter_stream(r)
+        self.assertEqual(next(chunks), b'abc')
+        # client went away: the upstream connection is released
+        chunks.close()
+        r.close.assert_called_once()
 
     def test_director_oauth_expires(self):
         self.director.oauth = {'expires_in': 84600}
         self.assertEqual(84600, self.director.oauth_token_expires())
 
+    def test_director_get_deployment_vitals_cached(self):
+        d = director.Director('https://192.168.0.0:25555', 'admin', 'nothing',
+                              cache_ttls={'vitals': 30})
+        d.deployments = ['cf']
+        d.iter_deployment_vitals = MagicMock(return_value=iter([{'id': 'a1'}]))
+        self.assertEqual(d.get_deployment_vitals('cf'), [{'id': 'a1'}])
+        # the fresh vitals are what nowait() returns, without starting a task
+        d.get_deployment_vitals_async = MagicMock()
+        self.assertEqual(d.get_deployment_vitals_nowait('cf'), ('done', [{'id': 'a1'}], None))
+        d.get_deployment_vitals_async.assert_not_called()
+        # always fetched, never served from the cache
+        d.iter_deployment_vitals.return_value = iter([{'id': 'a2'}])
+        self.assertEqual(d.get_deployment_vitals('cf'), [{'id': 'a2'}])
+        self.assertEqual(d.iter_deployment_vitals.call_count, 2)
+        d.invalidate('cf')
+        d.get_deployment_vitals_async.return_value = '7'
+        self.assertEqual(d.get_deployment_vitals_nowait('cf'), ('processing', None, '7'))
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_director_get_deployment_vitals_nowait(self, mock_get):
+        d = director.Director('https://192.168.0.0:25555', 'admin', 'nothing',
+                              cache_ttls={'vitals': 30})
+        d.deployments = ['cf']
+        d.session = requests.Session()
+        mock_get.return_value.status_code = 302
+        mock_get.return_value.headers = {'Location': 'https://192.168.50.6:25555/tasks/111'}
+        mock_get.return_value.json.return_value = {'state': 'done'}
+        mock_get.return_value.iter_lines.return_value = [b'{"job_name": "router", "id": "888-888-face"}']
+        state, vitals, task_id = d.get_deployment_vitals_nowait('cf')
+        self.assertEqual((state, vitals, task_id), ('processing', None, '111'))
+        d.vitals_pending[task_id][1].result(timeout=5)
+        # collected into the cache; no new task
+        state, vitals, task_id = d.get_deployment_vitals_nowait('cf')
+        self.assertEqual((state, vitals[0]['job_name'], task_id), ('done', 'router', None))
+
+    def test_director_get_deployment_vitals_nowait_failed(self):
+        d = director.Director('https://192.168.0.0:25555', 'admin', 'nothing',
+                              cache_ttls={'vitals': 30})
+        failed = concurrent.futures.Future()
+        failed.set_exception(RuntimeError('vitals task /tasks/111 is error'))
+        d.get_deployment_vitals_async = MagicMock(return_value='111')
+        self.assertEqual(d.get_deployment_vitals_nowait('cf'), ('processing', None, '111'))
+        d.vitals_pending['111'] = (time.time(), failed)
+        # the failure is reported, and no new task submitted until retry is asked for
+        self.assertEqual(d.get_deployment_vitals_nowait('cf'), ('error', None, '111'))
+        self.assertEqual(d.get_deployment_vitals_nowait('cf'), ('error', None, '111'))
+        self.assertEqual(d.get_deployment_vitals_async.call_count, 1)
+        d.get_deployment_vitals_async.return_value = '112'
+        self.assertEqual(d.get_deployment_vitals_nowait('cf', retry=True), ('processing', None, '112'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from opcon.modules import errandacl
+
+
+class TestErrandACL(unittest.TestCase):
+    def setUp(self):
+        self.acl = errandacl.ErrandACL({
+            'cf': {'allow': ['^smoke', 'smoke-tests$']},
+            'cf-prod': {'allow': ['^status$']},
+            'locked': {},
+            '*': {'allow': ['^status$', '^smoke']}})
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.acl.lookup('cf-prod-east').prefix, 'cf-prod')
+        self.assertEqual(self.acl.lookup('cf-dev').prefix, 'cf')
+        self.assertEqual(self.acl.lookup('zookeeper').prefix, '*')
+
+    def test_filter(self):
+        errands = ['smoke-tests', 'status', 'smoke-tests', 'rotate-database']
+        # several patterns match smoke-tests, it is still listed once
+        self.assertEqual(self.acl.filter('cf', errands), ['smoke-tests'])
+        self.assertEqual(self.acl.filter('cf-prod', errands), ['status'])
+        self.assertEqual(self.acl.filter('locked-down', errands), [])
+        self.assertEqual(self.acl.filter('zookeeper', errands), ['smoke-tests', 'status'])
+        self.assertTrue(self.acl.allowed('cf-prod', 'status'))
+        self.assertFalse(self.acl.allowed('cf-prod', 'smoke-tests'))
+
+    def test_unrestricted(self):
+        acl = errandacl.ErrandACL({'cf': {'allow': ['^status$']}})
+        self.assertIsNone(acl.lookup('zookeeper'))
+        self.assertEqual(acl.filter('zookeeper', ['a', 'b', 'a']), ['a', 'b'])
+
+    def test_uncombinable_patterns(self):
+        acl = errandacl.ErrandACL({'cf': {'allow': ['(?P<n>smoke)', '(?P<n>status)']}})
+        self.assertIsNone(acl.lookup('cf').regex)
+        self.assertEqual(acl.filter('cf', ['status', 'drain']), ['status'])
+
+    def test_bad_pattern(self):
+        with self.assertRaises(ValueError):
+            errandacl.ErrandACL({'cf': {'allow': ['(']}})
+
+
+if __name__ == '__main__':
+    unittest.main()
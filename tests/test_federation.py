@@ -0,0 +1,100 @@
+import unittest
+import threading
+import requests
+from unittest.mock import MagicMock
+from opcon.modules import director
+from opcon.modules import federation
+
+
+def bosh(name, tasks=None, vitals=None):
+    d = MagicMock()
+    d.name = name
+    d.bosh_url = 'https://{}:25555'.format(name)
+    d.debug = False
+    d.timeo = 5
+    d.deployments = ['cf']
+    d.get_director_stats.return_value = {'cf': 3}
+    d.get_job_history.return_value = tasks or []
+    d.get_deployment_vitals_nowait.return_value = ('done', vitals or [], None)
+    d.inventory_age.return_value = None
+    return d
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        self.east = bosh('east', tasks=[{'id': 1, 'timestamp': 100}, {'id': 3, 'timestamp': 300}],
+                         vitals=[{'job_name': 'api', 'id': 'a1'}])
+        self.west = bosh('west', tasks=[{'id': 1, 'timestamp': 200}],
+                         vitals=[{'job_name': 'api', 'id': 'b1'}])
+        self.fed = federation.Federation([self.east, self.west])
+
+    def test_names(self):
+        self.assertEqual(self.fed.names(), ['east', 'west'])
+        self.assertIs(self.fed.get(), self.east)
+        self.assertIs(self.fed.get('west'), self.west)
+        self.assertIsNone(self.fed.get('north'))
+        with self.assertRaises(ValueError):
+            federation.Federation([self.east, bosh('east')])
+        with self.assertRaises(ValueError):
+            self.fed.remove('east')
+        self.fed.remove('west')
+        self.assertEqual(len(self.fed), 1)
+
+    def test_login(self):
+        self.west.login.side_effect = requests.HTTPError('401')
+        self.fed.login()
+        self.east.login.assert_called_once_with()
+        self.assertEqual(self.fed.names(), ['east'])
+        # the primary director is not left out
+        self.east.login.side_effect = requests.HTTPError('401')
+        with self.assertRaises(requests.HTTPError):
+            self.fed.login()
+        self.assertEqual(self.fed.names(), ['east'])
+
+    def test_each_concurrent(self):
+        # both calls have to be running at once for either to finish
+        barrier = threading.Barrier(2, timeout=2)
+        results = self.fed.each(lambda d: barrier.wait() is not None and d.name)
+        self.assertEqual(list(results.items()), [('east', 'east'), ('west', 'west')])
+
+    def test_each_errors(self):
+        self.west.get_director_stats.side_effect = Exception('down')
+        rows = self.fed.stats()
+        self.assertEqual(rows[0], {'director': 'east', 'url': 'https://east:25555',
+                                   'deployment': 'cf', 'vms': 3})
+        self.assertEqual(rows[1]['vms'], director.FANOUT_ERROR)
+        release = threading.Event()
+        self.west.get_director_stats.side_effect = lambda: release.wait(2)
+        results = self.fed.each(lambda d: d.get_director_stats(), timeout=0.1)
+        release.set()
+        self.assertEqual(results['west'], director.FANOUT_TIMEOUT)
+
+    def test_job_history(self):
+        tasks = self.fed.get_job_history(2, state='done')
+        self.assertEqual([(t['director'], t['id']) for t in tasks], [('east', 3), ('west', 1)])
+        self.east.get_job_history.assert_called_with(2, state='done')
+        self.west.get_job_history.return_value = {}
+        self.assertEqual(len(self.fed.get_job_history(10)), 2)
+        with self.assertRaises(ValueError):
+            self.fed.get_job_history(10, description='(')
+
+    def test_vitals(self):
+        self.west.deployments = ['cf-west']
+        records, pending = self.fed.get_deployment_vitals('cf')
+        self.assertEqual(records, [{'job_name': 'api', 'id': 'a1', 'director': 'east', 'deployment': 'cf'}])
+        self.assertEqual(pending, {})
+        self.west.get_deployment_vitals_nowait.assert_not_called()
+        self.west.deployments = ['cf']
+        self.west.get_deployment_vitals_nowait.return_value = ('processing', None, '111')
+        records, pending = self.fed.get_deployment_vitals('cf')
+        self.assertEqual(len(records), 1)
+        self.assertEqual(pending, {'west': '111'})
+
+    def test_select(self):
+        self.assertIs(federation.select({'DIRECTORS': self.fed}, 'west'), self.west)
+        self.assertIs(federation.select({'DIRECTOR': self.east}), self.east)
+        self.assertIsNone(federation.select({'DIRECTOR': self.east}, 'west'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import requests
+from unittest.mock import patch
+from opcon.modules import director
+from opcon.modules import inventory
+from helpers import response
+
+
+VMS = {
+    'cf': [{'job': 'router', 'id': 'r1', 'index': 0, 'ips': ['10.0.0.1'], 'az': 'z1'},
+           {'job': 'api', 'id': 'a1', 'index': 0, 'ips': ['10.0.0.2'], 'az': 'z1'},
+           {'job': 'router', 'id': 'r2', 'index': 1, 'ips': ['10.0.0.3'], 'az': 'z2', 'active': False}],
+    'zookeeper': [{'job': 'zookeeper', 'id': 'z1', 'index': 0, 'ips': ['10.0.1.1'], 'az': 'z1'}],
+}
+
+
+def fake_get(url, **kwargs):
+    if url.endswith('/deployments'):
+        return response([{'name': 'cf'}, {'name': 'zookeeper'}])
+    return response(VMS[url.split('/')[-2]])
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.director = director.Director('https://192.168.0.0:25555',
+                                          'admin',
+                                          'nothing',
+                                          debug=False,
+                                          verify_tls=False)
+        self.director.session = requests.Session()
+        self.director.inventory = inventory.Inventory(self.director, interval=60)
+
+    @patch('opcon.modules.director.requests.Session.get', side_effect=fake_get)
+    def test_refresh(self, mock_get):
+        inv = self.director.inventory
+        inv.refresh()
+        self.assertEqual(self.director.deployments, ['cf', 'zookeeper'])
+        snap = inv.snapshot
+        cf = snap.get('cf')
+        self.assertEqual(sorted(cf.groups.keys()), ['api', 'router'])
+        self.assertEqual([i.id for i in cf.groups['router']], ['r1', 'r2'])
+        self.assertEqual(cf.groups['router'][1].state, 'inactive')
+        self.assertEqual(cf.groups['router'][0].ips, ('10.0.0.1',))
+        self.assertLess(snap.age('cf'), 5)
+
+        # served from memory from now on
+        calls = mock_get.call_count
+        self.assertEqual(self.director.get_deployment_jobs('cf'), ['api/a1', 'router/r1', 'router/r2'])
+        self.assertEqual(self.director.get_director_stats(), {'cf': 3, 'zookeeper': 1})
+        self.assertEqual(mock_get.call_count, calls)
+
+        # nothing due yet: the snapshot isn't replaced
+        inv.refresh()
+        self.assertIs(inv.snapshot, snap)
+        self.assertEqual(mock_get.call_count, calls)
+
+    @patch('opcon.modules.director.requests.Session.get', side_effect=fake_get)
+    def test_expire(self, mock_get):
+        inv = self.director.inventory
+        inv.refresh()
+        old = inv.snapshot
+        self.director.invalidate('cf')
+        inv.refresh()
+        # only cf was re-read; zookeeper is shared with the old snapshot
+        self.assertIsNot(inv.snapshot.get('cf'), old.get('cf'))
+        self.assertIs(inv.snapshot.get('zookeeper'), old.get('zookeeper'))
+        # and the old snapshot, still held by readers, is untouched
+        self.assertEqual(len(old.get('cf')), 3)
+
+    def test_staggered(self):
+        inv = self.director.inventory
+        inv.snapshot = inventory.Snapshot({'cf': inventory.Deployment('cf', [], 0)}, 0)
+        with patch.object(self.director, 'get_deployments', return_value=['cf']):
+            with patch.object(self.director, 'fan_out', return_value={}) as fan_out:
+                inv.refresh()
+        # already known: refreshed in its own slot, not right away
+        self.assertEqual(fan_out.call_count, 0)
+        self.assertGreater(inv.due['cf'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
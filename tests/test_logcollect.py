@@ -0,0 +1,98 @@
+import unittest
+import tarfile
+import io
+from unittest.mock import MagicMock
+from opcon.modules import statestore
+from opcon.modules import logcollect
+from helpers import tar_bytes, chunked
+
+
+class TestLogCollect(unittest.TestCase):
+    def setUp(self):
+        self.director = MagicMock()
+        self.director.debug = False
+        self.director.deployments = ['cf', 'cf-diego']
+        self.director.fan_out = lambda func, items, executor=None: dict([(i, func(i)) for i in items])
+        self.tasks = {'/tasks/1': {'state': 'processing'},
+                      '/tasks/2': {'state': 'processing'}}
+        self.director.submit_logs_task.side_effect = ['/tasks/1', '/tasks/2']
+        self.director.task_state.side_effect = lambda url: self.tasks[url]
+        self.collect = logcollect.LogCollections(self.director, statestore.MemoryStore())
+
+    def test_parse_targets(self):
+        self.assertEqual(logcollect.parse_targets('cf:router, cf:api\ncf-diego:diego_cell/0\ncf:api'),
+                         [('cf', 'router'), ('cf', 'api'), ('cf-diego', 'diego_cell/0')])
+        with self.assertRaises(ValueError):
+            logcollect.parse_targets('router')
+
+    def test_start(self):
+        with self.assertRaises(ValueError):
+            self.collect.start([('nothere', 'router')])
+        with self.assertRaises(ValueError):
+            self.collect.start([])
+        c = self.collect.start([('cf', 'router'), ('cf-diego', 'diego_cell')])
+        self.assertEqual(c['state'], logcollect.RUNNING)
+        self.assertEqual([t['task'] for t in c['targets']], ['/tasks/1', '/tasks/2'])
+        with self.assertRaises(ValueError):
+            self.collect.archive(c['id'])
+
+        self.tasks['/tasks/1'] = {'state': 'done', 'result': 'blob-1'}
+        self.tasks['/tasks/2'] = {'state': 'error', 'result': 'no agent'}
+        c = self.collect.get(c['id'])
+        self.assertEqual(c['state'], logcollect.DONE)
+        self.assertEqual(c['targets'][0]['blob'], 'blob-1')
+        self.assertEqual(self.collect.recent()[0]['id'], c['id'])
+
+    def test_recent(self):
+        c = self.collect.start([('cf', 'router'), ('cf-diego', 'diego_cell')])
+        self.tasks['/tasks/1'] = {'state': 'done', 'result': 'blob-1'}
+        # the list is rendered from the store, without looking at the tasks
+        self.director.task_state.reset_mock()
+        self.assertEqual(self.collect.recent()[0]['targets'][0]['state'], 'processing')
+        self.director.task_state.assert_not_called()
+        self.collect.refresh()
+        self.assertEqual(self.collect.recent()[0]['targets'][0]['state'], 'done')
+        self.assertEqual(self.collect.recent()[0]['state'], logcollect.RUNNING)
+        # a task that can't be looked up is given up on eventually
+        self.tasks['/tasks/2'] = None
+        for i in range(logcollect.LOOKUPS - 1):
+            self.collect.refresh()
+        self.assertEqual(self.collect.recent()[0]['targets'][1]['state'], 'processing')
+        self.collect.refresh()
+        c = self.collect.recent()[0]
+        self.assertEqual(c['targets'][1]['state'], 'error')
+        self.assertEqual(c['state'], logcollect.DONE)
+
+    def test_archive(self):
+        c = self.collect.start([('cf', 'router'), ('cf-diego', 'diego_cell')])
+        self.tasks['/tasks/1'] = {'state': 'done', 'result': 'blob-1'}
+        self.tasks['/tasks/2'] = {'state': 'done', 'result': 'blob-2'}
+        bundles = {'/resources/blob-1': tar_bytes([('./router.0.tgz', b'r' * 700)]),
+                   '/resources/blob-2': tar_bytes([('./diego_cell.0.tgz', b'd' * 10),
+                                                   ('./diego_cell.1.tgz', b'e' * 20)])}
+
+        def stream(path):
+            r = MagicMock()
+            r.ok = True
+            r.path = path
+            return r
+        self.director.stream.side_effect = stream
+        self.director.iter_stream.side_effect = lambda r, chunk_size=None: chunked(bundles[r.path], 100)
+
+        merged = b''.join(self.collect.archive(c['id']))
+        with tarfile.open(fileobj=io.BytesIO(merged), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['cf/router/router.0.tgz',
+                                              'cf-diego/diego_cell/diego_cell.0.tgz',
+                                              'cf-diego/diego_cell/diego_cell.1.tgz'])
+            self.assertEqual(tar.extractfile('cf/router/router.0.tgz').read(), b'r' * 700)
+
+    def test_merge_errors(self):
+        merged = b''.join(logcollect.merge_archives([('cf/api/', None, 'logs task error'),
+                                                     ('cf/router/', iter([b'garbage']), None)]))
+        with tarfile.open(fileobj=io.BytesIO(merged), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['cf/api/ERROR.txt', 'cf/router/ERROR.txt'])
+            self.assertEqual(tar.extractfile('cf/api/ERROR.txt').read(), b'logs task error\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
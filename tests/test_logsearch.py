@@ -0,0 +1,48 @@
+import unittest
+import gzip
+from opcon.modules import logsearch
+from helpers import tar_bytes, chunked
+
+
+class TestLogSearch(unittest.TestCase):
+    def setUp(self):
+        router = tar_bytes([('./router/router.stdout.log', b'ok\nPANIC: boom\nok\n'),
+                            ('./router/router.stdout.log.1.gz', gzip.compress(b'panic: old\n'))])
+        cell = tar_bytes([('./rep/rep.stdout.log', b'fine\nfine\nPANIC: cell\n')])
+        self.bundle = tar_bytes([('./router.0.tgz', router), ('./diego_cell.0.tgz', cell)])
+
+    def test_search(self):
+        search = logsearch.LogSearch('PANIC')
+        matches = list(search.run(chunked(self.bundle)))
+        self.assertEqual(matches, [('router.0.tgz/router/router.stdout.log', 2, 'PANIC: boom'),
+                                   ('diego_cell.0.tgz/rep/rep.stdout.log', 3, 'PANIC: cell')])
+        summary = search.summary()
+        self.assertEqual(summary['matches'], 2)
+        self.assertEqual(summary['files'], 3)
+        self.assertIsNone(summary['truncated'])
+
+    def test_options(self):
+        search = logsearch.LogSearch('panic:', fixed=True, ignore_case=True, files='*/router/*')
+        self.assertEqual([m[2] for m in search.run(chunked(self.bundle))],
+                         ['PANIC: boom', 'panic: old'])
+        with self.assertRaises(ValueError):
+            logsearch.LogSearch('(')
+        with self.assertRaises(ValueError):
+            logsearch.LogSearch('')
+
+    def test_limits(self):
+        search = logsearch.LogSearch('PANIC', max_matches=1)
+        self.assertEqual(len(list(search.run(chunked(self.bundle)))), 1)
+        self.assertTrue(search.summary()['truncated'].startswith('max matches'))
+        search = logsearch.LogSearch('PANIC', max_bytes=3)
+        self.assertEqual(list(search.run(chunked(self.bundle))), [])
+        self.assertTrue(search.summary()['truncated'].startswith('max bytes'))
+
+    def test_unreadable(self):
+        search = logsearch.LogSearch('PANIC')
+        self.assertEqual(list(search.run(iter([b'not a tarball']))), [])
+        self.assertTrue(search.summary()['truncated'].startswith('unreadable'))
+
+
+if __name__ == '__main__':
+    unittest.main()
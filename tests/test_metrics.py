@@ -0,0 +1,80 @@
+import unittest
+from flask import Flask
+from opcon.modules import metrics
+
+
+def app_create_app():
+    app = Flask('opcon')
+
+    @app.route('/deployment/<deployment>/jobs')
+    def jobs(deployment):
+        return 'ok'
+
+    @app.route('/broken')
+    def broken():
+        raise ValueError('broken')
+
+    metrics.init_app(app)
+    return app
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_metrics_counter_gauge(self):
+        c = self.registry.counter('test_total', 'a counter')
+        c.inc({'route': '/'})
+        c.inc({'route': '/'}, amount=2)
+        self.assertEqual(c.get({'route': '/'}), 3)
+        gauge = self.registry.gauge('test_gauge', 'a gauge')
+        gauge.set(5)
+        gauge.dec()
+        self.assertEqual(gauge.get(), 4)
+        text = self.registry.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{route="/"} 3', text)
+
+    def test_metrics_histogram(self):
+        h = self.registry.histogram('test_seconds', 'a histogram', buckets=(0.1, 1))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        text = self.registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count 3', text)
+
+    def test_metrics_routes(self):
+        app = app_create_app()
+        with app.test_client() as client:
+            client.get('/deployment/cf/jobs')
+            client.get('/broken')
+            rv = client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        text = rv.get_data(as_text=True)
+        # labelled by route template, not by path
+        self.assertIn('route="/deployment/<deployment>/jobs",status="200"', text)
+        self.assertIn('route="/broken",status="500"', text)
+        self.assertIn('opcon_http_requests_in_flight{route="/broken"} 0', text)
+
+    def test_metrics_allow(self):
+        app = Flask('opcon')
+        metrics.init_app(app, registry=self.registry, allow=['10.0.0.0/8'])
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 403)
+            rv = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+            self.assertEqual(rv.status_code, 200)
+        with self.assertRaises(ValueError):
+            metrics.init_app(Flask('opcon'), allow=['10.0.0.0/33'])
+
+    def test_metrics_timed_job(self):
+        job = metrics.timed_job('test-job', lambda: 42)
+        before = metrics.job_seconds.get({'job': 'test-job'})
+        self.assertEqual(job(), 42)
+        self.assertEqual(metrics.job_seconds.get({'job': 'test-job'}), before + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import os
+from opcon.modules import outputcache
+
+
+class TestOutputCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = outputcache.OutputCache(self.tmpdir.name, max_bytes=10)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_path(self):
+        self.assertTrue(self.cache.path('111', 'debug').endswith('111.debug'))
+        self.assertIsNone(self.cache.path('../111', 'debug'))
+        self.assertIsNone(self.cache.path('111', 'cancel'))
+
+    def test_tee(self):
+        self.assertIsNone(self.cache.lookup('111', 'result'))
+        body = b''.join(self.cache.tee('111', 'result', iter([b'abc', b'def'])))
+        self.assertEqual(body, b'abcdef')
+        path = self.cache.lookup('111', 'result')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_abandoned(self):
+        body = self.cache.tee('112', 'debug', iter([b'abc', b'def']))
+        self.assertEqual(next(body), b'abc')
+        # the reader goes away: nothing is cached, nothing is left behind
+        body.close()
+        self.assertIsNone(self.cache.lookup('112', 'debug'))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_evict(self):
+        list(self.cache.tee('1', 'debug', iter([b'12345'])))
+        list(self.cache.tee('2', 'debug', iter([b'12345'])))
+        os.utime(self.cache.path('1', 'debug'), (1, 1))
+        os.utime(self.cache.path('2', 'debug'), (2, 2))
+        # reading 1 makes 2 the least recently used
+        self.cache.lookup('1', 'debug')
+        list(self.cache.tee('3', 'debug', iter([b'12345'])))
+        self.assertIsNotNone(self.cache.lookup('1', 'debug'))
+        self.assertIsNone(self.cache.lookup('2', 'debug'))
+        self.assertIsNotNone(self.cache.lookup('3', 'debug'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import tempfile
+import os
+from opcon.modules import statestore
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, 'state.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_state_store_factory(self):
+        self.assertIsInstance(statestore.state_store(''), statestore.MemoryStore)
+        self.assertIsInstance(statestore.state_store('sqlite://' + self.db), statestore.SQLiteStore)
+        with self.assertRaises(ValueError):
+            statestore.state_store('redis://localhost')
+
+    def test_state_store_memory(self):
+        store = statestore.MemoryStore()
+        store.set('logins', 'fake', 42)
+        self.assertEqual(store.get('logins', 'fake'), 42)
+        self.assertEqual(store.get('logins', 'nothere'), None)
+        self.assertEqual(store.setdefault('app', 'key', 'first'), 'first')
+        self.assertEqual(store.setdefault('app', 'key', 'second'), 'first')
+
+    def test_state_store_sqlite_shared(self):
+        # two stores on one file stand in for two workers
+        one = statestore.state_store('sqlite://' + self.db)
+        two = statestore.state_store('sqlite://' + self.db)
+        one.set('pending_tasks', '/tasks/1', {'t_url': '/tasks/1'})
+        self.assertEqual(two.items('pending_tasks'), [('/tasks/1', {'t_url': '/tasks/1'})])
+        self.assertEqual(one.setdefault('app', 'secret_key', 'a'),
+                         two.setdefault('app', 'secret_key', 'b'))
+        two.clear('pending_tasks')
+        self.assertEqual(one.items('pending_tasks'), [])
+
+    def test_state_store_mapping(self):
+        logins = statestore.state_store('sqlite://' + self.db).mapping('logins')
+        logins['fake'] = 100
+        logins['fake'] += 1
+        self.assertIn('fake', logins)
+        self.assertEqual(logins['fake'], 101)
+        self.assertEqual(list(logins), ['fake'])
+        del logins['fake']
+        self.assertNotIn('fake', logins)
+        with self.assertRaises(KeyError):
+            logins['fake']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import threading
+import time
+from opcon.modules import taskevents
+
+
+class TestTaskEvents(unittest.TestCase):
+    def setUp(self):
+        self.events = taskevents.TaskEvents(size=3)
+
+    def test_message(self):
+        self.assertEqual(taskevents.message({'id': 1}, event='task', event_id='5.000000'),
+                         'event: task\nid: 5.000000\ndata: {"id":1}\n\n')
+
+    def test_since(self):
+        start = self.events.parse_id(self.events.last_id())
+        first = self.events.publish({'id': 1})
+        self.events.publish({'id': 2})
+        self.assertEqual([e['id'] for t, e in self.events.since(start)], [1, 2])
+        self.assertEqual([e['id'] for t, e in self.events.since(self.events.parse_id(first))], [2])
+        self.assertEqual(self.events.since(self.events.parse_id(self.events.last_id()), timeout=0), [])
+        # from before this process started, or events that have been dropped: reset
+        self.assertIsNone(self.events.since(start - 1))
+        for i in range(3, 6):
+            self.events.publish({'id': i})
+        self.assertIsNone(self.events.since(start))
+        self.assertEqual(self.events.parse_id('nonsense'), None)
+
+    def test_wakes_subscribers(self):
+        threading.Timer(0.05, self.events.publish, [{'id': 7}]).start()
+        t = self.events.parse_id(self.events.last_id())
+        began = time.time()
+        self.assertEqual([e['id'] for et, e in self.events.since(t, timeout=2)], [7])
+        self.assertLess(time.time() - began, 1)
+
+    def test_stream(self):
+        last = self.events.publish({'id': 1})
+        self.events.publish({'id': 2, 'state': 'done'})
+        stream = self.events.stream(last, keepalive=0.01, duration=0.05)
+        messages = list(stream)
+        self.assertEqual(messages[0], 'retry: {}\n\n'.format(taskevents.RETRY))
+        self.assertTrue(messages[1].startswith('event: task\nid: '))
+        self.assertIn('"state":"done"', messages[1])
+        self.assertIn(': keepalive\n\n', messages[2:])
+        self.assertEqual(self.events.subscribers, 0)
+        self.assertEqual(list(self.events.stream('1.0', duration=1))[-1], 'event: reset\ndata: {}\n\n')
+        # another worker's id
+        other = self.events.last_id().replace(self.events.origin + ':', 'ffff:')
+        self.assertEqual(list(self.events.stream(other, duration=1))[-1], 'event: reset\ndata: {}\n\n')
+
+    def test_streams(self):
+        streams = taskevents.Streams(1)
+        held = streams.hold(iter(['a', 'b']))
+        self.assertEqual(next(held), 'a')
+        self.assertTrue(streams.full())
+        # past the limit: told to come back later
+        self.assertEqual(list(streams.hold(iter(['c']))), ['retry: {}\n\n'.format(taskevents.BUSY_RETRY)])
+        held.close()
+        self.assertFalse(streams.full())
+        self.assertEqual(list(streams.hold(iter(['c']))), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import requests
+from unittest.mock import patch, MagicMock
+from opcon.modules import director
+from opcon.modules import taskhistory
+from helpers import response
+
+
+def task(tid, state='done', deployment='cf', user='admin', description='run errand smoke-tests'):
+    return {'id': tid, 'state': state, 'deployment': deployment, 'user': user,
+            'description': description, 'timestamp': 1000 + tid}
+
+
+class TestTaskHistory(unittest.TestCase):
+    def setUp(self):
+        self.director = director.Director('https://192.168.0.0:25555',
+                                          'admin',
+                                          'nothing',
+                                          debug=False,
+                                          verify_tls=False)
+        self.director.session = requests.Session()
+        self.history = taskhistory.TaskHistory(self.director, min_interval=60)
+        self.director.task_history = self.history
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_incremental_sync(self, mock_get):
+        mock_get.side_effect = [response([task(3, 'processing'), task(2), task(1)]),   # first listing
+                                response([task(3, 'processing')])]                     # still active
+        self.assertEqual([t['id'] for t in self.history.query(limit=2)], [3, 2])
+        self.assertTrue(self.history.complete)
+        self.assertEqual(self.history.active, set([3]))
+
+        # a new task, and task 3 finished: only the newest page, the active
+        # listing and task 3's final record are fetched
+        mock_get.reset_mock()
+        self.director.invalidate()
+        mock_get.side_effect = [response([task(4, 'queued'), task(3, 'processing')]),
+                                response([task(4, 'queued')]),
+                                response(task(3))]
+        tasks = self.history.query(limit=10)
+        self.assertEqual([t['id'] for t in tasks], [4, 3, 2, 1])
+        self.assertEqual(tasks[1]['state'], 'done')
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertTrue(mock_get.call_args_list[2].args[0].endswith('/tasks/3'))
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_filters(self, mock_get):
+        mock_get.side_effect = [response([task(5, 'error', user='ops'),
+                                          task(4, description='snapshot deployment'),
+                                          task(3, deployment='zookeeper'),
+                                          task(2),
+                                          task(1)]),
+                                response([])]
+        q = self.history.query
+        self.assertEqual([t['id'] for t in q(state='error,cancelled')], [5])
+        self.assertEqual([t['id'] for t in q(deployment='zookeeper')], [3])
+        self.assertEqual([t['id'] for t in q(user='ops')], [5])
+        self.assertEqual([t['id'] for t in q(exclude='^snapshot', deployment='cf')], [5, 2, 1])
+        self.assertEqual([t['id'] for t in q(description='snapshot')], [4])
+        self.assertEqual([t['id'] for t in q(since=1002, until=1003)], [3, 2])
+        self.assertEqual([t['id'] for t in q(limit=2)], [5, 4])
+        with self.assertRaises(ValueError):
+            q(description='(')
+
+    def test_filters_from_args(self):
+        args = MagicMock()
+        args.get.side_effect = lambda key, type=None: {'state': 'done', 'since': 10}.get(key)
+        self.assertEqual(taskhistory.filters_from_args(args), {'state': 'done', 'since': 10})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from unittest.mock import MagicMock
+from opcon.modules import tasktail
+
+
+class FakeOutput(object):
+    '''task output that grows; answers Range requests like the director, or ignores them'''
+    def __init__(self, ranges=True):
+        self.data = b''
+        self.ranges = ranges
+        self.requests = list()
+
+    def stream(self, path, params=None, headers=None):
+        start = int(headers['Range'][len('bytes='):-1])
+        self.requests.append(start)
+        r = MagicMock()
+        if not self.ranges:
+            r.status_code, r.ok, r.body = 200, True, self.data
+        elif start >= len(self.data):
+            r.status_code, r.ok, r.body = 416, False, b''
+        else:
+            r.status_code, r.ok, r.body = 206, True, self.data[start:]
+            r.headers = {'Content-Range': 'bytes {}-{}/{}'.format(start, len(self.data) - 1, len(self.data))}
+        return r
+
+    def iter_stream(self, r, chunk_size=None):
+        for i in range(0, len(r.body), 4):
+            yield r.body[i:i + 4]
+
+
+class TestTaskTail(unittest.TestCase):
+    def setUp(self):
+        self.output = FakeOutput()
+        self.director = MagicMock()
+        self.director.task_watcher = None
+        self.director.stream.side_effect = self.output.stream
+        self.director.iter_stream.side_effect = self.output.iter_stream
+        self.states = ['processing', 'processing', 'processing', 'processing', 'done']
+        self.director.task_state.side_effect = lambda url: {'state': self.states.pop(0)}
+        self.appends = [b'two\n', b'', b'three\nfo', b'ur\n']
+
+    def sleep(self, seconds):
+        self.output.data += self.appends.pop(0)
+
+    def test_follow(self):
+        self.output.data = b'one\n'
+        tail = tasktail.TaskTail(self.director, 42, 'debug', offset=0)
+        out = list(tail.follow(sleep=self.sleep))
+        self.assertEqual(b''.join(out), b'one\ntwo\nthree\nfour\n')
+        # an empty poll, then backing off
+        self.assertIn(b'', out)
+        # each byte is asked for once
+        self.assertEqual(self.output.requests, [0, 4, 8, 8, 16])
+        self.assertEqual(tail.state, 'done')
+
+    def test_no_ranges(self):
+        self.output = FakeOutput(ranges=False)
+        self.director.stream.side_effect = self.output.stream
+        self.output.data = b'one\ntwo\n'
+        tail = tasktail.TaskTail(self.director, 42, 'event', offset=4)
+        self.assertEqual(b''.join(tail.follow(sleep=self.sleep)), self.output.data[4:])
+        self.assertTrue(self.output.data.endswith(b'three\nfour\n'))
+        self.assertEqual(tail.offset, len(self.output.data))
+
+    def test_sse(self):
+        self.output.data = b'one\ntw'
+        self.appends = [b'o\n', b'last']
+        self.states = ['processing', 'processing', 'done']
+        tail = tasktail.TaskTail(self.director, 42, 'debug', poll=0.001, max_poll=0.001)
+        tail.follow = lambda: tasktail.TaskTail.follow(tail, sleep=self.sleep)
+        messages = list(tail.sse())
+        self.assertEqual(messages[1], 'event: output\nid: 4\ndata: {"text":"one\\n"}\n\n')
+        self.assertEqual(messages[2], 'event: output\nid: 8\ndata: {"text":"two\\n"}\n\n')
+        self.assertEqual(messages[3], 'event: output\nid: 12\ndata: {"text":"last"}\n\n')
+        self.assertEqual(messages[4], 'event: end\ndata: {"state":"done","offset":12}\n\n')
+
+    def test_text_duration(self):
+        self.output.data = b'one\n'
+        tail = tasktail.TaskTail(self.director, 42, 'debug')
+        tail.follow = lambda: tasktail.TaskTail.follow(tail, sleep=self.sleep)
+        # stops after duration, however long the task runs; the client goes on from offset
+        self.assertEqual(list(tail.text(duration=0)), [b'one\n'])
+        self.assertEqual(tail.offset, 4)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            tasktail.TaskTail(self.director, '../x', 'debug')
+        with self.assertRaises(ValueError):
+            tasktail.TaskTail(self.director, 42, 'debug', offset='x')
+        self.director.stream.side_effect = None
+        self.director.stream.return_value.status_code = 500
+        self.director.stream.return_value.ok = False
+        with self.assertRaises(IOError):
+            list(tasktail.TaskTail(self.director, 42, 'debug').fetch())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import requests
+from unittest.mock import patch
+from opcon.modules import director
+from opcon.modules import taskwatch
+from opcon.modules import taskevents
+from helpers import response
+
+
+class TestTaskWatcher(unittest.TestCase):
+    def setUp(self):
+        self.director = director.Director('https://192.168.0.0:25555',
+                                          'admin',
+                                          'nothing',
+                                          debug=False,
+                                          verify_tls=False)
+        self.director.deployments = ['cf', 'zookeeper']
+        self.director.session = requests.Session()
+        self.watcher = taskwatch.TaskWatcher(self.director, min_interval=1, max_interval=4)
+        self.director.task_watcher = self.watcher
+
+    def test_task_id(self):
+        self.assertEqual(taskwatch.task_id('/tasks/111'), '111')
+        self.assertEqual(taskwatch.task_id(111), '111')
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_watch_finished(self, mock_get):
+        mock_get.return_value = response({'id': 111, 'state': 'done', 'result': 'blob'})
+        future = self.watcher.watch('/tasks/111')
+        self.assertTrue(future.done())
+        self.assertEqual(self.director.get_logs_job('/tasks/111'), '/resources/blob')
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_sweep(self, mock_get):
+        mock_get.return_value = response({'id': 112, 'state': 'queued'})
+        self.director.save_pending_task(director.task_logs(director.TASK_LOGS, 'cf router', '/tasks/112'))
+        future = self.watcher.watch('/tasks/112')
+        self.assertFalse(future.done())
+
+        # one batched listing, task still running: back off
+        mock_get.return_value = response([{'id': 112, 'state': 'processing'}])
+        self.watcher.sweep()
+        self.assertEqual(self.director.pending_tasks[0].t_state, 'processing')
+        self.assertEqual(self.watcher.interval, 1)
+        self.watcher.next_sweep = 0
+        self.watcher.sweep()
+        self.assertEqual(self.watcher.interval, 2)
+        self.assertFalse(future.done())
+
+        # no longer listed as active: final record is fetched, waiters woken
+        mock_get.side_effect = [response([]),
+                                response({'id': 112, 'state': 'done', 'result': 'blob'})]
+        self.watcher.next_sweep = 0
+        self.watcher.sweep()
+        self.assertEqual(future.result(timeout=1)['result'], 'blob')
+        self.assertEqual(self.director.pending_tasks[0].t_state, 'done')
+        self.assertEqual(len(self.watcher.watched), 0)
+
+    @patch('opcon.modules.director.requests.Session.get')
+    def test_events(self, mock_get):
+        events = taskevents.TaskEvents()
+        self.watcher.events = events
+        # nothing watched and nobody listening: no polling
+        self.watcher.sweep()
+        mock_get.assert_not_called()
+
+        # with a subscriber, tasks started elsewhere are followed to the end
+        events.subscribe()
+        start = events.parse_id(events.last_id())
+        mock_get.return_value = response([{'id': 120, 'state': 'processing', 'description': 'deploy'}])
+        self.watcher.sweep()
+        self.assertEqual(self.watcher.interval, 1)
+        self.watcher.next_sweep = 0
+        self.watcher.sweep()
+        # still active with someone listening: no backing off
+        self.assertEqual(self.watcher.interval, 1)
+        mock_get.side_effect = [response([]),
+                                response({'id': 120, 'state': 'done', 'description': 'deploy'})]
+        self.watcher.next_sweep = 0
+        self.watcher.sweep()
+        published = events.since(start, timeout=0)
+        self.assertEqual([(e['id'], e['state'], e['director']) for t, e in published],
+                         [(120, 'processing', 'https://192.168.0.0:25555'), (120, 'done', 'https://192.168.0.0:25555')])
+        self.assertEqual(len(self.watcher.watched), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+import json
+import os
+from unittest.mock import patch, MagicMock
+from flask import Flask, render_template_string
+from opcon.modules import director
+from opcon.modules import tracing
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'trace.jsonl')
+        self.tracer = tracing.Tracer(self.path, sample_rate=1)
+
+    def tearDown(self):
+        for h in self.tracer.logger.handlers:
+            h.close()
+        self.tmpdir.cleanup()
+
+    def test_path_template(self):
+        self.assertEqual(tracing.path_template('/deployments/cf/vms'), '/deployments/<deployment>/vms')
+        self.assertEqual(tracing.path_template('/tasks/1234/output'), '/tasks/<id>/output')
+        self.assertEqual(tracing.path_template('/deployments/cf/errands/smoke/runs'),
+                         '/deployments/<deployment>/errands/<errand>/runs')
+        self.assertEqual(tracing.path_template('/oauth/token'), '/oauth/token')
+
+    def test_span_outside_trace(self):
+        self.assertIs(tracing.span('http'), tracing.NO_SPAN)
+
+    def test_nested_spans(self):
+        root = self.tracer.start_trace('request')
+        with tracing.span('http', path='/deployments') as child:
+            child.set(status=200)
+        root.finish()
+        self.assertIsNone(tracing.current())
+        spans = read_spans(self.path)
+        self.assertEqual([s['name'] for s in spans], ['http', 'request'])
+        self.assertEqual(spans[0]['parent_id'], spans[1]['span_id'])
+        self.assertEqual(spans[0]['trace_id'], spans[1]['trace_id'])
+        self.assertEqual(spans[0]['attrs'], {'path': '/deployments', 'status': 200})
+
+    def test_not_sampled(self):
+        self.tracer.sample_rate = 0
+        self.assertIsNone(self.tracer.start_trace('request'))
+        self.assertIs(tracing.span('http'), tracing.NO_SPAN)
+
+    @patch('opcon.modules.director.requests.Session.request')
+    def test_flask_request(self, mock_request):
+        r = MagicMock()
+        r.status_code = 200
+        r.headers = {'Content-Length': '2'}
+        mock_request.return_value = r
+        d = director.Director('https://192.168.0.0:25555', 'admin', 'nothing', verify_tls=False)
+        d.session = director.DirectorSession()
+        app = Flask('opcon')
+
+        @app.route('/deployment/<deployment>')
+        def deployment(deployment):
+            d.fan_out(lambda dep: d.session.get(d.bosh_url + '/deployments/' + dep + '/vms'), [deployment])
+            return render_template_string('{{ deployment }}', deployment=deployment)
+
+        self.tracer.init_app(app)
+        rv = app.test_client().get('/deployment/cf')
+        self.assertEqual(rv.status_code, 200)
+        spans = {s['name']: s for s in read_spans(self.path)}
+        self.assertEqual(spans['request']['attrs']['route'], '/deployment/<deployment>')
+        self.assertEqual(spans['request']['attrs']['status'], 200)
+        # the director call ran on the fan-out pool, but belongs to this request
+        self.assertEqual(spans['http']['parent_id'], spans['request']['span_id'])
+        self.assertEqual(spans['http']['attrs']['path'], '/deployments/<deployment>/vms')
+        self.assertEqual(spans['http']['attrs']['bytes'], 2)
+        self.assertEqual(spans['render_template']['parent_id'], spans['request']['span_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
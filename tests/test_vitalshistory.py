@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+import math
+import os
+from unittest.mock import MagicMock
+from opcon.modules import vitalshistory
+from helpers import instance
+
+
+class TestVitalsHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'vitals.dat')
+        self.director = MagicMock()
+        self.director.debug = False
+        self.history = vitalshistory.VitalsHistory(self.director, self.path, max_instances=2)
+
+    def tearDown(self):
+        self.history.close()
+        self.tmpdir.cleanup()
+
+    def test_metrics_from_vitals(self):
+        m = vitalshistory.metrics_from_vitals(instance('api', 'a1', 50)['vitals'])
+        self.assertEqual(m[:9], [0.5, 1.0, 0.0, 0.1, 0.2, 0.3, 50.0, 0.0, 40.0])
+        self.assertTrue(math.isnan(m[vitalshistory.METRICS.index('disk_persistent')]))
+
+    def test_downsampling(self):
+        t0 = 900 * 1000
+        for minute, mem in enumerate([10, 20, 30]):
+            self.history.record('cf', [instance('api', 'a1', mem)], now=t0 + 60 * minute)
+        now = t0 + 120
+        fine = self.history.history('cf', 'api', 'a1', metrics=['mem'], now=now)
+        self.assertEqual(fine['step'], 60)
+        self.assertEqual(fine['metrics']['mem'][-3:], [10.0, 20.0, 30.0])
+        self.assertEqual(fine['metrics']['mem'][-4], None)
+        self.assertEqual(len(fine['metrics']['mem']), 360)
+        coarse = self.history.history('cf', 'api', 'a1', resolution=1, metrics=['mem'], now=now)
+        self.assertEqual(coarse['metrics']['mem'][-1], 20.0)
+        self.assertEqual(len(coarse['metrics']['mem']), 672)
+        # six hours later the minute samples have aged out, the 15 minute one hasn't
+        later = now + 6 * 3600
+        self.assertEqual(set(self.history.history('cf', 'api', 'a1', metrics=['mem'], now=later)['metrics']['mem']),
+                         set([None]))
+        self.assertEqual(self.history.history('cf', 'api', 'a1', resolution=1, metrics=['mem'],
+                                              now=later)['metrics']['mem'][-25], 20.0)
+        with self.assertRaises(ValueError):
+            self.history.history('cf', 'api', 'a1', metrics=['nothing'])
+        self.assertIsNone(self.history.history('cf', 'api', 'a2'))
+
+    def test_persistence(self):
+        self.history.record('cf', [instance('api', 'a1', 42)], now=6000)
+        self.history.close()
+        self.history = vitalshistory.VitalsHistory(self.director, self.path, max_instances=2)
+        self.assertEqual(self.history.sparklines('cf', now=6000), {'api/a1': [None] * 59 + [42.0]})
+
+    def test_bounded(self):
+        self.history.record('cf', [instance('api', 'a1', 1), instance('api', 'a2', 2)], now=6000)
+        self.history.record('cf', [instance('api', 'a3', 3)], now=6060)
+        # a1 and a2 were seen together, the first of them gave up its slot
+        self.assertEqual(sorted(self.history.sparklines('cf', now=6060).keys()), ['api/a2', 'api/a3'])
+        self.assertEqual(os.path.getsize(self.path),
+                         self.history.data_offset + 2 * self.history.slot_size)
+        self.history.expire(now=6060 + vitalshistory.FORGET + 1)
+        self.assertEqual(self.history.sparklines('cf', now=6060), {})
+
+    def test_sample(self):
+        self.director.deployments = ['cf']
+        self.director.fan_out.side_effect = \
+            lambda func, items, timeout=None, executor=None: dict([(i, func(i)) for i in items])
+        self.director.get_deployment_vitals.return_value = [instance('api', 'a1', 77)]
+        self.history.sample()
+        self.assertTrue(self.history.writer)
+        self.assertIs(self.director.fan_out.call_args[1]['executor'], self.director.background)
+        self.assertEqual(self.history.sparklines('cf')['api/a1'][-1], 77.0)
+        # another worker opens the file while the sampler holds its lock, and doesn't sample
+        other = vitalshistory.VitalsHistory(self.director, self.path, max_instances=2)
+        other.sample()
+        self.assertFalse(other.writer)
+        self.assertEqual(other.sparklines('cf')['api/a1'][-1], 77.0)
+        other.close()
+
+    def test_sparkline_svg(self):
+        self.assertEqual(vitalshistory.sparkline_svg([None, None]), '')
+        svg = vitalshistory.sparkline_svg([0, 100, None, 50], width=30, height=10)
+        self.assertIn('points="0.0,10.0 10.0,0.0"', svg)
+        self.assertIn('points="30.0,5.0"', svg)
+
+
+if __name__ == '__main__':
+    unittest.main()
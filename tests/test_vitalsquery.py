@@ -0,0 +1,70 @@
+import unittest
+from opcon.modules import vitalsquery
+from helpers import instance
+
+
+RECORDS = [instance('router', 'r1', 20),
+           instance('diego_cell', 'c1', 85),
+           instance('diego_cell', 'c2', 60, state='failing'),
+           instance('diego_cell', 'c3', 90),
+           {'job_name': 'api', 'id': 'a1', 'job_state': 'stopped', 'ips': [], 'vitals': {}}]
+
+
+class TestVitalsQuery(unittest.TestCase):
+    def test_lookup(self):
+        r = RECORDS[0]
+        self.assertEqual(vitalsquery.lookup(r, 'vitals.mem.percent'), '20')
+        self.assertEqual(vitalsquery.lookup(r, 'mem'), '20')
+        self.assertEqual(vitalsquery.lookup(r, 'load5'), '0.2')
+        self.assertEqual(vitalsquery.lookup(r, 'ip'), '10.0.0.20')
+        self.assertIsNone(vitalsquery.lookup(r, 'vitals.disk.persistent.percent'))
+        self.assertIsNone(vitalsquery.lookup(RECORDS[4], 'ips.0'))
+
+    def test_fields_and_sort(self):
+        page = vitalsquery.query(RECORDS, fields=['id', 'mem'], sort=['-mem'])
+        self.assertEqual(page['data'][0], {'id': 'c3', 'mem': '90'})
+        # the instance without memory vitals comes last either way
+        self.assertEqual([d['id'] for d in page['data']], ['c3', 'c1', 'c2', 'r1', 'a1'])
+        page = vitalsquery.query(RECORDS, fields=['id'], sort=['mem'])
+        self.assertEqual([d['id'] for d in page['data']], ['r1', 'c2', 'c1', 'c3', 'a1'])
+        page = vitalsquery.query(RECORDS, fields=['id'], sort=['-job_name'])
+        self.assertEqual([d['id'] for d in page['data']], ['r1', 'c1', 'c2', 'c3', 'a1'])
+        self.assertIsNone(page['next'])
+
+    def test_filters(self):
+        q = vitalsquery.query
+        self.assertEqual([d['id'] for d in q(RECORDS, fields=['id'], filters=['job_state!=running'])['data']],
+                         ['a1', 'c2'])
+        self.assertEqual([d['id'] for d in q(RECORDS, fields=['id'], filters=['mem>80'])['data']],
+                         ['c1', 'c3'])
+        self.assertEqual([d['id'] for d in q(RECORDS, fields=['id'],
+                                             filters=['job_name~^diego', 'mem<=85'])['data']],
+                         ['c1', 'c2'])
+        self.assertEqual(q(RECORDS, filters=['mem>80'])['count'], 2)
+        with self.assertRaises(ValueError):
+            q(RECORDS, filters=['mem'])
+        with self.assertRaises(ValueError):
+            q(RECORDS, filters=['job_name~('])
+
+    def test_pages(self):
+        seen = list()
+        cursor = None
+        while True:
+            page = vitalsquery.query(RECORDS, fields=['id'], sort=['-mem'], limit=2, cursor=cursor)
+            self.assertEqual(page['count'], 5)
+            seen += [d['id'] for d in page['data']]
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['c3', 'c1', 'c2', 'r1', 'a1'])
+        # c1 goes away between pages: the next page still starts after c1's place
+        first = vitalsquery.query(RECORDS, fields=['id'], sort=['-mem'], limit=2)
+        rest = vitalsquery.query([r for r in RECORDS if r['id'] != 'c1'], fields=['id'], sort=['-mem'],
+                                 limit=2, cursor=first['next'])
+        self.assertEqual([d['id'] for d in rest['data']], ['c2', 'r1'])
+        with self.assertRaises(ValueError):
+            vitalsquery.query(RECORDS, cursor='garbage')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from unittest.mock import patch
+from opcon.modules import vitalsummary
+from helpers import instance
+
+
+VITALS = [instance('diego_cell', 'c{}'.format(i), 40) for i in range(10)] + \
+    [instance('diego_cell', 'c10', 95),
+     instance('router', 'r1', 10), instance('router', 'r2', 30),
+     instance('router', 'r3', 20, vm_cid=None)]
+
+
+class TestVitalSummary(unittest.TestCase):
+    def check(self, summary):
+        self.assertEqual(summary['instances'], 13)
+        cells, routers = summary['jobs']
+        self.assertEqual((cells['job_name'], cells['count']), ('diego_cell', 11))
+        self.assertEqual(cells['metrics']['mem'], {'mean': 45.0, 'p50': 40.0, 'p95': 67.5, 'max': 95.0})
+        self.assertEqual(routers['metrics']['mem'], {'mean': 20.0, 'p50': 20.0, 'p95': 29.0, 'max': 30.0})
+        self.assertEqual(routers['metrics']['disk_persistent'],
+                         {'mean': None, 'p50': None, 'p95': None, 'max': None})
+        self.assertEqual([(o['id'], o['metric'], o['value']) for o in summary['outliers']],
+                         [('c10', 'mem', 95.0)])
+        self.assertEqual(summary['outliers'][0]['z'], 3.16)
+
+    @unittest.skipUnless(vitalsummary.numpy, 'numpy is not installed')
+    def test_summarize_numpy(self):
+        # the vectorised pass, and only that
+        with patch('opcon.modules.vitalsummary.summarize_python', side_effect=AssertionError('pure python')):
+            self.check(vitalsummary.summarize(VITALS))
+
+    @patch('opcon.modules.vitalsummary.numpy', None)
+    def test_summarize_without_numpy(self):
+        with patch('opcon.modules.vitalsummary.summarize_numpy', side_effect=AssertionError('numpy')):
+            self.check(vitalsummary.summarize(VITALS))
+
+    def test_threshold(self):
+        summary = vitalsummary.summarize(VITALS, z=0.9)
+        self.assertEqual(sorted([o['id'] for o in summary['outliers']]), ['c10', 'r1', 'r2'])
+        self.assertEqual(vitalsummary.summarize([])['jobs'], [])
+
+    def test_percentile(self):
+        self.assertEqual(vitalsummary.percentile([1.0], 95), 1.0)
+        self.assertEqual(vitalsummary.percentile([0.0, 10.0], 95), 9.5)
+
+
+if __name__ == '__main__':
+    unittest.main()